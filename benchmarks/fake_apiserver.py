@@ -0,0 +1,504 @@
+"""
+In memory stand-in for the kubernetes apiserver, to benchmark the maintenance scripts offline (see run_benchmarks.py).
+
+It implements only what the scripts use, through components/helpers/k8s_client.py or the fake kubectl next to this file:
+* discovery of the api versions in RESOURCES
+* get, list (label/field selectors, limit/continue pagination, metadata only) and watch (replaying the changes since the
+  given resourceVersion, then waiting for new ones until timeoutSeconds)
+* merge, strategic (as merge), apply (as merge) and json patches, with the resourceVersion preconditions, and delete
+
+Objects are stored once, in the version they are added with. They can carry an overlay per api version (under
+VERSIONS_KEY) that is merged in when they are read through that version, ex. the v1beta1 `status.taskRuns` of the
+tekton pipelineruns, like the conversion webhook would do.
+
+Every request waits `latency` seconds first, and is counted (by verb and resource) along with the bytes of the request
+and response bodies.
+"""
+from __future__ import annotations
+
+import base64
+import copy
+import json
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator
+
+VERSIONS_KEY = "__versions__"
+# how long a watch without timeoutSeconds is kept open, the real apiserver keeps it for a few minutes
+DEFAULT_WATCH_SECONDS = 1.0
+
+
+@dataclass(frozen=True)
+class Resource:
+    api_version: str
+    plural: str
+    kind: str
+    namespaced: bool
+    short_names: tuple[str, ...] = ()
+
+    @property
+    def group(self) -> str:
+        return self.api_version.rpartition("/")[0]
+
+
+RESOURCES = (
+    Resource("v1", "namespaces", "Namespace", namespaced=False, short_names=("ns",)),
+    Resource("v1", "configmaps", "ConfigMap", namespaced=True, short_names=("cm",)),
+    Resource("apps/v1", "deployments", "Deployment", namespaced=True, short_names=("deploy",)),
+    Resource("batch/v1", "cronjobs", "CronJob", namespaced=True, short_names=("cj",)),
+    Resource("batch/v1", "jobs", "Job", namespaced=True),
+    Resource("tekton.dev/v1", "pipelineruns", "PipelineRun", namespaced=True, short_names=("pr",)),
+    Resource("tekton.dev/v1", "taskruns", "TaskRun", namespaced=True, short_names=("tr",)),
+    Resource("tekton.dev/v1beta1", "pipelineruns", "PipelineRun", namespaced=True, short_names=("pr",)),
+    Resource("tekton.dev/v1beta1", "taskruns", "TaskRun", namespaced=True, short_names=("tr",)),
+    Resource(
+        "apiextensions.k8s.io/v1",
+        "customresourcedefinitions",
+        "CustomResourceDefinition",
+        namespaced=False,
+        short_names=("crd", "crds"),
+    ),
+)
+METADATA_ONLY_MARKER = "as=PartialObjectMetadata"
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+    def status(self) -> dict[str, Any]:
+        return {"kind": "Status", "apiVersion": "v1", "status": "Failure", "message": str(self), "code": self.code}
+
+
+def get_resource(api_version: str, plural: str) -> Resource:
+    for resource in RESOURCES:
+        if resource.api_version == api_version and resource.plural == plural:
+            return resource
+    raise ApiError(404, f"the server could not find the requested resource ({api_version} {plural})")
+
+
+def parse_path(path: str) -> tuple[str, list[str]]:
+    """Splits an api path in the api version and the rest of the segments."""
+    segments = [urllib.parse.unquote(segment) for segment in path.strip("/").split("/")]
+    if segments[:2] == ["api", "v1"]:
+        return "v1", segments[2:]
+    if segments[0] == "apis" and len(segments) >= 3:
+        return f"{segments[1]}/{segments[2]}", segments[3:]
+    raise ApiError(404, f"the server could not find the requested path {path}")
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """RFC 7386 json merge patch."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def json_patch(target: dict[str, Any], operations: list[dict[str, Any]]) -> dict[str, Any]:
+    """RFC 6902 json patch, only the add, replace, remove and test operations."""
+    result = copy.deepcopy(target)
+    for operation in operations:
+        *parents, last = [
+            part.replace("~1", "/").replace("~0", "~") for part in operation["path"].lstrip("/").split("/")
+        ]
+        container: Any = result
+        try:
+            for part in parents:
+                container = container[int(part)] if isinstance(container, list) else container[part]
+            key: Any = int(last) if isinstance(container, list) and last != "-" else last
+            if operation["op"] == "test":
+                if container[key] != operation["value"]:
+                    raise ApiError(422, f"the test operation on {operation['path']} failed")
+            elif operation["op"] == "remove":
+                del container[key]
+            elif operation["op"] == "add" and isinstance(container, list):
+                container.insert(len(container) if key == "-" else key, operation["value"])
+            elif operation["op"] in ("add", "replace"):
+                exists = key in container if isinstance(container, dict) else key < len(container)
+                if operation["op"] == "replace" and not exists:
+                    raise ApiError(422, f"unable to replace the missing {operation['path']}")
+                container[key] = operation["value"]
+            else:
+                raise ApiError(422, f"unsupported json patch operation {operation['op']}")
+        except (KeyError, IndexError, TypeError, ValueError) as error:
+            raise ApiError(422, f"unable to apply the json patch on {operation['path']}: {error!r}") from error
+    return result
+
+
+def get_field(k8s_object: dict[str, Any], field: str) -> str:
+    value: Any = k8s_object
+    for key in field.split("."):
+        value = value.get(key, "") if isinstance(value, dict) else ""
+    return str(value)
+
+
+def matches_selector(values: Callable[[str], str | None], selector: str | None) -> bool:
+    """Equality based selectors (a=b, a==b, a!=b, a, !a), for both labels and fields."""
+    for requirement in filter(None, (selector or "").split(",")):
+        if "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if values(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.split("=", 1)
+            if values(key) != value.lstrip("="):
+                return False
+        elif requirement.startswith("!"):
+            if values(requirement[1:]) is not None:
+                return False
+        elif values(requirement) is None:
+            return False
+    return True
+
+
+def matches(k8s_object: dict[str, Any], label_selector: str | None, field_selector: str | None) -> bool:
+    labels = k8s_object["metadata"].get("labels") or {}
+    return matches_selector(labels.get, label_selector) and matches_selector(
+        lambda field: get_field(k8s_object, field), field_selector
+    )
+
+
+class FakeApiserver:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.resource_version = 0
+        # (group, plural) -> (namespace, name) -> object as stored
+        self.objects: dict[tuple[str, str], dict[tuple[str, str], dict[str, Any]]] = {}
+        # (resourceVersion, type, group, plural, old object, new object), see watch
+        self.events: list[tuple[int, str, str, str, dict[str, Any] | None, dict[str, Any]]] = []
+        # watches from before this resourceVersion get a 410 Gone, like after an etcd compaction
+        self.oldest_resource_version = 0
+        self.stats: Counter = Counter()
+        self._lock = threading.Condition()
+        # sorted keys of the objects matching a list query, invalidated on any change
+        self._list_cache: dict[tuple[Any, ...], list[tuple[str, str]]] = {}
+        self._server: ThreadingHTTPServer | None = None
+
+    # helpers to set up the data, they don't count as requests
+
+    def add(self, k8s_object: dict[str, Any], record: bool = True) -> None:
+        group = k8s_object["apiVersion"].rpartition("/")[0]
+        resource = next(resource for resource in RESOURCES if resource.kind == k8s_object["kind"])
+        metadata = k8s_object["metadata"]
+        with self._lock:
+            self.resource_version += 1
+            metadata["resourceVersion"] = str(self.resource_version)
+            metadata.setdefault("uid", f"uid-{self.resource_version}")
+            metadata.setdefault("creationTimestamp", "2024-01-01T00:00:00Z")
+            key = (metadata.get("namespace", ""), metadata["name"])
+            self.objects.setdefault((group, resource.plural), {})[key] = k8s_object
+            self._changed("ADDED", group, resource.plural, None, k8s_object, record=record)
+
+    def compact(self) -> None:
+        """Drops the events recorded so far, ex. once the initial objects are loaded."""
+        with self._lock:
+            self.events.clear()
+            self.oldest_resource_version = self.resource_version
+
+    def update(
+        self, group: str, plural: str, namespace: str, name: str, change: Callable[[dict[str, Any]], Any]
+    ) -> None:
+        with self._lock:
+            old = self.objects[(group, plural)][(namespace, name)]
+            new = copy.deepcopy(old)
+            change(new)
+            self._store(group, plural, old, new)
+
+    def remove(self, group: str, plural: str, namespace: str, name: str) -> None:
+        with self._lock:
+            old = self.objects[(group, plural)].pop((namespace, name))
+            self.resource_version += 1
+            self._changed("DELETED", group, plural, old, {**old, "metadata": {**old["metadata"]}})
+
+    def count(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += value
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats.clear()
+
+    def _store(self, group: str, plural: str, old: dict[str, Any], new: dict[str, Any]) -> dict[str, Any]:
+        self.resource_version += 1
+        new["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.objects[(group, plural)][(new["metadata"].get("namespace", ""), new["metadata"]["name"])] = new
+        self._changed("MODIFIED", group, plural, old, new)
+        return new
+
+    def _changed(
+        self,
+        event_type: str,
+        group: str,
+        plural: str,
+        old: dict[str, Any] | None,
+        new: dict[str, Any],
+        record: bool = True,
+    ) -> None:
+        if event_type == "DELETED":
+            new["metadata"]["resourceVersion"] = str(self.resource_version)
+        self._list_cache.clear()
+        if record:
+            self.events.append((self.resource_version, event_type, group, plural, old, new))
+            self._lock.notify_all()
+
+    # serving
+
+    def start(self, port: int = 0) -> str:
+        """Starts serving in a background thread, returns the url."""
+        apiserver = self
+
+        class Handler(RequestHandler):
+            server_state = apiserver
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def view(self, k8s_object: dict[str, Any], resource: Resource, metadata_only: bool = False) -> dict[str, Any]:
+        """The object as seen through the given api version."""
+        if metadata_only:
+            return {"apiVersion": "meta.k8s.io/v1", "kind": "PartialObjectMetadata", "metadata": k8s_object["metadata"]}
+        result = {key: value for key, value in k8s_object.items() if key != VERSIONS_KEY}
+        if resource.api_version != k8s_object["apiVersion"]:
+            result = merge_patch(result, k8s_object.get(VERSIONS_KEY, {}).get(resource.api_version, {}))
+        result["apiVersion"] = resource.api_version
+        return result
+
+    def get(self, resource: Resource, namespace: str, name: str) -> dict[str, Any]:
+        try:
+            return self.objects.get((resource.group, resource.plural), {})[(namespace, name)]
+        except KeyError:
+            raise ApiError(404, f'{resource.plural} "{name}" not found') from None
+
+    def list(self, resource: Resource, namespace: str | None, params: dict[str, str], metadata_only: bool) -> bytes:
+        with self._lock:
+            label_selector, field_selector = params.get("labelSelector"), params.get("fieldSelector")
+            cache_key = (resource.group, resource.plural, namespace, label_selector, field_selector)
+            if cache_key not in self._list_cache:
+                self._list_cache[cache_key] = sorted(
+                    key
+                    for key, k8s_object in self.objects.get((resource.group, resource.plural), {}).items()
+                    if (namespace is None or key[0] == namespace)
+                    and matches(k8s_object, label_selector, field_selector)
+                )
+            keys = self._list_cache[cache_key]
+            start = 0
+            if params.get("continue"):
+                last_key = tuple(json.loads(base64.b64decode(params["continue"])))
+                start = _bisect_right(keys, last_key)
+            limit = int(params.get("limit") or 0) or len(keys)
+            page = keys[start : start + limit]
+            objects = self.objects.get((resource.group, resource.plural), {})
+            items = [self.view(objects[key], resource, metadata_only=metadata_only) for key in page]
+            list_metadata: dict[str, Any] = {"resourceVersion": str(self.resource_version)}
+            if start + limit < len(keys):
+                list_metadata["continue"] = base64.b64encode(json.dumps(page[-1]).encode()).decode()
+                list_metadata["remainingItemCount"] = len(keys) - start - limit
+
+        return json.dumps(
+            {
+                "apiVersion": "meta.k8s.io/v1" if metadata_only else resource.api_version,
+                "kind": "PartialObjectMetadataList" if metadata_only else f"{resource.kind}List",
+                "metadata": list_metadata,
+                "items": items,
+            }
+        ).encode()
+
+    def watch_events(
+        self, resource: Resource, namespace: str | None, params: dict[str, str], metadata_only: bool
+    ) -> Iterator[dict[str, Any]]:
+        """Yields the watch events since the given resourceVersion, until the timeout."""
+        since = int(params.get("resourceVersion") or self.resource_version)
+        if since < self.oldest_resource_version:
+            yield {"type": "ERROR", "object": ApiError(410, f"too old resource version: {since}").status()}
+            return
+
+        timeout = float(params["timeoutSeconds"]) if params.get("timeoutSeconds") else DEFAULT_WATCH_SECONDS
+        deadline = time.monotonic() + timeout
+        label_selector, field_selector = params.get("labelSelector"), params.get("fieldSelector")
+        position = 0
+        while True:
+            with self._lock:
+                while position < len(self.events) and self.events[position][0] <= since:
+                    position += 1
+                new_events = self.events[position:]
+                position = len(self.events)
+                if not new_events:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                    continue
+
+            for _, event_type, group, plural, old, new in new_events:
+                if (group, plural) != (resource.group, resource.plural):
+                    continue
+                if namespace is not None and new["metadata"].get("namespace") != namespace:
+                    continue
+                old_matches = old is not None and matches(old, label_selector, field_selector)
+                new_matches = matches(new, label_selector, field_selector)
+                if event_type != "DELETED" and new_matches:
+                    event_type = "ADDED" if not old_matches else event_type
+                elif old_matches:
+                    # stopped matching the selectors
+                    event_type = "DELETED"
+                else:
+                    continue
+                yield {"type": event_type, "object": self.view(new, resource, metadata_only=metadata_only)}
+
+        if params.get("allowWatchBookmarks") == "true":
+            bookmark = {"apiVersion": resource.api_version, "kind": resource.kind}
+            bookmark["metadata"] = {"resourceVersion": str(self.resource_version)}
+            yield {"type": "BOOKMARK", "object": bookmark}
+
+    def patch(self, resource: Resource, namespace: str, name: str, content_type: str, body: Any) -> dict[str, Any]:
+        with self._lock:
+            old = self.get(resource, namespace, name)
+            if content_type.startswith("application/json-patch+json"):
+                new = json_patch(old, body)
+            else:
+                expected = (body.get("metadata") or {}).get("resourceVersion") if isinstance(body, dict) else None
+                if expected and expected != old["metadata"]["resourceVersion"]:
+                    raise ApiError(
+                        409,
+                        f'Operation cannot be fulfilled on {resource.plural} "{name}": the object has been modified',
+                    )
+                if content_type.startswith("application/apply-patch"):
+                    body = {key: value for key, value in body.items() if key not in ("apiVersion", "kind")}
+                new = merge_patch(old, body)
+            return self.view(self._store(resource.group, resource.plural, old, new), resource)
+
+    def delete(self, resource: Resource, namespace: str, name: str) -> dict[str, Any]:
+        with self._lock:
+            old = self.get(resource, namespace, name)
+            self.remove(resource.group, resource.plural, namespace, name)
+            return self.view(old, resource)
+
+
+def _bisect_right(keys: list[tuple[str, str]], key: tuple[str, ...]) -> int:
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) // 2
+        if key < keys[middle]:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise the headers and body in separate writes wait for the delayed ack of the client (~40ms per call)
+    disable_nagle_algorithm = True
+    server_state: FakeApiserver
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_PATCH(self) -> None:
+        self._handle("PATCH")
+
+    def do_DELETE(self) -> None:
+        self._handle("DELETE")
+
+    def _send(self, code: int, body: bytes) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server_state.count("bytes_out", len(body))
+
+    def _handle(self, method: str) -> None:
+        apiserver = self.server_state
+        if apiserver.latency:
+            time.sleep(apiserver.latency)
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        raw_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        metadata_only = METADATA_ONLY_MARKER in self.headers.get("Accept", "")
+        apiserver.count("calls")
+        apiserver.count("bytes_in", len(raw_body))
+        if "kubectl" in self.headers.get("User-Agent", ""):
+            apiserver.count("kubectl_calls")
+
+        try:
+            api_version, segments = parse_path(url.path)
+            if not segments:
+                apiserver.count("DISCOVERY")
+                resources = [
+                    {"name": resource.plural, "kind": resource.kind, "namespaced": resource.namespaced}
+                    for resource in RESOURCES
+                    if resource.api_version == api_version
+                ]
+                if not resources:
+                    raise ApiError(404, f"unknown api version {api_version}")
+                self._send(200, json.dumps({"groupVersion": api_version, "resources": resources}).encode())
+                return
+
+            namespace = None
+            if segments[0] == "namespaces" and len(segments) >= 3:
+                namespace, segments = segments[1], segments[2:]
+            resource = get_resource(api_version, segments[0])
+            name = segments[1] if len(segments) > 1 else None
+            if namespace is None and resource.namespaced and name is not None:
+                raise ApiError(404, f"{resource.plural} are namespaced")
+
+            if method == "GET" and name is None and params.get("watch") in ("true", "1"):
+                apiserver.count(f"WATCH {resource.plural}")
+                self._watch(resource, namespace, params, metadata_only)
+                return
+
+            if method == "GET" and name is None:
+                apiserver.count(f"LIST {resource.plural}")
+                self._send(200, apiserver.list(resource, namespace, params, metadata_only))
+                return
+
+            if name is None:
+                raise ApiError(405, f"{method} on a collection is not supported")
+            apiserver.count(f"{method} {resource.plural}")
+            if method == "GET":
+                with apiserver._lock:
+                    result = apiserver.view(apiserver.get(resource, namespace or "", name), resource, metadata_only)
+            elif method == "PATCH":
+                result = apiserver.patch(
+                    resource, namespace or "", name, self.headers.get("Content-Type", ""), json.loads(raw_body)
+                )
+            else:
+                result = apiserver.delete(resource, namespace or "", name)
+            self._send(200, json.dumps(result).encode())
+        except ApiError as error:
+            apiserver.count("errors")
+            self._send(error.code, json.dumps(error.status()).encode())
+
+    def _watch(self, resource: Resource, namespace: str | None, params: dict[str, str], metadata_only: bool) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in self.server_state.watch_events(resource, namespace, params, metadata_only):
+            line = json.dumps(event).encode() + b"\n"
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+            self.server_state.count("bytes_out", len(line))
+        self.wfile.write(b"0\r\n\r\n")
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks of the maintenance scripts, against a fake apiserver (see fake_apiserver.py) and a fake kubectl.
+
+Each scenario loads a synthetic cluster of the given scale in the fake apiserver, runs one of the scripts end to end
+against it (answering its prompts) and reports:
+* the wall time
+* the number of api calls (in total and by verb and resource), and of kubectl runs
+* the bytes received and sent by the apiserver
+* the peak RSS of the script (and its children)
+
+The datasets are:
+* tekton: <scale> pipelineruns and <scale> taskruns in image-build, most of them still stored as v1beta1
+* jobs: <scale> tool namespaces, each with a jobs-framework cronjob and deployment, half of them still version 1 and a
+  quarter with the old default cpu resources
+
+The number of calls only depends on the scale, so it's compared with the one in baseline.json, and any scenario doing
+more calls than that fails the run. Use --update-baseline to record the new numbers after an intended change.
+
+Ex. the default 800 objects and 10k, with 5ms of latency per call:
+    benchmarks/run_benchmarks.py --scale 800 --scale 10000 --latency-ms 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import yaml
+
+from fake_apiserver import VERSIONS_KEY, FakeApiserver
+
+CURDIR = pathlib.Path(__file__).resolve().parent
+BASEDIR = CURDIR.parent
+FAKE_BIN_DIR = CURDIR / "fake-bin"
+BASELINE_FILE = CURDIR / "baseline.json"
+JOBS_MIGRATION_DIR = "components/jobs-api/0.0.467.migration_of_all_jobs_to_version_2"
+TEKTON_NAMESPACE = "image-build"
+JOBS_FRAMEWORK_LABELS = {"app.kubernetes.io/managed-by": "toolforge-jobs-framework"}
+RSS_WRAPPER = """
+import resource, subprocess, sys
+exit_code = subprocess.call(sys.argv[2:])
+with open(sys.argv[1], "w") as rss_file:
+    rss_file.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(exit_code)
+"""
+
+
+def get_container(name: str, cpu: str) -> dict[str, Any]:
+    return {
+        "name": name,
+        "image": "docker-registry.tools.wmflabs.org/toolforge-python311-sssd-base:latest",
+        "command": ["/bin/sh", "-c", "--", f"cd $TOOL_DATA_DIR && ./{name}.sh 1>>{name}.out 2>>{name}.err"],
+        "env": [{"name": "HOME", "value": "/data/project/tool"}],
+        "resources": {"limits": {"cpu": cpu, "memory": "512Mi"}, "requests": {"cpu": cpu, "memory": "512Mi"}},
+        "workingDir": "/data/project/tool",
+    }
+
+
+def load_tekton(apiserver: FakeApiserver, scale: int) -> None:
+    """<scale> pipelineruns with a taskrun each, 1 in 10 already migrated, 1 in 20 cancelled."""
+    steps = [
+        {
+            "name": step,
+            "image": f"docker-registry.tools.wmflabs.org/buildpacks/{step}:0.1",
+            "script": "#!/bin/sh\n" * 20,
+        }
+        for step in ("prepare", "clone", "detect", "analyze", "restore", "build", "export")
+    ]
+    for index in range(scale):
+        pipelinerun = f"build-{index:06d}"
+        taskrun = f"{pipelinerun}-build-from-git"
+        status = {
+            "conditions": [{"type": "Succeeded", "status": "True", "reason": "Succeeded"}],
+            "startTime": "2024-01-01T00:00:00Z",
+            "completionTime": "2024-01-01T00:05:00Z",
+        }
+        if index % 10 == 0:
+            status["childReferences"] = [{"apiVersion": "tekton.dev/v1", "kind": "TaskRun", "name": taskrun}]
+        apiserver.add(
+            {
+                "apiVersion": "tekton.dev/v1",
+                "kind": "PipelineRun",
+                "metadata": {"name": pipelinerun, "namespace": TEKTON_NAMESPACE, "labels": {"user": f"tool{index}"}},
+                "spec": {
+                    "pipelineRef": {"name": "buildpacks"},
+                    "params": [{"name": "APP_IMAGE", "value": f"tools-harbor.wmcloud.org/tool-tool{index}/app"}],
+                    **({"status": "PipelineRunCancelled"} if index % 20 == 0 else {}),
+                },
+                "status": status,
+                # 1 in 3 stored without the taskRuns, the scripts have to find them from the taskruns
+                VERSIONS_KEY: (
+                    {"tekton.dev/v1beta1": {"status": {"taskRuns": {taskrun: {"pipelineTaskName": "build-from-git"}}}}}
+                    if index % 3
+                    else {}
+                ),
+            },
+            record=False,
+        )
+        apiserver.add(
+            {
+                "apiVersion": "tekton.dev/v1",
+                "kind": "TaskRun",
+                "metadata": {
+                    "name": taskrun,
+                    "namespace": TEKTON_NAMESPACE,
+                    # 1 in 2 without the label, as they were created by an older tekton
+                    "labels": {"tekton.dev/pipelineRun": pipelinerun} if index % 2 else {},
+                },
+                "spec": {"serviceAccountName": "buildpacks-service-account", "taskSpec": {"steps": steps}},
+                "status": {
+                    "podName": f"{taskrun}-pod",
+                    "conditions": [{"type": "Succeeded", "status": "True", "reason": "Succeeded"}],
+                    "steps": [{"name": step["name"], "terminated": {"exitCode": 0}} for step in steps],
+                },
+                VERSIONS_KEY: {"tekton.dev/v1beta1": {"status": {"taskResults": []}}},
+            },
+            record=False,
+        )
+    apiserver.compact()
+
+
+def load_jobs(apiserver: FakeApiserver, scale: int) -> None:
+    """<scale> tools with a cronjob and a deployment each, 1 in 2 version 1, 1 in 4 with the old cpu defaults."""
+    for index in range(scale):
+        tool = f"tool{index:06d}"
+        namespace = f"tool-{tool}"
+        cpu = "500m" if index % 4 == 0 else "250m"
+        version = "1" if index % 2 == 0 else "2"
+        apiserver.add(
+            {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace, "labels": {"name": namespace}}},
+            record=False,
+        )
+        labels = {**JOBS_FRAMEWORK_LABELS, "app.kubernetes.io/version": version, "toolforge": "tool"}
+        apiserver.add(
+            {
+                "apiVersion": "batch/v1",
+                "kind": "CronJob",
+                "metadata": {
+                    "name": "daily",
+                    "namespace": namespace,
+                    "labels": {**labels, "app.kubernetes.io/component": "cronjobs"},
+                },
+                "spec": {
+                    "schedule": f"{index % 60} 3 * * *",
+                    "jobTemplate": {"spec": {"template": {"spec": {"containers": [get_container("daily", cpu)]}}}},
+                },
+            },
+            record=False,
+        )
+        apiserver.add(
+            {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "metadata": {
+                    "name": "bot",
+                    "namespace": namespace,
+                    "labels": {**labels, "app.kubernetes.io/component": "deployments"},
+                },
+                "spec": {"replicas": 1, "template": {"spec": {"containers": [get_container("bot", cpu)]}}},
+            },
+            record=False,
+        )
+    apiserver.compact()
+
+
+def migrate_some_jobs(apiserver: FakeApiserver, scale: int) -> None:
+    """Changes between two inventory runs: 1 in 50 version 1 cronjobs migrated, 1 in 100 version 1 bots deleted."""
+    for index in range(0, scale, 2):
+        namespace = f"tool-tool{index:06d}"
+        if index % 50 == 0:
+            apiserver.update(
+                "batch",
+                "cronjobs",
+                namespace,
+                "daily",
+                lambda cronjob: cronjob["metadata"]["labels"].update({"app.kubernetes.io/version": "2"}),
+            )
+        if index % 100 == 2:
+            apiserver.remove("apps", "deployments", namespace, "bot")
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    dataset: Callable[[FakeApiserver, int], None]
+    # relative to the repo, {tmp} is replaced by the scenario work directory
+    command: tuple[str, ...]
+    # the answers to the prompts of the script
+    stdin: str = ""
+    # run before the measured command, ex. to have the state of a previous run
+    setup: tuple[str, ...] = ()
+    # changes to the objects between the setup and the measured command
+    mutate: Callable[[FakeApiserver, int], None] | None = None
+
+
+SCENARIOS = (
+    Scenario(
+        name="taskruns-to-v1",
+        dataset=load_tekton,
+        command=("components/builds-builder/0.124.0-upgrade_taskruns_to_v1.py", "--journal", "{tmp}/journal.jsonl"),
+        stdin="all\n",
+    ),
+    Scenario(
+        name="taskruns-to-v1-bulk",
+        dataset=load_tekton,
+        command=(
+            "components/builds-builder/0.124.0-upgrade_taskruns_to_v1.py",
+            "--bulk",
+            "--journal",
+            "{tmp}/journal.jsonl",
+        ),
+        stdin="all\n",
+    ),
+    Scenario(
+        name="pipelineruns-to-v1",
+        dataset=load_tekton,
+        command=(
+            "components/builds-builder/0.0.121-2-upgrade_pipelineruns_to_v1.py",
+            "--max-rps=0",
+            "--journal",
+            "{tmp}/journal.jsonl",
+        ),
+        stdin="all\n",
+    ),
+    Scenario(
+        name="pipelineruns-to-v1-plan",
+        dataset=load_tekton,
+        command=(
+            "components/builds-builder/0.0.121-2-upgrade_pipelineruns_to_v1.py",
+            "--plan",
+            "--max-rps=0",
+            "--journal",
+            "{tmp}/journal.jsonl",
+            "--snapshot",
+            "{tmp}/snapshot.json",
+        ),
+        stdin="y\n",
+    ),
+    Scenario(
+        name="update-jobs-resources",
+        dataset=load_jobs,
+        command=("components/jobs-api/0.0.416-update-resources.py", "--max-rps=0", "--report", "{tmp}/report.json"),
+    ),
+    Scenario(
+        name="jobs-migration-list-kubectl",
+        dataset=load_jobs,
+        command=(f"{JOBS_MIGRATION_DIR}/01_create_tools_migrations_list.sh", "{tmp}/tools_migration_list.txt"),
+    ),
+    Scenario(
+        name="jobs-migration-inventory",
+        dataset=load_jobs,
+        command=(f"{JOBS_MIGRATION_DIR}/tools_migration_inventory.py", "--output-file", "{tmp}/list.txt"),
+    ),
+    Scenario(
+        name="jobs-migration-inventory-update",
+        dataset=load_jobs,
+        setup=(f"{JOBS_MIGRATION_DIR}/tools_migration_inventory.py", "--output-file", "{tmp}/list.txt"),
+        mutate=migrate_some_jobs,
+        command=(
+            f"{JOBS_MIGRATION_DIR}/tools_migration_inventory.py",
+            "--output-file",
+            "{tmp}/list.txt",
+            "--watch-seconds",
+            "1",
+        ),
+    ),
+)
+
+
+@dataclass
+class Result:
+    scenario: str
+    scale: int
+    exit_code: int
+    wall_seconds: float
+    peak_rss_bytes: int
+    stats: dict[str, int]
+    kubectl_runs: int
+    log: str
+    baseline_calls: int | None = None
+
+    @property
+    def calls(self) -> int:
+        return self.stats.get("calls", 0)
+
+    @property
+    def regression(self) -> bool:
+        return self.baseline_calls is not None and self.calls > self.baseline_calls
+
+
+def write_kubeconfig(path: pathlib.Path, server: str) -> None:
+    path.write_text(
+        yaml.safe_dump(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "current-context": "benchmarks",
+                "contexts": [{"name": "benchmarks", "context": {"cluster": "benchmarks", "user": "benchmarks"}}],
+                "clusters": [{"name": "benchmarks", "cluster": {"server": server}}],
+                "users": [{"name": "benchmarks", "user": {"token": "benchmarks"}}],
+            }
+        )
+    )
+
+
+def get_command(command: tuple[str, ...], tmp_dir: pathlib.Path) -> list[str]:
+    args = [arg.replace("{tmp}", str(tmp_dir)) for arg in command]
+    interpreter = [sys.executable] if args[0].endswith(".py") else ["bash"]
+    return [*interpreter, str(BASEDIR / args[0]), *args[1:]]
+
+
+def run_measured(
+    command: list[str], env: dict[str, str], stdin: str, log_path: pathlib.Path, timeout: float
+) -> tuple[int, float, int]:
+    """Returns the exit code, wall time and peak RSS (bytes) of the command, including the processes it started."""
+    with log_path.open("ab") as log, tempfile.TemporaryFile() as stdin_file, tempfile.NamedTemporaryFile() as rss_file:
+        stdin_file.write(stdin.encode())
+        stdin_file.seek(0)
+        log.write(f"$ {' '.join(command)}\n".encode())
+        log.flush()
+        start = time.monotonic()
+        # linux keeps the peak RSS over exec, so the command would start with the one of this process (that holds the
+        # whole dataset), start it from a small process instead
+        process = subprocess.Popen(
+            [sys.executable, "-c", RSS_WRAPPER, rss_file.name, *command],
+            stdin=stdin_file,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env,
+            cwd=BASEDIR,
+            start_new_session=True,
+        )
+        try:
+            exit_code = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            exit_code = process.wait()
+        wall_seconds = time.monotonic() - start
+        peak_rss = int(rss_file.read() or 0)
+    # ru_maxrss is in kilobytes on linux
+    return exit_code, wall_seconds, peak_rss * 1024
+
+
+def run_scenario(scenario: Scenario, scale: int, latency: float, work_dir: pathlib.Path, timeout: float) -> Result:
+    tmp_dir = work_dir / f"{scenario.name}-{scale}"
+    log_path = work_dir / f"{scenario.name}-{scale}.log"
+    # no journals, snapshots or inventories from a previous run
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    log_path.unlink(missing_ok=True)
+    (tmp_dir / "home").mkdir(parents=True)
+    kubectl_log = tmp_dir / "kubectl.log"
+
+    apiserver = FakeApiserver()
+    scenario.dataset(apiserver, scale)
+    server = apiserver.start()
+    try:
+        write_kubeconfig(tmp_dir / "kubeconfig", server)
+        env = {
+            **os.environ,
+            "HOME": str(tmp_dir / "home"),
+            "KUBECONFIG": str(tmp_dir / "kubeconfig"),
+            "PATH": f"{FAKE_BIN_DIR}{os.pathsep}{os.environ.get('PATH', '')}",
+            "BENCHMARK_KUBECTL_LOG": str(kubectl_log),
+            "PYTHONDONTWRITEBYTECODE": "1",
+        }
+        env.pop("XDG_CACHE_HOME", None)
+        if scenario.setup:
+            run_measured(get_command(scenario.setup, tmp_dir), env, scenario.stdin, log_path, timeout)
+        if scenario.mutate:
+            scenario.mutate(apiserver, scale)
+        kubectl_log.unlink(missing_ok=True)
+
+        # the latency only applies to the measured run
+        apiserver.latency = latency
+        apiserver.reset_stats()
+        exit_code, wall_seconds, peak_rss = run_measured(
+            get_command(scenario.command, tmp_dir), env, scenario.stdin, log_path, timeout
+        )
+    finally:
+        apiserver.stop()
+
+    return Result(
+        scenario=scenario.name,
+        scale=scale,
+        exit_code=exit_code,
+        wall_seconds=wall_seconds,
+        peak_rss_bytes=peak_rss,
+        stats=dict(apiserver.stats),
+        kubectl_runs=len(kubectl_log.read_text().splitlines()) if kubectl_log.exists() else 0,
+        log=str(log_path),
+    )
+
+
+def show_results(results: list[Result]) -> None:
+    print(
+        f"{'scenario':32} {'scale':>7} {'wall(s)':>8} {'calls':>7} {'baseline':>8} {'kubectl':>7} "
+        f"{'MB in':>7} {'MB out':>8} {'RSS(MB)':>8}  result"
+    )
+    for result in results:
+        if result.exit_code != 0:
+            outcome = f"FAILED (exit code {result.exit_code}, see {result.log})"
+        elif result.regression:
+            outcome = f"REGRESSION (+{result.calls - (result.baseline_calls or 0)} calls)"
+        else:
+            outcome = "ok"
+        print(
+            f"{result.scenario:32} {result.scale:>7} {result.wall_seconds:>8.1f} {result.calls:>7} "
+            f"{'-' if result.baseline_calls is None else result.baseline_calls:>8} {result.kubectl_runs:>7} "
+            f"{result.stats.get('bytes_in', 0) / 1e6:>7.1f} {result.stats.get('bytes_out', 0) / 1e6:>8.1f} "
+            f"{result.peak_rss_bytes / 1e6:>8.1f}  {outcome}"
+        )
+        calls_by_type = {
+            key: value for key, value in sorted(result.stats.items()) if key not in ("calls", "bytes_in", "bytes_out")
+        }
+        print(f"{'':42}{calls_by_type}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--scale",
+        type=int,
+        action="append",
+        help="Number of objects of each kind (can be repeated, default: 800), ex. 800, 10000 or 100000.",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="Only run the given scenario (can be repeated, default: all).",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added to every api call (default: 0).")
+    parser.add_argument("--timeout", type=float, default=1800, help="Timeout for each script run, in seconds.")
+    parser.add_argument(
+        "--work-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to keep the logs and files of each run (default: a new temporary directory).",
+    )
+    parser.add_argument("--json", dest="json_path", type=pathlib.Path, help="Also write the results to this json file.")
+    parser.add_argument(
+        "--baseline", type=pathlib.Path, default=BASELINE_FILE, help=f"Baseline file (default: {BASELINE_FILE})."
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Record the number of calls of the successful runs in the baseline file instead of comparing with it.",
+    )
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or pathlib.Path(tempfile.mkdtemp(prefix="toolforge-deploy-benchmarks-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario.name in args.scenario]
+    print(f"Logs and files of each run in {work_dir}")
+
+    results = []
+    for scale in args.scale or [800]:
+        for scenario in scenarios:
+            print(f"Running {scenario.name} with {scale} objects...", flush=True)
+            result = run_scenario(
+                scenario=scenario, scale=scale, latency=args.latency_ms / 1000, work_dir=work_dir, timeout=args.timeout
+            )
+            if not args.update_baseline:
+                result.baseline_calls = baseline.get(scenario.name, {}).get(str(scale))
+            results.append(result)
+
+    show_results(results)
+    if args.json_path:
+        args.json_path.write_text(
+            json.dumps([{**result.__dict__, "calls": result.calls} for result in results], indent=2)
+        )
+
+    if args.update_baseline:
+        for result in results:
+            if result.exit_code == 0:
+                baseline.setdefault(result.scenario, {})[str(result.scale)] = result.calls
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"Updated the baseline in {args.baseline}")
+        return 0
+
+    if any(result.exit_code != 0 or result.regression for result in results):
+        print("Some scenarios failed or made more calls than in the baseline.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,7 @@ Currently in tools this means ~800 conversion requests for any request to the bu
 
 
 This has to be run from a k8s control node, *instead* of running the toolforge.component.deploy cookbook.
+It talks directly to the apiserver with the credentials from your kubeconfig (see components/helpers/k8s_client.py).
 
 It will:
 * go over all the pipelineruns in the image-build namespace
@@ -16,10 +17,21 @@ It will:
 * download the v1beta1 version and extract the taskruns (this is the currently stored version)
 * add the `childRefeneces` section with the taskruns to the v1 version
 * upload the modified v1 version (this effectively stores the v1 version retaining the links to taskruns)
+
+Once you answer "all", the patches are sent in parallel (see --concurrency and --max-rps), and a summary of the failed
+ones is shown at the end instead of stopping on the first failure.
+
+Every migrated (or skipped) pipelinerun is recorded with its resourceVersion in a local journal (see --journal), so if
+the script is interrupted, the next run skips the already finished ones without asking the apiserver. Use --verify to
+re-check only the journaled pipelineruns that changed since they were recorded.
+
+With --plan, all the pipelineruns (both versions) and taskruns are captured in a local snapshot with a few list calls,
+the whole set of patches is computed offline and shown, and then applied after a single confirmation. Each patch
+carries the resourceVersion from the snapshot, so pipelineruns that changed in the meantime are rejected (and reported)
+instead of overwritten. --dry-run only shows the plan, and re-running it reuses the snapshot (see --refresh-snapshot).
 """
 from typing import Any, Literal
-import subprocess
-import tempfile
+import sys
 import pathlib
 import click
 import yaml
@@ -27,6 +39,16 @@ import yaml
 
 CURDIR = pathlib.Path(__file__).parent
 BASEDIR = CURDIR.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from cluster_snapshot import SNAPSHOTS_DIR, Plan, PlannedPatch, PlanStep, Snapshot  # noqa: E402
+from k8s_client import get_client, get_cluster_id, resource_path  # noqa: E402
+from k8s_executor import RateLimitedExecutor  # noqa: E402
+from migration_journal import JOURNALS_DIR, JournalError, MigrationJournal  # noqa: E402
+from tekton_index import TaskRunIndex  # noqa: E402
+
+
+NAMESPACE = "image-build"
 
 
 def get_pipelinerun_names() -> list[str]:
@@ -39,109 +61,295 @@ def get_taskrun_names() -> list[str]:
 
 def get_all_names(resource: str) -> list[str]:
     """This will be the only request that takes >10s."""
-    cmd: list[str] = [
-        "kubectl",
-        "get",
-        "-o",
-        "name",
-        "-n",
-        "image-build",
-        resource,
-    ]
-    try:
-        raw_list = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
+    return list(get_resource_versions(resource=resource).keys())
+
 
-    # they output the type prefixed, we only want the name
-    pipelinerun_names = [
-        name.rsplit("/", 1)[-1] for name in raw_list.decode("utf-8").split()
-    ]
-    return pipelinerun_names
+def get_all_taskruns() -> list[dict[str, Any]]:
+    """Single (paginated) list call, used to build the taskrun index, that only needs their metadata."""
+    return get_client().list(resource_path("tekton.dev/v1", "taskruns", namespace=NAMESPACE), metadata_only=True).items
+
+
+def get_resource_versions(resource: str) -> dict[str, str]:
+    """Returns the current resourceVersion for each object name, used to verify the journal."""
+    result = get_client().list(resource_path("tekton.dev/v1", resource, namespace=NAMESPACE), metadata_only=True)
+    return {item["metadata"]["name"]: item["metadata"]["resourceVersion"] for item in result.items}
 
 
 def get_pipeline(name: str, version: Literal["v1", "v1beta1"]) -> dict[str, Any]:
-    """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
-    """
-    cmd: list[str] = [
-        "kubectl",
-        "get",
-        "-n",
-        "image-build",
-        "-o",
-        "yaml",
-        f"pipelineruns.{version}.tekton.dev",
-        name,
-    ]
-    try:
-        output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
+    return get_client().get(resource_path(f"tekton.dev/{version}", "pipelineruns", namespace=NAMESPACE, name=name))
 
-    return yaml.safe_load(output)
 
+def k8s_patch(new_value: dict[str, Any], pipelinerun_name: str) -> str:
+    """Returns the resourceVersion of the patched pipelinerun."""
+    path = resource_path("tekton.dev/v1", "pipelineruns", namespace=NAMESPACE, name=pipelinerun_name)
+    return get_client().patch(path=path, body=new_value, patch_type="merge")["metadata"]["resourceVersion"]
 
-def k8s_patch(new_value: dict[str, Any], pipelinerun_name: str):
-    """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
-    """
-    tmp_file = pathlib.Path(tempfile.mktemp())
-    with tmp_file.open("w") as tmp_file_df:
-        yaml.safe_dump(new_value, tmp_file_df)
-
-    cmd: list[str] = [
-        "kubectl",
-        "patch",
-        "pipelineruns",
-        "--namespace=image-build",
-        "--type=merge",
-        f"--patch-file={tmp_file}",
-        pipelinerun_name,
-    ]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
 
-    tmp_file.unlink()
+def k8s_patch_status_subresource(new_value: dict[str, Any], pipelinerun_name: str) -> str:
+    """Returns the resourceVersion of the patched pipelinerun."""
+    path = resource_path(
+        "tekton.dev/v1", "pipelineruns", namespace=NAMESPACE, name=pipelinerun_name, subresource="status"
+    )
+    return get_client().patch(path=path, body=new_value, patch_type="merge")["metadata"]["resourceVersion"]
+
+
+def patch_pipelinerun(
+    pipelinerun_name: str,
+    spec_status_patch: dict[str, Any],
+    patch: dict[str, Any],
+    journal: MigrationJournal,
+) -> None:
+    if spec_status_patch:
+        k8s_patch(new_value=spec_status_patch, pipelinerun_name=pipelinerun_name)
+
+    resource_version = k8s_patch_status_subresource(new_value=patch, pipelinerun_name=pipelinerun_name)
+    journal.record(name=pipelinerun_name, resource_version=resource_version)
 
 
-def k8s_patch_status_subresource(new_value: dict[str, Any], pipelinerun_name: str):
+def get_patches(
+    v1_version: dict[str, Any],
+    v1beta1_version: dict[str, Any],
+    taskrun_index: TaskRunIndex,
+) -> tuple[dict[str, Any], dict[str, Any]] | None:
     """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
+    Returns the spec and status patches for the pipelinerun, or None if there's nothing to do.
+
+    Only uses the given objects, so it works the same for live objects and for the ones in a snapshot.
     """
-    tmp_file = pathlib.Path(tempfile.mktemp())
-    with tmp_file.open("w") as tmp_file_df:
-        yaml.safe_dump(new_value, tmp_file_df)
-
-    cmd: list[str] = [
-        "kubectl",
-        "patch",
-        "pipelineruns",
-        "--namespace=image-build",
-        "--subresource=status",
-        "--type=merge",
-        f"--patch-file={tmp_file}",
-        pipelinerun_name,
-    ]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
+    pipelinerun_name = v1_version["metadata"]["name"]
+    if "taskRuns" not in v1beta1_version["status"]:
+        # fall back to filtering from the known runs
+        taskrun_names = taskrun_index.for_pipelinerun(pipelinerun_name=pipelinerun_name)
+        if not taskrun_names:
+            click.echo(
+                "      Skipping, the v1beta1 version has no task runs, maybe it failed completely to launch?"
+            )
+            return None
+    else:
+        taskrun_names = list(v1beta1_version["status"]["taskRuns"].keys())
+
+    patch: dict[str, Any] = {"status": {"childReferences": []}}
+    for taskrun_name in taskrun_names:
+        patch["status"]["childReferences"].append(
+            {
+                "apiVersion": "tekton.dev/v1",
+                "kind": "TaskRun",
+                "name": taskrun_name,
+                "pipelineTaskName": "build-from-git",
+            }
+        )
+
+    spec_status_patch: dict[str, Any] = {}
+    # Needed to patch cancelled runs
+    if v1_version["spec"].get("status", None) == "PipelineRunCancelled":
+        spec_status_patch["spec"] = {"status": "Cancelled"}
+
+    return spec_status_patch, patch
+
+
+def run_plan(
+    journal: MigrationJournal,
+    snapshot_path: pathlib.Path,
+    refresh_snapshot: bool,
+    dry_run: bool,
+    concurrency: int,
+    max_rps: float,
+) -> None:
+    """Snapshot-and-plan mode, see --plan."""
+    client = get_client()
+    snapshot = Snapshot.load_or_capture(
+        path=snapshot_path,
+        queries={
+            "pipelineruns_v1": lambda: client.list(
+                resource_path("tekton.dev/v1", "pipelineruns", namespace=NAMESPACE)
+            ).items,
+            "pipelineruns_v1beta1": lambda: client.list(
+                resource_path("tekton.dev/v1beta1", "pipelineruns", namespace=NAMESPACE)
+            ).items,
+            "taskruns": lambda: client.list(
+                resource_path("tekton.dev/v1", "taskruns", namespace=NAMESPACE), metadata_only=True
+            ).items,
+        },
+        refresh=refresh_snapshot,
+    )
+    v1beta1_versions = {item["metadata"]["name"]: item for item in snapshot["pipelineruns_v1beta1"]}
+    taskrun_index = TaskRunIndex.from_taskruns(taskruns=snapshot["taskruns"])
+
+    plan = Plan()
+    skipped: dict[str, str] = {}
+    for v1_version in snapshot["pipelineruns_v1"]:
+        v1_version.setdefault("apiVersion", "tekton.dev/v1")
+        v1_version.setdefault("kind", "PipelineRun")
+        pipelinerun_name = v1_version["metadata"]["name"]
+        if journal.is_done(pipelinerun_name):
+            continue
 
-    tmp_file.unlink()
+        if "childReferences" in v1_version["status"] or pipelinerun_name not in v1beta1_versions:
+            skipped[pipelinerun_name] = v1_version["metadata"]["resourceVersion"]
+            continue
+
+        click.echo(f"    Pipelinerun {pipelinerun_name}")
+        patches = get_patches(
+            v1_version=v1_version,
+            v1beta1_version=v1beta1_versions[pipelinerun_name],
+            taskrun_index=taskrun_index,
+        )
+        if patches is None:
+            skipped[pipelinerun_name] = v1_version["metadata"]["resourceVersion"]
+            continue
+
+        spec_status_patch, patch = patches
+        planned_patches = [PlannedPatch(body=spec_status_patch)] if spec_status_patch else []
+        planned_patches.append(PlannedPatch(body=patch, subresource="status"))
+        plan.add(PlanStep.for_object(k8s_object=v1_version, patches=planned_patches))
+
+    plan.show()
+    click.echo(f"{len(skipped)} pipelineruns need no migration (already v1 or without task runs).")
+    if dry_run:
+        click.echo("Dry run, not applying anything.")
+        return
+
+    if not plan.steps and not skipped:
+        click.echo("Nothing to do.")
+        return
+
+    if not click.confirm("Are you sure you want to apply the plan?", default=False):
+        click.echo("Aborting")
+        return
+
+    for pipelinerun_name, resource_version in skipped.items():
+        journal.record(name=pipelinerun_name, resource_version=resource_version)
+
+    failures = plan.apply(
+        concurrency=concurrency,
+        max_rps=max_rps,
+        on_applied=lambda step, resource_version: journal.record(name=step.name, resource_version=resource_version),
+    )
+    Snapshot.discard(path=snapshot_path)
+    if failures:
+        click.echo("Some pipelineruns failed to be migrated, you can re-run the script to retry them.")
+        sys.exit(1)
+
+    click.echo(
+        r"Done \o/, please run the functional tests from the bastion to make sure everything works as expected."
+    )
 
 
 @click.command(help=__doc__)
-def main() -> None:
+@click.option(
+    "--concurrency",
+    default=8,
+    show_default=True,
+    help="How many patches to send in parallel once you answer 'all'.",
+)
+@click.option(
+    "--max-rps",
+    default=10.0,
+    show_default=True,
+    help="Maximum patch requests per second to send (0 for no limit), to avoid overloading the conversion webhook.",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=(
+        f"Journal file to record the finished pipelineruns in (default: {JOURNALS_DIR}/<cluster>/<script name>.jsonl)."
+    ),
+)
+@click.option(
+    "--verify",
+    is_flag=True,
+    default=False,
+    help="Only re-check the journaled pipelineruns that changed (different resourceVersion) since they were migrated.",
+)
+@click.option(
+    "--plan",
+    "plan_mode",
+    is_flag=True,
+    default=False,
+    help=(
+        "Capture (or reuse) a snapshot of all the pipelineruns and taskruns with a few list calls, compute all the "
+        "patches offline and apply them at once after a single confirmation."
+    ),
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only show the plan computed from the snapshot (implies --plan), can be repeated without hitting the "
+        "apiserver."
+    ),
+)
+@click.option(
+    "--snapshot",
+    "snapshot_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=f"Snapshot file for --plan (default: {SNAPSHOTS_DIR}/<cluster>/<script name>.json).",
+)
+@click.option(
+    "--refresh-snapshot",
+    is_flag=True,
+    default=False,
+    help="Re-capture the snapshot even if there's one already.",
+)
+def main(
+    concurrency: int,
+    max_rps: float,
+    journal_path: pathlib.Path | None,
+    verify: bool,
+    plan_mode: bool,
+    dry_run: bool,
+    snapshot_path: pathlib.Path | None,
+    refresh_snapshot: bool,
+) -> None:
     yes_all = False
+    executor = RateLimitedExecutor(concurrency=concurrency, max_rps=max_rps, label="pipelineruns")
+    cluster_id = get_cluster_id()
+    try:
+        if journal_path:
+            journal = MigrationJournal(path=journal_path, cluster_id=cluster_id)
+        else:
+            journal = MigrationJournal.for_script(__file__, cluster_id=cluster_id)
+    except JournalError as error:
+        raise click.ClickException(str(error)) from error
     click.echo(
         "Running the pipelinerun upgrade script (only do so after upgrade!) for builds-builder to 0.121.0"
     )
-    pipelinerun_names = get_all_names(resource="pipelineruns")
-    click.echo(f"I'm going to migrate {len(pipelinerun_names)} pipelineruns")
-    all_taskrun_names = get_all_names(resource="taskruns")
+    click.echo(f"Using journal {journal.path} ({len(journal.done)} pipelineruns already done)")
+    if plan_mode or dry_run:
+        if verify:
+            raise click.UsageError("--verify can't be used with --plan/--dry-run")
+
+        run_plan(
+            journal=journal,
+            snapshot_path=snapshot_path or Snapshot.default_path(__file__),
+            refresh_snapshot=refresh_snapshot,
+            dry_run=dry_run,
+            concurrency=concurrency,
+            max_rps=max_rps,
+        )
+        return
+
+    if verify:
+        resource_versions = get_resource_versions(resource="pipelineruns")
+        changed_names = journal.changed(resource_versions=resource_versions)
+        pipelinerun_names = [name for name in changed_names if name in resource_versions]
+        click.echo(
+            f"I'm going to re-check {len(pipelinerun_names)} pipelineruns that changed since migrated "
+            f"({len(changed_names) - len(pipelinerun_names)} journaled ones are gone)"
+        )
+    else:
+        pipelinerun_names = [
+            pipelinerun_name
+            for pipelinerun_name in get_all_names(resource="pipelineruns")
+            if not journal.is_done(pipelinerun_name)
+        ]
+        click.echo(f"I'm going to migrate {len(pipelinerun_names)} pipelineruns")
+
+    taskrun_index = TaskRunIndex.from_taskruns(taskruns=get_all_taskruns())
     for pipelinerun_name in pipelinerun_names:
         click.echo(f"    Pipelinerun {pipelinerun_name}")
         v1_version = get_pipeline(name=pipelinerun_name, version="v1")
@@ -149,41 +357,18 @@ def main() -> None:
             click.echo(
                 "        Skipping, it seems it's already stored in version v1 (it has childReferences)"
             )
+            journal.record(name=pipelinerun_name, resource_version=v1_version["metadata"]["resourceVersion"])
             continue
 
-        v1_version["status"]["childReferences"] = []
         v1beta1_version = get_pipeline(name=pipelinerun_name, version="v1beta1")
-        if "taskRuns" not in v1beta1_version["status"]:
-            # fall back to filtering from the known runs
-            taskrun_names = [
-                taskrun_name
-                for taskrun_name in all_taskrun_names
-                if taskrun_name.startswith(pipelinerun_name)
-            ]
-            if not taskrun_names:
-                click.echo(
-                    "      Skipping, the v1beta1 version has no task runs, maybe it failed completely to launch?"
-                )
-                continue
-        else:
-            taskrun_names = list(v1beta1_version["status"]["taskRuns"].keys())
-
-        patch: dict[str, Any] = {"status": {"childReferences": []}}
-        for taskrun_name in taskrun_names:
-            patch["status"]["childReferences"].append(
-                {
-                    "apiVersion": "tekton.dev/v1",
-                    "kind": "TaskRun",
-                    "name": taskrun_name,
-                    "pipelineTaskName": "build-from-git",
-                }
-            )
-
-        spec_status_patch: dict[str, Any] = {}
-        # Needed to patch cancelled runs
-        if v1_version["spec"].get("status", None) == "PipelineRunCancelled":
-            spec_status_patch["spec"]["status"] = "Cancelled"
+        patches = get_patches(
+            v1_version=v1_version, v1beta1_version=v1beta1_version, taskrun_index=taskrun_index
+        )
+        if patches is None:
+            journal.record(name=pipelinerun_name, resource_version=v1beta1_version["metadata"]["resourceVersion"])
+            continue
 
+        spec_status_patch, patch = patches
         click.echo("    Uploading modified v1 pipelinerun...")
         if not yes_all:
             click.echo(f"-- {pipelinerun_name} ------------------------")
@@ -202,14 +387,33 @@ def main() -> None:
             )
             if answer == "no":
                 click.echo("Aborting")
+                executor.wait()
                 return
             if answer == "all":
                 yes_all = True
 
-        if spec_status_patch:
-            k8s_patch(new_value=patch, pipelinerun_name=pipelinerun_name)
+        if not yes_all:
+            # we are still checking them one by one
+            patch_pipelinerun(
+                pipelinerun_name=pipelinerun_name,
+                spec_status_patch=spec_status_patch,
+                patch=patch,
+                journal=journal,
+            )
+        else:
+            executor.submit(
+                pipelinerun_name,
+                patch_pipelinerun,
+                pipelinerun_name=pipelinerun_name,
+                spec_status_patch=spec_status_patch,
+                patch=patch,
+                journal=journal,
+            )
 
-        k8s_patch_status_subresource(new_value=patch, pipelinerun_name=pipelinerun_name)
+    failures = executor.wait()
+    if failures:
+        click.echo("Some pipelineruns failed to be migrated, you can re-run the script to retry them.")
+        sys.exit(1)
 
     click.echo(
         r"Done \o/, please run the functional tests from the bastion to make sure everything works as expected."
@@ -217,4 +421,5 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    with tracing.script_span(__file__):
+        main()
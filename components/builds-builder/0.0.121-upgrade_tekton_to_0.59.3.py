@@ -15,8 +15,7 @@ It will:
 """
 from typing import Any
 import requests
-import subprocess
-import tempfile
+import sys
 import pathlib
 import click
 import yaml
@@ -28,14 +27,14 @@ BASEDIR = CURDIR.parent.parent
 REMOVE_CONVERSIONS_PATCH = {
     "spec": {"conversion": {"$retainKeys": ["strategy"], "strategy": "None"}}
 }
+CRDS_PATH = "/apis/apiextensions.k8s.io/v1/customresourcedefinitions"
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_client import get_client  # noqa: E402
 
 
 def patch_existing_crds_without_hooks():
-    existing_crds = (
-        subprocess.check_output(["kubectl", "get", "crds", "-o=name"])
-        .decode("utf-8")
-        .split()
-    )
+    existing_crds = [crd["metadata"]["name"] for crd in get_client().list(CRDS_PATH, metadata_only=True).items]
 
     for crd in existing_crds:
         if not crd.endswith("tekton.dev"):
@@ -43,7 +42,7 @@ def patch_existing_crds_without_hooks():
         # we need to patch the old to remove the conversion webhook *before* applying the new
         patch(
             patch=REMOVE_CONVERSIONS_PATCH,
-            object_fqp=crd,
+            object_path=f"{CRDS_PATH}/{crd}",
         )
 
 
@@ -62,11 +61,11 @@ def apply_crds_without_hooks():
 
 
 def upgrade_builds_builder():
-    subprocess.check_call([f"{BASEDIR}/deploy.sh", "builds-builder", "--wait"])
+    tracing.run([f"{BASEDIR}/deploy.sh", "builds-builder", "--wait"], check=True)
 
 
 def upgrade_builds_api():
-    subprocess.check_call([f"{BASEDIR}/deploy.sh", "builds-api", "--wait"])
+    tracing.run([f"{BASEDIR}/deploy.sh", "builds-api", "--wait"], check=True)
 
 
 def apply_crds_with_hooks():
@@ -77,51 +76,24 @@ def apply_crds_with_hooks():
     apply(k8s_objects=crds_data)
 
 
-def patch(patch: dict[str, Any], object_fqp: str):
+def patch(patch: dict[str, Any], object_path: str):
     """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
+    Strategic merge patch (same as kubectl patch defaults to), needed for the $retainKeys directive.
 
-    object_fqd is the fully qualified path, like:
-        customresourcedefinition.apiextensions.k8s.io/taskruns.tekton.dev
+    object_path is the api path to the object, like:
+        /apis/apiextensions.k8s.io/v1/customresourcedefinitions/taskruns.tekton.dev
     """
-    tmp_file = pathlib.Path(tempfile.mktemp())
-    with tmp_file.open("w") as tmp_file_df:
-        yaml.safe_dump(patch, tmp_file_df)
-
-    cmd: list[str] = [
-        "kubectl",
-        "patch",
-        "--patch-file",
-        str(tmp_file),
-        object_fqp,
-    ]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
-
-    tmp_file.unlink()
+    get_client().patch(path=object_path, body=patch, patch_type="strategic")
 
 
 def apply(k8s_objects: list[dict[str, Any]]):
-    """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
-    """
+    """Server-side applies the given CRDs."""
     if isinstance(k8s_objects, dict):
         # in case we get passed a single object directly, we want a list of them
         k8s_objects = [k8s_objects]
 
-    tmp_file = pathlib.Path(tempfile.mktemp())
-    with tmp_file.open("w") as tmp_file_df:
-        yaml.safe_dump_all(k8s_objects, tmp_file_df)
-
-    cmd: list[str] = ["kubectl", "apply", "-f", str(tmp_file)]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
-
-    tmp_file.unlink()
+    for k8s_object in k8s_objects:
+        get_client().apply(k8s_object=k8s_object, plural="customresourcedefinitions")
 
 
 # order matters
@@ -149,7 +121,8 @@ def main(stages: list[str]):
     for stage in stages:
         click.echo(f"{stage}: starting")
         stage_fn = STAGES[stage]
-        stage_fn()
+        with tracing.span(stage):
+            stage_fn()
         click.echo(f"{stage}: done")
 
     click.echo(
@@ -158,4 +131,5 @@ def main(stages: list[str]):
 
 
 if __name__ == "__main__":
-    main()
+    with tracing.script_span(__file__):
+        main()
@@ -1,22 +1,27 @@
 #!/usr/bin/env python3
 ## Only run the first time we move from kustomize to helmfile
+#
+# The resources to adopt are captured once in a local snapshot (reused on the next runs, see --refresh-snapshot), the
+# ones already owned by the release are skipped, and the patches fail instead of overwriting resources that changed
+# since the snapshot was taken. Use --dry-run to only show what would be adopted.
 from __future__ import annotations
-from subprocess import check_call, check_output
+import functools
+import pathlib
+import sys
 import click
 from dataclasses import dataclass
 
-
-@dataclass(frozen=True)
-class Resource:
-    kind: str
-    name: str
-    namespace: str
-    release: str
-
-    @classmethod
-    def from_line(cls, line: str, namespace: str, release: str) -> "Resource":
-        kind, name = line.split("/", 1)
-        return cls(kind=kind, name=name, namespace=namespace, release=release)
+BASEDIR = pathlib.Path(__file__).parent.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from cluster_snapshot import SNAPSHOTS_DIR, Snapshot  # noqa: E402
+from helm_ownership import (  # noqa: E402
+    ObjectRef,
+    get_matching_objects,
+    get_named_objects,
+    load_or_capture_objects,
+    plan_adoption,
+)
 
 
 @dataclass(frozen=True)
@@ -26,14 +31,6 @@ class ResourceMatch:
     namespace: str = ""
     release: str = ""
 
-    def matches(self, resource: Resource) -> bool:
-        return bool(
-            self.kind and self.kind == resource.kind
-            and self.name and self.name == resource.name
-            and self.namespace and self.namespace == resource.namespace
-            and self.release and self.release == resource.release
-        )
-
 
 @dataclass(frozen=True)
 class Release:
@@ -43,12 +40,10 @@ class Release:
     selector: str
     resource_matches: list[ResourceMatch]
 
-    def adopt(self, resource: Resource) -> None:
-        resource_str = f"{resource.kind}/{resource.name}"
-        adopt(
-            release=self,
-            resource=resource_str,
-        )
+    @property
+    def snapshot_key(self) -> str:
+        # the same release spans several namespaces
+        return f"{self.name}/{self.resource_namespace}"
 
 
 SELECTOR = "app.kubernetes.io/part-of=toolforge-build-service"
@@ -100,46 +95,20 @@ TO_ADOPT = [
 ]
 
 
-def annotate(resource: str, namespace: str, annotations: dict[str, str]) -> None:
-    for name, value in annotations.items():
-        check_call(
-            ["kubectl", "annotate", f"-n={namespace}", "--overwrite", resource, f"{name}={value}"]
-        )
-
-
-def label(resource: str, namespace: str, labels: dict[str, str]) -> None:
-    for name, value in labels.items():
-        check_call(
-            ["kubectl", "label", f"-n={namespace}", "--overwrite", resource, f"{name}={value}"]
-        )
-
-
-def adopt(resource: str, release: Release) -> None:
-    annotate(resource, namespace=release.resource_namespace, annotations={
-        "meta.helm.sh/release-name": release.name,
-        "meta.helm.sh/release-namespace": release.release_namespace,
-    })
-    label(resource, namespace=release.resource_namespace, labels={"app.kubernetes.io/managed-by": "Helm"})
+def get_matches(release: Release) -> list[ObjectRef]:
+    return get_matching_objects(
+        resource_matches=release.resource_matches,
+        default_namespace=release.resource_namespace,
+        selector=release.selector,
+    )
 
 
-def get_kind(kind: str, namespace: str, selector: str) -> list[str]:
-    output = check_output([
-        "kubectl", "get", f"-n={namespace}", f"-l={selector}", f"{kind}", "-o=name"
-    ])
-    return output.decode("utf-8").splitlines()
-
-
-def get_matches(resource_match: ResourceMatch, release: Release) -> list[Resource]:
-    results = []
-
-    namespace = resource_match.namespace or release.resource_namespace
-    if not resource_match.name:
-        for match in get_kind(kind=resource_match.kind, namespace=namespace, selector=release.selector):
-            results.append(Resource.from_line(line=match, namespace=namespace, release=release.name))
-    else:
-        results.append(Resource(kind=resource_match.kind, name=resource_match.name, namespace=namespace, release=release.name))
-
-    return results
+def get_namespace_and_matches(release: Release) -> list[ObjectRef]:
+    namespace = get_named_objects(
+        kind_names=[f"namespace/{release.resource_namespace}"],
+        namespace=release.resource_namespace,
+    )
+    return namespace + get_matches(release=release)
 
 
 @click.command()
@@ -148,16 +117,62 @@ def get_matches(resource_match: ResourceMatch, release: Release) -> list[Resourc
     is_flag=True,
     default=False,
 )
-def main(with_persistent_volume: bool):
+@click.option("--dry-run", is_flag=True, default=False, help="Only show the resources that would be adopted.")
+@click.option("--concurrency", default=8, show_default=True, help="How many resources to patch in parallel.")
+@click.option("--max-rps", default=10.0, show_default=True, help="Maximum patch requests per second (0 for no limit).")
+@click.option(
+    "--snapshot",
+    "snapshot_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=f"Snapshot file of the resources to adopt (default: {SNAPSHOTS_DIR}/<cluster>/<script name>.json).",
+)
+@click.option("--refresh-snapshot", is_flag=True, default=False, help="Re-capture the snapshot even if there's one.")
+def main(
+    with_persistent_volume: bool,
+    dry_run: bool,
+    concurrency: int,
+    max_rps: float,
+    snapshot_path: pathlib.Path | None,
+    refresh_snapshot: bool,
+):
+    prefix = ""
+    if dry_run:
+        prefix = "DRY-RUN: "
+
+    snapshot_path = snapshot_path or Snapshot.default_path(__file__)
+    matches = load_or_capture_objects(
+        path=snapshot_path,
+        queries={
+            release.snapshot_key: functools.partial(get_namespace_and_matches, release=release) for release in TO_ADOPT
+        },
+        refresh=refresh_snapshot,
+    )
+    failed = False
     for release in TO_ADOPT:
         click.echo(f"## Adopting namespace {release.resource_namespace}")
-        adopt(f"namespace/{release.resource_namespace}", release=release)
-        for resource_match in release.resource_matches:
-            for resource in get_matches(resource_match=resource_match, release=release):
-                click.echo(click.style(f"## Adopting resource {resource}", fg="green"))
-                if resource.kind != "persistentvolume" or with_persistent_volume:
-                    release.adopt(resource=resource)
+        to_adopt = [
+            resource
+            for resource in matches[release.snapshot_key]
+            if resource.kind != "persistentvolume" or with_persistent_volume
+        ]
+        plan = plan_adoption(objects=to_adopt, release_name=release.name, release_namespace=release.release_namespace)
+        for step in plan.steps:
+            click.echo(click.style(f"{prefix}## Adopting resource {step}", fg="green"))
+
+        if not dry_run:
+            failures = plan.apply(concurrency=concurrency, max_rps=max_rps)
+            failed = failed or bool(failures)
+        else:
+            click.echo("   Not really, dry run")
+
+    if not dry_run:
+        Snapshot.discard(path=snapshot_path)
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    with tracing.script_span(__file__):
+        main()
@@ -1,28 +1,22 @@
 #!/usr/bin/env python3
 # We need to disown the crds as now they are installed separately in the crd step (helm hook) and not owned anymore,
 # so help would remove them if we don't disown them beforehand.
+#
+# The matching resources are captured once in a local snapshot (reused on the next runs, see --refresh-snapshot), so
+# repeated --dry-run calls don't hit the apiserver, and the patches fail instead of overwriting resources that changed
+# since the snapshot was taken.
 from __future__ import annotations
-import json
-from subprocess import check_call, check_output
+import functools
+import pathlib
+import sys
 import click
 from dataclasses import dataclass
 
-import yaml
-import gzip
-import base64
-
-
-@dataclass(frozen=True)
-class Resource:
-    kind: str
-    name: str
-    namespace: str
-    release: str
-
-    @classmethod
-    def from_line(cls, line: str, namespace: str, release: str) -> "Resource":
-        kind, name = line.split("/", 1)
-        return cls(kind=kind, name=name, namespace=namespace, release=release)
+BASEDIR = pathlib.Path(__file__).parent.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from cluster_snapshot import SNAPSHOTS_DIR, Snapshot  # noqa: E402
+from helm_ownership import ObjectRef, get_matching_objects, load_or_capture_objects, plan_disown  # noqa: E402
 
 
 @dataclass(frozen=True)
@@ -32,14 +26,6 @@ class ResourceMatch:
     namespace: str = ""
     release: str = ""
 
-    def matches(self, resource: Resource) -> bool:
-        return bool(
-            self.kind and self.kind == resource.kind
-            and self.name and self.name == resource.name
-            and self.namespace and self.namespace == resource.namespace
-            and self.release and self.release == resource.release
-        )
-
 
 @dataclass(frozen=True)
 class Release:
@@ -49,13 +35,6 @@ class Release:
     selector: str
     resource_matches: list[ResourceMatch]
 
-    def disown(self, resource: Resource) -> None:
-        resource_str = f"{resource.kind}/{resource.name}"
-        disown(
-            release=self,
-            resource=resource_str,
-        )
-
 
 SELECTOR = "app.kubernetes.io/part-of=toolforge-build-service"
 TO_DISOWN = [
@@ -71,46 +50,12 @@ TO_DISOWN = [
 ]
 
 
-def remove_annotations(resource: str, namespace: str, annotations: list[str]) -> None:
-    for annotation in annotations:
-        check_call(
-            ["kubectl", "annotate", f"-n={namespace}", "--overwrite", resource, f"{annotation}-"]
-        )
-
-
-def remove_label(resource: str, namespace: str, labels: list[str]) -> None:
-    for label in labels:
-        check_call(
-            ["kubectl", "label", f"-n={namespace}", "--overwrite", resource, f"{label}-"]
-        )
-
-
-def disown(resource: str, release: Release) -> None:
-    remove_annotations(resource, namespace=release.resource_namespace, annotations=[
-        "meta.helm.sh/release-name",
-        "meta.helm.sh/release-namespace",
-    ])
-    remove_label(resource, namespace=release.resource_namespace, labels=["app.kubernetes.io/managed-by"])
-
-
-def get_kind(kind: str, namespace: str, selector: str) -> list[str]:
-    output = check_output([
-        "kubectl", "get", f"-n={namespace}", f"-l={selector}", f"{kind}", "-o=name"
-    ])
-    return output.decode("utf-8").splitlines()
-
-
-def get_matches(resource_match: ResourceMatch, release: Release) -> list[Resource]:
-    results = []
-
-    namespace = resource_match.namespace or release.resource_namespace
-    if not resource_match.name:
-        for match in get_kind(kind=resource_match.kind, namespace=namespace, selector=release.selector):
-            results.append(Resource.from_line(line=match, namespace=namespace, release=release.name))
-    else:
-        results.append(Resource(kind=resource_match.kind, name=resource_match.name, namespace=namespace, release=release.name))
-
-    return results
+def get_matches(release: Release) -> list[ObjectRef]:
+    return get_matching_objects(
+        resource_matches=release.resource_matches,
+        default_namespace=release.resource_namespace,
+        selector=release.selector,
+    )
 
 
 @click.command()
@@ -119,23 +64,55 @@ def get_matches(resource_match: ResourceMatch, release: Release) -> list[Resourc
     is_flag=True,
     default=False,
 )
-def main(dry_run: bool):
+@click.option("--concurrency", default=8, show_default=True, help="How many resources to patch in parallel.")
+@click.option("--max-rps", default=10.0, show_default=True, help="Maximum patch requests per second (0 for no limit).")
+@click.option(
+    "--snapshot",
+    "snapshot_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=f"Snapshot file of the matching resources (default: {SNAPSHOTS_DIR}/<cluster>/<script name>.json).",
+)
+@click.option("--refresh-snapshot", is_flag=True, default=False, help="Re-capture the snapshot even if there's one.")
+def main(
+    dry_run: bool,
+    concurrency: int,
+    max_rps: float,
+    snapshot_path: pathlib.Path | None,
+    refresh_snapshot: bool,
+):
     prefix = ""
     if dry_run:
         prefix = "DRY-RUN: "
 
+    snapshot_path = snapshot_path or Snapshot.default_path(__file__)
+    matches = load_or_capture_objects(
+        path=snapshot_path,
+        queries={release.name: functools.partial(get_matches, release=release) for release in TO_DISOWN},
+        refresh=refresh_snapshot,
+    )
+    failed = False
     for release in TO_DISOWN:
-        for resource_match in release.resource_matches:
-            click.echo(f"checking {resource_match}")
-            for resource in get_matches(resource_match=resource_match, release=release):
-                click.echo(click.style(f"{prefix}## Adopting resource {resource}", fg="green"))
-                if not dry_run:
-                    release.disown(resource=resource)
-                else:
-                    click.echo("   Not really, dry run")
+        click.echo(f"checking {release.resource_matches}")
+        plan = plan_disown(objects=matches[release.name])
+        for step in plan.steps:
+            click.echo(click.style(f"{prefix}## Disowning resource {step}", fg="green"))
+
+        if not dry_run:
+            failures = plan.apply(concurrency=concurrency, max_rps=max_rps)
+            failed = failed or bool(failures)
+        else:
+            click.echo("   Not really, dry run")
 
         click.echo(f"Now remember to remove the release state: kubectl delete secrets -n={release.release_namespace}")
 
+    if not dry_run:
+        Snapshot.discard(path=snapshot_path)
+
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
-    main()
+    with tracing.script_span(__file__):
+        main()
@@ -9,19 +9,27 @@ Currently in tools this means ~800 conversion requests for any request to the bu
 
 
 This has to be run from a k8s control node, *instead* of running the toolforge.component.deploy cookbook.
+It talks directly to the apiserver with the credentials from your kubeconfig (see components/helpers/k8s_client.py).
 
 It will:
 * go over all the taskruns in the image-build namespace
 * download the v1 version (this needs a round to the conversion hook)
 * download the v1beta1 version and extract the taskruns (this is the currently stored version)
-* upload the v1 version (this effectively stores the v1 version as the main one)
+* upload the v1 version (this effectively stores the v1 version as the main one), with a forced server-side apply
+  (field manager toolforge-deploy)
+
+Every applied taskrun is recorded with its resourceVersion in a local journal (see --journal), so if the script is
+interrupted, the next run skips the already finished ones. Use --verify to re-check only the journaled taskruns that
+changed since they were recorded. The taskruns that changed between getting and applying them are got again and
+retried once, the ones still failing are listed at the end (re-run the script to retry them).
+
+With --bulk, instead of getting each taskrun twice, it will list all the taskruns once per version (paginated) and join
+them by name in memory, so the number of requests to get them depends on the number of pages and not on the number of
+taskruns.
 """
 import difflib
-import os
+from typing import Any, Iterable, Iterator, Literal
 import sys
-from typing import Any, Literal
-import subprocess
-import tempfile
 import pathlib
 import click
 import yaml
@@ -29,6 +37,13 @@ import yaml
 
 CURDIR = pathlib.Path(__file__).parent
 BASEDIR = CURDIR.parent.parent
+NAMESPACE = "image-build"
+# objects per page when listing in bulk mode, the pages are fetched using the `continue` token
+PAGE_SIZE = 500
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_client import K8sError, get_client, get_cluster_id, resource_path  # noqa: E402
+from migration_journal import JOURNALS_DIR, JournalError, MigrationJournal  # noqa: E402
 
 
 def get_taskrun_names() -> list[str]:
@@ -37,88 +52,157 @@ def get_taskrun_names() -> list[str]:
 
 def get_all_names(resource: str) -> list[str]:
     """This will be the only request that takes >10s."""
-    cmd: list[str] = [
-        "kubectl",
-        "get",
-        "-o",
-        "name",
-        "-n",
-        "image-build",
-        resource,
-    ]
-    try:
-        raw_list = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
+    return list(get_resource_versions(resource=resource).keys())
+
 
-    # they output the type prefixed, we only want the name
-    taskrun_names = [
-        name.rsplit("/", 1)[-1] for name in raw_list.decode("utf-8").split()
-    ]
-    return taskrun_names
+def get_resource_versions(resource: str) -> dict[str, str]:
+    """Returns the current resourceVersion for each object name, used to verify the journal."""
+    result = get_client().list(resource_path("tekton.dev/v1", resource, namespace=NAMESPACE), metadata_only=True)
+    return {item["metadata"]["name"]: item["metadata"]["resourceVersion"] for item in result.items}
 
 
 def get_taskrun(name: str, version: Literal["v1", "v1beta1"]) -> dict[str, Any]:
+    return get_client().get(resource_path(f"tekton.dev/{version}", "taskruns", namespace=NAMESPACE, name=name))
+
+
+def get_all_taskruns(version: Literal["v1", "v1beta1"]) -> dict[str, dict[str, Any]]:
+    """Single paginated list call, returns the taskruns indexed by name."""
+    result = get_client().list(
+        resource_path(f"tekton.dev/{version}", "taskruns", namespace=NAMESPACE), page_size=PAGE_SIZE
+    )
+    taskruns = {}
+    for item in result.items:
+        # list items might come without them, and we need them to apply the object later
+        item.setdefault("apiVersion", f"tekton.dev/{version}")
+        item.setdefault("kind", "TaskRun")
+        taskruns[item["metadata"]["name"]] = item
+    return taskruns
+
+
+def iter_taskruns(taskrun_names: list[str]) -> Iterator[tuple[str, dict[str, Any], dict[str, Any]]]:
+    """Yields (name, v1 version, v1beta1 version) getting each taskrun version one by one."""
+    for taskrun_name in taskrun_names:
+        yield (
+            taskrun_name,
+            get_taskrun(name=taskrun_name, version="v1"),
+            get_taskrun(name=taskrun_name, version="v1beta1"),
+        )
+
+
+def iter_taskruns_bulk(taskrun_names: list[str]) -> Iterator[tuple[str, dict[str, Any], dict[str, Any]]]:
+    """Yields (name, v1 version, v1beta1 version) from one list per version joined by name."""
+    if not taskrun_names:
+        return
+
+    v1_taskruns = get_all_taskruns(version="v1")
+    v1beta1_taskruns = get_all_taskruns(version="v1beta1")
+    for taskrun_name in taskrun_names:
+        v1_version = v1_taskruns.get(taskrun_name)
+        if v1_version is None:
+            click.echo(f"    Skipping taskrun {taskrun_name}, not found in the v1 list")
+            continue
+
+        v1beta1_version = v1beta1_taskruns.get(taskrun_name)
+        if v1beta1_version is None:
+            # it got created/deleted between both lists, it will be stored already as v1 if new
+            click.echo(f"    Skipping taskrun {taskrun_name}, not found in the v1beta1 list")
+            continue
+
+        yield taskrun_name, v1_version, v1beta1_version
+
+
+def k8s_apply(new_value: dict[str, Any]) -> str:
     """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
-    """
-    cmd: list[str] = [
-        "kubectl",
-        "get",
-        "-n",
-        "image-build",
-        "-o",
-        "yaml",
-        f"taskruns.{version}.tekton.dev",
-        name,
-    ]
-    try:
-        output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
+    Server-side applies the given taskrun, returns the resourceVersion of the applied object.
 
-    return yaml.safe_load(output)
+    As the resourceVersion is passed along, it will fail if the taskrun changed since we got it.
+    """
+    return get_client().apply(k8s_object=new_value, plural="taskruns")["metadata"]["resourceVersion"]
 
 
-def k8s_apply(new_value: dict[str, Any]):
+def migrate_taskrun(taskrun_name: str, v1_version: dict[str, Any]) -> str | None:
     """
-    We don't have kubernetes python libs in the bastion/control nodes, so defaulting to cli.
+    Applies the v1 version, returns its new resourceVersion, or None if the taskrun is gone.
+
+    If the taskrun changed since we got it (409 Conflict), it's got again and applied once more.
     """
-    tmp_file_fd, tmp_file_name = tempfile.mkstemp()
-    # otherwise we leak open files
-    tmp_file = pathlib.Path(tmp_file_name)
-    with tmp_file.open("w") as tmp_file_df:
-        yaml.safe_dump(new_value, tmp_file_df)
-    os.close(fd=tmp_file_fd)
-
-    cmd: list[str] = [
-        "kubectl",
-        "apply",
-        "--namespace=image-build",
-        "-f",
-        f"{tmp_file}",
-    ]
     try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError as error:
-        raise Exception(f"Error running {cmd}") from error
-
-    tmp_file.unlink()
+        return k8s_apply(new_value=v1_version)
+    except K8sError as error:
+        if error.status_code == 404:
+            return None
+        if error.status_code != 409:
+            raise
+
+    click.echo(f"    Taskrun {taskrun_name} changed since we got it, retrying with the current version")
+    try:
+        return k8s_apply(new_value=get_taskrun(name=taskrun_name, version="v1"))
+    except K8sError as error:
+        if error.status_code == 404:
+            return None
+        raise
 
 
 @click.command(help=__doc__)
-def main() -> None:
+@click.option(
+    "--bulk",
+    is_flag=True,
+    default=False,
+    help="List all the taskruns once per version instead of getting them one by one.",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=f"Journal file to record the finished taskruns in (default: {JOURNALS_DIR}/<cluster>/<script name>.jsonl).",
+)
+@click.option(
+    "--verify",
+    is_flag=True,
+    default=False,
+    help="Only re-check the journaled taskruns that changed (different resourceVersion) since they were migrated.",
+)
+def main(bulk: bool, journal_path: pathlib.Path | None, verify: bool) -> None:
     yes_all = False
+    cluster_id = get_cluster_id()
+    try:
+        if journal_path:
+            journal = MigrationJournal(path=journal_path, cluster_id=cluster_id)
+        else:
+            journal = MigrationJournal.for_script(__file__, cluster_id=cluster_id)
+    except JournalError as error:
+        raise click.ClickException(str(error)) from error
     click.echo(
         "Running the taskrun upgrade script (only do so after upgrade!) for builds-builder to 0.121.0 "
         "(when we did the tekton migration)"
     )
-    taskrun_names = get_all_names(resource="taskruns")
-    click.echo(f"I'm going to migrate {len(taskrun_names)} taskruns")
-    for taskrun_name in taskrun_names:
+    click.echo(f"Using journal {journal.path} ({len(journal.done)} taskruns already done)")
+    if verify:
+        resource_versions = get_resource_versions(resource="taskruns")
+        changed_names = journal.changed(resource_versions=resource_versions)
+        taskrun_names = [name for name in changed_names if name in resource_versions]
+        click.echo(
+            f"I'm going to re-check {len(taskrun_names)} taskruns that changed since migrated "
+            f"({len(changed_names) - len(taskrun_names)} journaled ones are gone)"
+        )
+    else:
+        taskrun_names = [
+            taskrun_name
+            for taskrun_name in get_all_names(resource="taskruns")
+            if not journal.is_done(taskrun_name)
+        ]
+        click.echo(f"I'm going to migrate {len(taskrun_names)} taskruns")
+
+    taskruns: Iterable[tuple[str, dict[str, Any], dict[str, Any]]]
+    if bulk:
+        taskruns = iter_taskruns_bulk(taskrun_names=taskrun_names)
+    else:
+        taskruns = iter_taskruns(taskrun_names=taskrun_names)
+
+    failures: dict[str, str] = {}
+    for taskrun_name, v1_version, v1beta1_version in taskruns:
         click.echo(f"    Taskrun {taskrun_name}")
-        v1_version = get_taskrun(name=taskrun_name, version="v1")
-        v1beta1_version = get_taskrun(name=taskrun_name, version="v1beta1")
         click.echo("    Uploading v1 taskrun...")
         if not yes_all:
             click.echo(f"-- {taskrun_name} Diff ------------------------")
@@ -142,7 +226,24 @@ def main() -> None:
             if answer == "all":
                 yes_all = True
 
-        k8s_apply(new_value=v1_version)
+        try:
+            resource_version = migrate_taskrun(taskrun_name=taskrun_name, v1_version=v1_version)
+        except K8sError as error:
+            if error.status_code != 409:
+                raise
+            click.echo(f"    Failed to apply taskrun {taskrun_name}: {error}")
+            failures[taskrun_name] = str(error)
+            continue
+        if resource_version is None:
+            click.echo(f"    Skipping taskrun {taskrun_name}, it's gone")
+            continue
+        journal.record(name=taskrun_name, resource_version=resource_version)
+
+    if failures:
+        click.echo(f"{len(failures)} taskruns kept changing while applying them, re-run the script to retry them:")
+        for taskrun_name, error in failures.items():
+            click.echo(f"    {taskrun_name}: {error}")
+        sys.exit(1)
 
     click.echo(
         r"Done \o/, please run the functional tests from the bastion to make sure everything works as expected."
@@ -150,4 +251,5 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    with tracing.script_span(__file__):
+        main()
@@ -0,0 +1,213 @@
+"""
+Snapshot-and-plan helpers for the maintenance scripts.
+
+Instead of querying the cluster object by object while deciding what to do (and doing it), a script can:
+* capture a local snapshot of all the objects it cares about, with a few bulk list calls (reused on the next runs
+  against the same cluster until it's applied or SNAPSHOT_MAX_AGE_SECONDS old)
+* compute the full plan of changes offline against that snapshot (so --dry-run is instant and repeatable)
+* apply the plan, with every patch checking that the object did not change since the snapshot (resourceVersion)
+
+Usage:
+    snapshot = Snapshot.load_or_capture(path=..., queries={"pipelineruns": lambda: client.list(...).items})
+    plan = Plan()
+    for pipelinerun in snapshot["pipelineruns"]:
+        plan.add(PlanStep.for_object(k8s_object=pipelinerun, patches=[PlannedPatch(body={...})]))
+    plan.show()
+    failures = plan.apply(concurrency=8, max_rps=10)
+    Snapshot.discard(path=...)
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable
+
+import click
+import yaml
+
+from k8s_client import get_client, get_cluster_id
+from k8s_executor import Failure, RateLimitedExecutor
+
+
+SNAPSHOTS_DIR = pathlib.Path.home() / ".cache" / "toolforge-deploy" / "snapshots"
+# older snapshots are captured again, the objects have most likely changed since
+SNAPSHOT_MAX_AGE_SECONDS = 60 * 60
+
+
+@dataclass
+class Snapshot:
+    # name of the query -> objects returned
+    collections: dict[str, list[dict[str, Any]]]
+    captured_at: float
+    # see k8s_client.get_cluster_id, a snapshot is only reused for the same cluster
+    cluster_id: str = ""
+
+    def __getitem__(self, name: str) -> list[dict[str, Any]]:
+        return self.collections[name]
+
+    @classmethod
+    def default_path(cls, script: str) -> pathlib.Path:
+        """Default snapshot file for the given script path and the current cluster, ex. default_path(__file__)."""
+        return SNAPSHOTS_DIR / get_cluster_id() / f"{pathlib.Path(script).stem}.json"
+
+    @classmethod
+    def capture(cls, queries: dict[str, Callable[[], list[dict[str, Any]]]]) -> "Snapshot":
+        collections = {}
+        for name, query in queries.items():
+            click.echo(f"Capturing {name}...")
+            collections[name] = query()
+        return cls(collections=collections, captured_at=time.time(), cluster_id=get_cluster_id())
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Snapshot":
+        data = json.loads(path.read_text())
+        return cls(
+            collections=data["collections"], captured_at=data["captured_at"], cluster_id=data.get("cluster_id", "")
+        )
+
+    def save(self, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {"collections": self.collections, "captured_at": self.captured_at, "cluster_id": self.cluster_id}
+        path.write_text(json.dumps(data))
+
+    @classmethod
+    def load_or_capture(
+        cls,
+        path: pathlib.Path,
+        queries: dict[str, Callable[[], list[dict[str, Any]]]],
+        refresh: bool = False,
+        max_age: float = SNAPSHOT_MAX_AGE_SECONDS,
+    ) -> "Snapshot":
+        if path.exists() and not refresh:
+            snapshot = cls.load(path)
+            age = time.time() - snapshot.captured_at
+            if snapshot.cluster_id != get_cluster_id():
+                click.echo(f"The snapshot {path} is from another cluster ({snapshot.cluster_id}), re-capturing it")
+            elif age > max_age:
+                click.echo(f"The snapshot {path} is too old ({age:.0f}s), re-capturing it")
+            elif set(snapshot.collections) == set(queries):
+                click.echo(f"Using snapshot {path} (captured {age:.0f}s ago, pass --refresh-snapshot to re-capture)")
+                return snapshot
+
+        snapshot = cls.capture(queries=queries)
+        snapshot.save(path)
+        click.echo(f"Saved snapshot to {path}")
+        return snapshot
+
+    @staticmethod
+    def discard(path: pathlib.Path) -> None:
+        """To call once the plan is applied, the snapshot no longer matches the objects (their resourceVersion)."""
+        path.unlink(missing_ok=True)
+        click.echo(f"Removed the snapshot {path}, the next run will capture a new one")
+
+
+@dataclass(frozen=True)
+class PlannedPatch:
+    body: dict[str, Any]
+    # ex. status, None for the main object
+    subresource: str | None = None
+
+
+@dataclass(frozen=True)
+class PlanStep:
+    """All the patches to send to one object, in order."""
+
+    api_version: str
+    kind: str
+    name: str
+    namespace: str | None
+    # the one in the snapshot, the first patch fails if the object changed since (empty to skip the check)
+    resource_version: str
+    patches: list[PlannedPatch] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        namespace = f" (ns:{self.namespace})" if self.namespace else ""
+        return f"{self.kind}/{self.name}{namespace}"
+
+    @classmethod
+    def for_object(cls, k8s_object: dict[str, Any], patches: list[PlannedPatch]) -> "PlanStep":
+        return cls(
+            api_version=k8s_object["apiVersion"],
+            kind=k8s_object["kind"],
+            name=k8s_object["metadata"]["name"],
+            namespace=k8s_object["metadata"].get("namespace"),
+            resource_version=k8s_object["metadata"]["resourceVersion"],
+            patches=patches,
+        )
+
+    def apply(self) -> str:
+        """
+        Sends the merge patches in order, returns the final resourceVersion.
+
+        Adding the resourceVersion to a merge patch makes the apiserver reject it with a conflict if the object changed,
+        each patch uses the resourceVersion returned by the previous one.
+        """
+        client = get_client()
+        resource_version = self.resource_version
+        for patch in self.patches:
+            path = client.object_path(
+                api_version=self.api_version,
+                kind=self.kind,
+                name=self.name,
+                namespace=self.namespace,
+                subresource=patch.subresource,
+            )
+            body = patch.body
+            if resource_version:
+                body = {**body, "metadata": {**body.get("metadata", {}), "resourceVersion": resource_version}}
+            response = client.patch(path=path, body=body, patch_type="merge")
+            resource_version = response["metadata"]["resourceVersion"]
+
+        return resource_version
+
+
+@dataclass
+class Plan:
+    steps: list[PlanStep] = field(default_factory=list)
+
+    def add(self, step: PlanStep) -> None:
+        self.steps.append(step)
+
+    def show(self) -> None:
+        for step in self.steps:
+            click.echo(f"-- {step} (resourceVersion {step.resource_version}) ------------------------")
+            for patch in step.patches:
+                click.echo(f"{step.kind}{'.' + patch.subresource if patch.subresource else ''}:")
+                click.echo(yaml.safe_dump(patch.body))
+        click.echo(f"The plan has {len(self.steps)} objects to patch.")
+
+    def save(self, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps([asdict(step) for step in self.steps], indent=2))
+
+    def apply(
+        self,
+        concurrency: int,
+        max_rps: float,
+        on_applied: Callable[[PlanStep, str], None] | None = None,
+    ) -> list[Failure]:
+        """
+        Applies all the steps in parallel, returns the failed ones.
+
+        on_applied gets called with the step and the new resourceVersion of the object after each successful step.
+        """
+
+        def _apply_step(step: PlanStep) -> None:
+            resource_version = step.apply()
+            if on_applied:
+                on_applied(step, resource_version)
+
+        executor = RateLimitedExecutor(concurrency=concurrency, max_rps=max_rps, label="objects")
+        for step in self.steps:
+            executor.submit(str(step), _apply_step, step)
+
+        failures = executor.wait()
+        conflicts = [failure for failure in failures if getattr(failure.error, "status_code", None) == 409]
+        if conflicts:
+            click.echo(
+                f"{len(conflicts)} objects changed since the snapshot was taken, re-run to retry them with a new "
+                "snapshot."
+            )
+        return failures
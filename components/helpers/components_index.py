@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Index of the components of this repo, to answer the usual questions without going through the tree every time.
+
+It walks the components/*/helmfile.yaml, values/* and tests.txt files once and stores, for each component:
+* whether it's deployable, its helmfile and override-deploy.sh script
+* its releases (namespace, chart name, chart repo), and which one is the main one
+* for each environment: the values file deploy.sh uses, the chart repository and the (resolved) chart versions
+* the chartVersion of each of its values files
+* its test tags (tests.txt) and, for the clis, the name of their package
+
+The index is stored as json in ~/.cache/toolforge-deploy/components-index/ (one per checkout), along with the mtime,
+size and hash of every file it was built from. It's only rebuilt when one of them changed (or was added/removed), a file
+that only got its mtime changed (ex. git checkout) just gets its new mtime recorded.
+
+Print it (rebuilding it if needed) to query it with jq:
+    components_index.py | jq -r '.components["jobs-api"].environments.tools.chart_version'
+
+or use --path to get the path of the up to date index file.
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import re
+from typing import Any
+
+import yaml
+
+
+BASEDIR = pathlib.Path(__file__).resolve().parent.parent.parent
+INDEX_DIR = pathlib.Path.home() / ".cache" / "toolforge-deploy" / "components-index"
+# bump when the format of the index changes
+INDEX_VERSION = 1
+NOT_COMPONENTS = ("helpers", "common")
+SOURCE_PATTERNS = (
+    "components/*/helmfile.yaml",
+    "components/*/override-deploy.sh",
+    "components/*/tests.txt",
+    "components/*/values/**/*",
+)
+# the charts that only wrap some raw manifests, not the main release of a component
+RAW_CHARTS = ("wmf-stable/raw",)
+# clis with a package not named toolforge-<component>
+APT_PACKAGE_NAMES = {
+    "toolforge-cli": "toolforge-cli",
+    "webservice-cli": "toolforge-webservice",
+    "toolforge-weld": "python3-toolforge-weld",
+}
+TEMPLATE_LINE_RE = re.compile(r"^\s*{{.*}}\s*$")
+TEMPLATE_RE = re.compile(r"{{.*?}}")
+VALUES_REF_RE = re.compile(r"{{\s*\.Values\.([\w.]+)\s*}}")
+CHART_VERSION_RE = re.compile(r"^chartVersion:\s*(\S+)", flags=re.MULTILINE)
+
+
+def get_index_path(base_dir: pathlib.Path) -> pathlib.Path:
+    checkout_id = hashlib.sha256(str(base_dir.resolve()).encode()).hexdigest()[:16]
+    return INDEX_DIR / f"{checkout_id}.json"
+
+
+def get_sources(base_dir: pathlib.Path) -> list[str]:
+    sources = set()
+    for pattern in SOURCE_PATTERNS:
+        for path in glob.glob(pattern, root_dir=base_dir, recursive=True):
+            if (base_dir / path).is_file():
+                sources.add(path)
+    return sorted(sources)
+
+
+def get_stat(path: pathlib.Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def get_hash(path: pathlib.Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def load_yaml(path: pathlib.Path) -> dict[str, Any]:
+    """Loads a (maybe helmfile templated) yaml file, ignoring the templates."""
+    content = path.read_text()
+    if "{{" in content:
+        content = "\n".join(
+            TEMPLATE_RE.sub('""', line) for line in content.splitlines() if not TEMPLATE_LINE_RE.match(line)
+        )
+    try:
+        documents = [document for document in yaml.safe_load_all(content) if isinstance(document, dict)]
+    except yaml.YAMLError:
+        match = CHART_VERSION_RE.search(content)
+        return {"chartVersion": match.group(1)} if match else {}
+
+    merged: dict[str, Any] = {}
+    for document in documents:
+        merged.update(document)
+    return merged
+
+
+def merge(base: dict[str, Any], override: dict[str, Any]) -> dict[str, Any]:
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def render(value: Any, values: dict[str, Any]) -> str | None:
+    """Resolves the {{ .Values.x.y }} references in the string, None if any is missing."""
+    if value is None:
+        return None
+
+    def get_value(match: re.Match) -> str:
+        current: Any = values
+        for key in match.group(1).split("."):
+            if not isinstance(current, dict) or key not in current:
+                raise KeyError(match.group(1))
+            current = current[key]
+        return str(current)
+
+    try:
+        return VALUES_REF_RE.sub(get_value, str(value))
+    except KeyError:
+        return None
+
+
+def get_environment_values(
+    component_dir: pathlib.Path, environment: str, environment_config: dict[str, Any] | None
+) -> dict[str, Any]:
+    patterns = (environment_config or {}).get("values") or ["values/{{ .Environment.Name }}.yaml*"]
+    values: dict[str, Any] = {}
+    for pattern in patterns:
+        if not isinstance(pattern, str):
+            continue
+        pattern = re.sub(r"{{\s*\.Environment\.Name\s*}}", environment, pattern)
+        for path in sorted(glob.glob(pattern, root_dir=component_dir)):
+            values = merge(values, load_yaml(component_dir / path))
+    return values
+
+
+def get_deploy_values_file(component_dir: pathlib.Path, environment: str) -> str | None:
+    """Same logic as deploy.sh."""
+    for name in (f"values/{environment}.yaml", f"values/{environment}.yaml.gotmpl"):
+        if (component_dir / name).exists():
+            return name
+    return None
+
+
+def get_component(base_dir: pathlib.Path, name: str) -> dict[str, Any]:
+    component_dir = base_dir / "components" / name
+    relative_dir = f"components/{name}"
+    helmfile_path = component_dir / "helmfile.yaml"
+    override_path = component_dir / "override-deploy.sh"
+    tests_path = component_dir / "tests.txt"
+    component: dict[str, Any] = {
+        "deployable": helmfile_path.exists() or override_path.exists(),
+        "helmfile": f"{relative_dir}/helmfile.yaml" if helmfile_path.exists() else None,
+        "override_script": f"{relative_dir}/override-deploy.sh" if override_path.exists() else None,
+        "test_tags": [],
+        "apt_package": None,
+        "main_release": None,
+        "releases": {},
+        "environments": {},
+        "values_files": {},
+    }
+    if tests_path.exists():
+        component["test_tags"] = [
+            line.strip() for line in tests_path.read_text().splitlines() if line.strip() and not line.startswith("#")
+        ]
+    if not component["deployable"]:
+        component["apt_package"] = APT_PACKAGE_NAMES.get(name, f"toolforge-{name}")
+
+    for path in sorted(component_dir.glob("values/*.yaml*")):
+        match = CHART_VERSION_RE.search(path.read_text())
+        component["values_files"][f"{relative_dir}/values/{path.name}"] = match.group(1) if match else None
+
+    if not helmfile_path.exists():
+        return component
+
+    releases: list[dict[str, Any]] = []
+    environments: dict[str, Any] = {}
+    for document in yaml.safe_load_all(helmfile_path.read_text()):
+        if not isinstance(document, dict):
+            continue
+        releases.extend(document.get("releases") or [])
+        for environment, environment_config in (document.get("environments") or {}).items():
+            environments.setdefault(environment, environment_config)
+
+    for release in releases:
+        chart_repo, _, chart = str(release["chart"]).rpartition("/")
+        component["releases"][release["name"]] = {
+            "namespace": release.get("namespace"),
+            "chart": chart,
+            "chart_repo": chart_repo,
+            "version": release.get("version"),
+        }
+    release_names = list(component["releases"])
+    not_raw = [release["name"] for release in releases if release["chart"] not in RAW_CHARTS]
+    if name in release_names:
+        component["main_release"] = name
+    elif not_raw or release_names:
+        component["main_release"] = (not_raw or release_names)[0]
+
+    for environment, environment_config in environments.items():
+        values = get_environment_values(
+            component_dir=component_dir, environment=environment, environment_config=environment_config
+        )
+        environment_releases = {
+            release_name: {
+                "chart_repo": render(release["chart_repo"], values),
+                "chart_version": render(release["version"], values),
+            }
+            for release_name, release in component["releases"].items()
+        }
+        values_file = get_deploy_values_file(component_dir=component_dir, environment=environment)
+        component["environments"][environment] = {
+            "values_file": f"{relative_dir}/{values_file}" if values_file else None,
+            "chart_repository": values.get("chartRepository"),
+            "chart_version": (
+                environment_releases[component["main_release"]]["chart_version"]
+                if component["main_release"]
+                else None
+            ),
+            "releases": environment_releases,
+        }
+
+    return component
+
+
+def build_index(base_dir: pathlib.Path, sources: list[str]) -> dict[str, Any]:
+    names = sorted(
+        path.name
+        for path in (base_dir / "components").iterdir()
+        if path.is_dir() and path.name not in NOT_COMPONENTS and not path.name.startswith((".", "__"))
+    )
+    return {
+        "version": INDEX_VERSION,
+        "sources": {
+            source: {"stat": get_stat(base_dir / source), "sha256": get_hash(base_dir / source)} for source in sources
+        },
+        "components": {name: get_component(base_dir=base_dir, name=name) for name in names},
+    }
+
+
+def is_up_to_date(base_dir: pathlib.Path, index: dict[str, Any], sources: list[str]) -> bool:
+    """Checks the sources of the index, updating the stats of the ones that only changed mtime."""
+    if index.get("version") != INDEX_VERSION or sorted(index["sources"]) != sources:
+        return False
+
+    for source in sources:
+        recorded = index["sources"][source]
+        stat = get_stat(base_dir / source)
+        if stat == recorded["stat"]:
+            continue
+        if get_hash(base_dir / source) != recorded["sha256"]:
+            return False
+        recorded["stat"] = stat
+
+    return True
+
+
+def save_index(index_path: pathlib.Path, index: dict[str, Any]) -> None:
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    # write and move, so concurrent runs never read a half written file
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}")
+    tmp_path.write_text(json.dumps(index, indent=1, sort_keys=True))
+    tmp_path.replace(index_path)
+
+
+def load_index(base_dir: pathlib.Path = BASEDIR, rebuild: bool = False) -> tuple[dict[str, Any], pathlib.Path]:
+    """Returns the up to date index and the path to it, rebuilding it if any of its sources changed."""
+    index_path = get_index_path(base_dir)
+    sources = get_sources(base_dir)
+    if index_path.exists() and not rebuild:
+        try:
+            index = json.loads(index_path.read_text())
+        except json.JSONDecodeError:
+            index = {}
+        old_stats = json.dumps(index.get("sources"), sort_keys=True)
+        if index and is_up_to_date(base_dir=base_dir, index=index, sources=sources):
+            if json.dumps(index["sources"], sort_keys=True) != old_stats:
+                save_index(index_path=index_path, index=index)
+            return index, index_path
+
+    index = build_index(base_dir=base_dir, sources=sources)
+    save_index(index_path=index_path, index=index)
+    return index, index_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--base-dir",
+        type=pathlib.Path,
+        default=BASEDIR,
+        help="The toolforge-deploy checkout to index (default: the one this script is in).",
+    )
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index even if nothing changed.")
+    parser.add_argument("--path", action="store_true", help="Print the path to the index file instead of the index.")
+    args = parser.parse_args()
+
+    index, index_path = load_index(base_dir=args.base_dir, rebuild=args.rebuild)
+    if args.path:
+        print(index_path)
+    else:
+        print(json.dumps({"components": index["components"]}, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
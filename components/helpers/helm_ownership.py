@@ -0,0 +1,206 @@
+"""
+Helpers to adopt existing resources into a helm release (or to disown them from it).
+
+Helm only takes over resources that have the release annotations and the managed-by label, instead of running kubectl
+annotate/label once per key and resource, this:
+* finds all the resources of all the given kinds in a namespace with a single `kubectl get kind1,kind2,...` call
+* plans one merge patch per resource with both the annotations and the label, skipping the ones that are already
+  owned (or disowned), and applies them in parallel (see cluster_snapshot and k8s_executor)
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import subprocess
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Iterable, Protocol
+
+import tracing
+from cluster_snapshot import Plan, PlannedPatch, PlanStep, Snapshot
+
+
+RELEASE_NAME_ANNOTATION = "meta.helm.sh/release-name"
+RELEASE_NAMESPACE_ANNOTATION = "meta.helm.sh/release-namespace"
+MANAGED_BY_LABEL = "app.kubernetes.io/managed-by"
+
+
+@dataclass(frozen=True)
+class ObjectRef:
+    api_version: str
+    # lowercase, as used in the kubectl command line (ex. rolebinding)
+    kind: str
+    name: str
+    namespace: str
+    # to detect changes between the snapshot and the patch, empty to skip the check
+    resource_version: str = ""
+    # the helm release currently owning the object, if any, helm needs all three to adopt it
+    release_name: str = ""
+    release_namespace: str = ""
+    managed_by: str = ""
+
+    def __str__(self) -> str:
+        return f"{self.kind}/{self.name} (ns:{self.namespace})"
+
+    @classmethod
+    def from_object(cls, k8s_object: dict[str, Any], namespace: str) -> "ObjectRef":
+        annotations = k8s_object["metadata"].get("annotations") or {}
+        return cls(
+            api_version=k8s_object["apiVersion"],
+            kind=k8s_object["kind"].lower(),
+            name=k8s_object["metadata"]["name"],
+            namespace=k8s_object["metadata"].get("namespace", namespace),
+            resource_version=k8s_object["metadata"].get("resourceVersion", ""),
+            release_name=annotations.get(RELEASE_NAME_ANNOTATION, ""),
+            release_namespace=annotations.get(RELEASE_NAMESPACE_ANNOTATION, ""),
+            managed_by=(k8s_object["metadata"].get("labels") or {}).get(MANAGED_BY_LABEL, ""),
+        )
+
+    def is_owned_by(self, release_name: str, release_namespace: str) -> bool:
+        # a previous run might have been interrupted between the annotations and the label
+        return (
+            self.release_name == release_name
+            and self.release_namespace == release_namespace
+            and self.managed_by == "Helm"
+        )
+
+    def is_owned(self) -> bool:
+        return bool(self.release_name or self.release_namespace or self.managed_by)
+
+    def to_plan_step(self, patch: dict[str, Any]) -> PlanStep:
+        return PlanStep(
+            api_version=self.api_version,
+            kind=self.kind,
+            name=self.name,
+            namespace=self.namespace,
+            resource_version=self.resource_version,
+            patches=[PlannedPatch(body=patch)],
+        )
+
+
+def _kubectl_get(args: list[str], namespace: str) -> list[dict[str, Any]]:
+    cmd = ["kubectl", "get", f"--namespace={namespace}", "--output=json", *args]
+    try:
+        output = tracing.run(cmd, check=True, capture_output=True).stdout
+    except subprocess.CalledProcessError as error:
+        raise Exception(f"Error running {cmd}") from error
+
+    if not output.strip():
+        # --ignore-not-found prints nothing when none of the named objects exist
+        return []
+    result = json.loads(output)
+    # a single kind/name gets the bare object instead of a list
+    return result["items"] if result.get("kind") == "List" else [result]
+
+
+def get_objects(kinds: Iterable[str], namespace: str, selector: str) -> list[ObjectRef]:
+    """All the objects of all the given kinds matching the selector, with a single kubectl call."""
+    kinds = sorted(set(kinds))
+    if not kinds:
+        return []
+
+    items = _kubectl_get(args=[f"--selector={selector}", ",".join(kinds)], namespace=namespace)
+    return [ObjectRef.from_object(k8s_object=item, namespace=namespace) for item in items]
+
+
+def get_named_objects(kind_names: Iterable[str], namespace: str) -> list[ObjectRef]:
+    """Objects given as kind/name, with a single kubectl call, missing ones are skipped."""
+    kind_names = sorted(set(kind_names))
+    if not kind_names:
+        return []
+
+    items = _kubectl_get(args=["--ignore-not-found", *kind_names], namespace=namespace)
+    return [ObjectRef.from_object(k8s_object=item, namespace=namespace) for item in items]
+
+
+class ResourceMatch(Protocol):
+    kind: str
+    name: str
+    namespace: str
+
+
+def get_matching_objects(
+    resource_matches: Iterable[ResourceMatch], default_namespace: str, selector: str
+) -> list[ObjectRef]:
+    """
+    Gets all the objects for the given matches with one call per namespace (and one more for the ones matched by name).
+
+    Matches without name get all the objects of that kind with the selector, matches without namespace use the
+    default one.
+    """
+    kinds_per_namespace: dict[str, list[str]] = defaultdict(list)
+    names_per_namespace: dict[str, list[str]] = defaultdict(list)
+    for resource_match in resource_matches:
+        namespace = resource_match.namespace or default_namespace
+        if resource_match.name:
+            names_per_namespace[namespace].append(f"{resource_match.kind}/{resource_match.name}")
+        else:
+            kinds_per_namespace[namespace].append(resource_match.kind)
+
+    results = []
+    for namespace, kinds in kinds_per_namespace.items():
+        results.extend(get_objects(kinds=kinds, namespace=namespace, selector=selector))
+    for namespace, kind_names in names_per_namespace.items():
+        results.extend(get_named_objects(kind_names=kind_names, namespace=namespace))
+
+    return results
+
+
+def load_or_capture_objects(
+    path: pathlib.Path,
+    queries: dict[str, Callable[[], list[ObjectRef]]],
+    refresh: bool = False,
+) -> dict[str, list[ObjectRef]]:
+    """Same as Snapshot.load_or_capture, for queries returning object references (ex. get_matching_objects)."""
+    snapshot = Snapshot.load_or_capture(
+        path=path,
+        queries={
+            name: (lambda query=query: [asdict(k8s_object) for k8s_object in query()])
+            for name, query in queries.items()
+        },
+        refresh=refresh,
+    )
+    return {name: [ObjectRef(**k8s_object) for k8s_object in snapshot[name]] for name in queries}
+
+
+def adopt_patch(release_name: str, release_namespace: str) -> dict[str, Any]:
+    return {
+        "metadata": {
+            "annotations": {
+                RELEASE_NAME_ANNOTATION: release_name,
+                RELEASE_NAMESPACE_ANNOTATION: release_namespace,
+            },
+            "labels": {MANAGED_BY_LABEL: "Helm"},
+        }
+    }
+
+
+def disown_patch() -> dict[str, Any]:
+    # null removes the key on merge patches
+    return {
+        "metadata": {
+            "annotations": {
+                RELEASE_NAME_ANNOTATION: None,
+                RELEASE_NAMESPACE_ANNOTATION: None,
+            },
+            "labels": {MANAGED_BY_LABEL: None},
+        }
+    }
+
+
+def plan_adoption(objects: Iterable[ObjectRef], release_name: str, release_namespace: str) -> Plan:
+    """Plan to adopt the objects that are not already fully owned by the release."""
+    patch = adopt_patch(release_name=release_name, release_namespace=release_namespace)
+    return Plan(
+        steps=[
+            k8s_object.to_plan_step(patch=patch)
+            for k8s_object in objects
+            if not k8s_object.is_owned_by(release_name=release_name, release_namespace=release_namespace)
+        ]
+    )
+
+
+def plan_disown(objects: Iterable[ObjectRef]) -> Plan:
+    """Plan to disown the objects that still have any of the release annotations or the managed-by label."""
+    patch = disown_patch()
+    return Plan(steps=[k8s_object.to_plan_step(patch=patch) for k8s_object in objects if k8s_object.is_owned()])
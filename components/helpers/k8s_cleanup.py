@@ -0,0 +1,97 @@
+"""
+Declarative bulk cleanup of leftover objects, for the scripts that clean up after a refactor.
+
+Each rule is a kind, optional field/label selectors and a predicate on the object metadata, ex. the old resourcequotas
+named differently than their namespace:
+    CleanupRule(
+        description="old resourcequotas",
+        api_version="v1",
+        plural="resourcequotas",
+        predicate=lambda metadata: metadata["name"] != metadata["namespace"],
+    )
+
+All the rules are evaluated against a single (cluster wide, metadata only) list per kind and selectors, and the matching
+objects are deleted in parallel (see k8s_executor), without waiting for each deletion to finish.
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import click
+
+from k8s_client import K8sClient, resource_path
+from k8s_executor import RateLimitedExecutor
+
+
+@dataclass(frozen=True)
+class CleanupRule:
+    description: str
+    api_version: str
+    plural: str
+    field_selector: str | None = None
+    label_selector: str | None = None
+    # gets the object metadata, returns True if it has to be deleted
+    predicate: Callable[[dict[str, Any]], bool] = lambda metadata: True
+
+
+def get_matches(client: K8sClient, rules: list[CleanupRule]) -> list[tuple[CleanupRule, dict[str, Any]]]:
+    """
+    Returns the (rule, metadata) of the objects to delete, listing each kind + selectors only once.
+
+    Objects matched by more than one rule are returned only for the first one.
+    """
+    lists: dict[tuple[str, str, str | None, str | None], list[dict[str, Any]]] = {}
+    seen: set[tuple[str, str, str | None, str]] = set()
+    matches = []
+    for rule in rules:
+        list_key = (rule.api_version, rule.plural, rule.field_selector, rule.label_selector)
+        if list_key not in lists:
+            lists[list_key] = client.list(
+                resource_path(rule.api_version, rule.plural),
+                field_selector=rule.field_selector,
+                label_selector=rule.label_selector,
+                metadata_only=True,
+            ).items
+
+        rule_matches = [item["metadata"] for item in lists[list_key] if rule.predicate(item["metadata"])]
+        click.echo(f"Found {len(rule_matches)} {rule.description} ({rule.plural})")
+        for metadata in rule_matches:
+            object_key = (rule.api_version, rule.plural, metadata.get("namespace"), metadata["name"])
+            if object_key not in seen:
+                seen.add(object_key)
+                matches.append((rule, metadata))
+
+    return matches
+
+
+def run_cleanup(
+    client: K8sClient,
+    rules: list[CleanupRule],
+    concurrency: int,
+    max_rps: float,
+    propagation_policy: str = "Background",
+    dry_run: bool = False,
+) -> bool:
+    """Deletes all the objects matching the rules, returns True if all the deletions worked."""
+    start = time.monotonic()
+    matches = get_matches(client=client, rules=rules)
+    executor = RateLimitedExecutor(concurrency=concurrency, max_rps=max_rps, label="deletions")
+    for rule, metadata in matches:
+        namespace = metadata.get("namespace")
+        name = f"{rule.plural}/{metadata['name']}" + (f" (ns:{namespace})" if namespace else "")
+        if dry_run:
+            click.echo(f"DRY-RUN: would delete {name}")
+            continue
+
+        path = resource_path(rule.api_version, rule.plural, namespace=namespace, name=metadata["name"])
+        executor.submit(name, client.delete, path=path, propagation_policy=propagation_policy)
+
+    failures = executor.wait()
+    elapsed = time.monotonic() - start
+    click.echo(
+        f"{'Would have deleted' if dry_run else 'Deleted'} {len(matches) - len(failures)} objects "
+        f"({len(failures)} failed) in {elapsed:.1f}s"
+    )
+    return not failures
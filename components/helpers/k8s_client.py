@@ -0,0 +1,382 @@
+"""
+Minimal kubernetes REST client for the maintenance scripts.
+
+We don't have kubernetes python libs in the bastion/control nodes, and forking kubectl for every request means parsing
+the kubeconfig and opening a new TLS connection every time, so this uses only `requests` and `yaml` (both available
+there) and keeps a pool of keep-alive connections to the apiserver.
+
+Usage:
+    client = get_client()
+    for taskrun in client.list_items(resource_path("tekton.dev/v1", "taskruns", namespace="image-build")):
+        ...
+    for event in client.watch(resource_path("batch/v1", "cronjobs"), resource_version=list_result.resource_version):
+        ...
+    client.patch(resource_path("tekton.dev/v1", "pipelineruns", namespace="image-build", name=name), {"spec": ...})
+"""
+from __future__ import annotations
+
+import atexit
+import base64
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterator, Literal
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+
+DEFAULT_KUBECONFIG = pathlib.Path.home() / ".kube" / "config"
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_FIELD_MANAGER = "toolforge-deploy"
+# enough connections for the executor workers (see k8s_executor)
+POOL_SIZE = 32
+# (connect, read) seconds, so a stalled connection fails instead of hanging the script, like kubectl would
+DEFAULT_TIMEOUT = (10, 60)
+# how long the apiserver keeps a watch open if not given, the read timeout of the watches is a bit longer than that
+DEFAULT_WATCH_SECONDS = 300
+WATCH_READ_TIMEOUT_MARGIN = 30
+PATCH_CONTENT_TYPES = {
+    "merge": "application/merge-patch+json",
+    "json": "application/json-patch+json",
+    "strategic": "application/strategic-merge-patch+json",
+    "apply": "application/apply-patch+yaml",
+}
+METADATA_ONLY_ACCEPT = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json"
+METADATA_ONLY_WATCH_ACCEPT = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json"
+PatchType = Literal["merge", "json", "strategic", "apply"]
+
+
+class K8sError(Exception):
+    def __init__(self, message: str, status_code: int | None = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass(frozen=True)
+class ListResult:
+    items: list[dict[str, Any]]
+    # the resourceVersion of the list, to start watches from
+    resource_version: str
+
+
+def resource_path(
+    api_version: str,
+    plural: str,
+    namespace: str | None = None,
+    name: str | None = None,
+    subresource: str | None = None,
+) -> str:
+    """
+    Builds the api path for the given resource, ex.:
+        resource_path("tekton.dev/v1", "taskruns", namespace="image-build", name="mytaskrun")
+        -> /apis/tekton.dev/v1/namespaces/image-build/taskruns/mytaskrun
+    """
+    path = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+    if namespace:
+        path += f"/namespaces/{namespace}"
+    path += f"/{plural}"
+    if name:
+        path += f"/{name}"
+    if subresource:
+        path += f"/{subresource}"
+    return path
+
+
+def _data_to_file(data: str) -> str:
+    """requests only accepts certificates from files, so we write the inline kubeconfig ones to temporary files."""
+    fd, file_name = tempfile.mkstemp(prefix="k8s-client-")
+    with os.fdopen(fd, "wb") as cert_fd:
+        cert_fd.write(base64.b64decode(data))
+    atexit.register(os.unlink, file_name)
+    return file_name
+
+
+class K8sClient:
+    def __init__(self, server: str, session: requests.Session, context: str = "") -> None:
+        self.server = server.rstrip("/")
+        self.session = session
+        # the kubeconfig context it was created from, if any
+        self.context = context
+        # api version -> resources, see get_api_resource
+        self._discovery_cache: dict[str, list[dict[str, Any]]] = {}
+        # so the threads patching in parallel don't all do the discovery request
+        self._discovery_lock = threading.Lock()
+
+    @classmethod
+    def from_kubeconfig(
+        cls,
+        path: pathlib.Path | None = None,
+        context: str | None = None,
+        impersonate_user: str | None = None,
+        impersonate_group: str | None = None,
+    ) -> "K8sClient":
+        if path is None:
+            path = pathlib.Path(os.environ.get("KUBECONFIG", str(DEFAULT_KUBECONFIG)).split(os.pathsep)[0])
+        kubeconfig = yaml.safe_load(path.read_text())
+
+        context_name = context or kubeconfig["current-context"]
+        context_data = next(entry["context"] for entry in kubeconfig["contexts"] if entry["name"] == context_name)
+        cluster = next(entry["cluster"] for entry in kubeconfig["clusters"] if entry["name"] == context_data["cluster"])
+        user = next(entry["user"] for entry in kubeconfig["users"] if entry["name"] == context_data["user"])
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        if cluster.get("insecure-skip-tls-verify"):
+            session.verify = False
+        elif "certificate-authority-data" in cluster:
+            session.verify = _data_to_file(cluster["certificate-authority-data"])
+        elif "certificate-authority" in cluster:
+            session.verify = cluster["certificate-authority"]
+
+        if "client-certificate-data" in user:
+            session.cert = (
+                _data_to_file(user["client-certificate-data"]),
+                _data_to_file(user["client-key-data"]),
+            )
+        elif "client-certificate" in user:
+            session.cert = (user["client-certificate"], user["client-key"])
+        elif "token" in user:
+            session.headers["Authorization"] = f"Bearer {user['token']}"
+        elif "tokenFile" in user:
+            session.headers["Authorization"] = f"Bearer {pathlib.Path(user['tokenFile']).read_text().strip()}"
+        elif "exec" in user or "auth-provider" in user:
+            raise K8sError(f"Unsupported auth method for user {context_data['user']} in {path}, use kubectl instead")
+
+        if impersonate_user:
+            session.headers["Impersonate-User"] = impersonate_user
+        if impersonate_group:
+            # like kubectl --as-group, note that requests does not allow passing more than one
+            session.headers["Impersonate-Group"] = impersonate_group
+
+        return cls(server=cluster["server"], session=session, context=context_name)
+
+    def request(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        start = time.monotonic()
+        response = self.session.request(method, f"{self.server}{path}", **kwargs)
+        # for the watches, that's only until the headers
+        tracing.record_api_call(method=method, path=path, seconds=time.monotonic() - start)
+        if not response.ok:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise K8sError(
+                f"Error on {method} {path}: {response.status_code} {message}", status_code=response.status_code
+            )
+        return response
+
+    def get_api_resource(self, api_version: str, kind: str) -> dict[str, Any]:
+        """
+        Discovery info for the given kind (plural name, if it's namespaced, ...), one request per api version.
+
+        The kind is case insensitive, so `rolebinding` works as well as `RoleBinding`.
+        """
+        with self._discovery_lock:
+            if api_version not in self._discovery_cache:
+                path = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+                self._discovery_cache[api_version] = self.get(path)["resources"]
+
+        for api_resource in self._discovery_cache[api_version]:
+            # skip subresources, ex. deployments/status
+            if "/" not in api_resource["name"] and api_resource["kind"].lower() == kind.lower():
+                return api_resource
+
+        raise K8sError(f"Unable to find kind {kind} in api version {api_version}")
+
+    def object_path(
+        self,
+        api_version: str,
+        kind: str,
+        name: str,
+        namespace: str | None = None,
+        subresource: str | None = None,
+    ) -> str:
+        """Same as resource_path, but resolves the plural and ignores the namespace for cluster wide kinds."""
+        api_resource = self.get_api_resource(api_version=api_version, kind=kind)
+        return resource_path(
+            api_version=api_version,
+            plural=api_resource["name"],
+            namespace=namespace if api_resource["namespaced"] else None,
+            name=name,
+            subresource=subresource,
+        )
+
+    def get(self, path: str, **params: Any) -> dict[str, Any]:
+        return self.request("GET", path, params=params).json()
+
+    def list(
+        self,
+        path: str,
+        label_selector: str | None = None,
+        field_selector: str | None = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        metadata_only: bool = False,
+    ) -> ListResult:
+        """Lists all the objects, following the `continue` token page by page."""
+        items = []
+        resource_version = ""
+        for page in self._pages(
+            path=path,
+            label_selector=label_selector,
+            field_selector=field_selector,
+            page_size=page_size,
+            metadata_only=metadata_only,
+        ):
+            items.extend(page["items"])
+            resource_version = page["metadata"].get("resourceVersion", resource_version)
+        return ListResult(items=items, resource_version=resource_version)
+
+    def list_items(self, path: str, **kwargs: Any) -> Iterator[dict[str, Any]]:
+        """Same as list, but yields the items as the pages arrive."""
+        for page in self._pages(path=path, **kwargs):
+            yield from page["items"]
+
+    def _pages(
+        self,
+        path: str,
+        label_selector: str | None = None,
+        field_selector: str | None = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        metadata_only: bool = False,
+    ) -> Iterator[dict[str, Any]]:
+        params: dict[str, Any] = {"limit": page_size}
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        headers = {"Accept": METADATA_ONLY_ACCEPT} if metadata_only else {}
+
+        while True:
+            page = self.request("GET", path, params=params, headers=headers).json()
+            yield page
+            continue_token = page["metadata"].get("continue")
+            if not continue_token:
+                return
+            params["continue"] = continue_token
+
+    def watch(
+        self,
+        path: str,
+        resource_version: str,
+        label_selector: str | None = None,
+        field_selector: str | None = None,
+        timeout_seconds: int | None = None,
+        metadata_only: bool = False,
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Yields the watch events ({"type": "ADDED|MODIFIED|DELETED|BOOKMARK", "object": ...}) since resource_version.
+
+        Raises K8sError with status_code 410 when the resourceVersion is too old, the caller has to list again.
+        The apiserver closes the watch after timeout_seconds (DEFAULT_WATCH_SECONDS if not given), the caller can
+        resume it from the resourceVersion of the last event. Raises requests.Timeout if nothing arrives for longer
+        than that, ex. on a stalled connection.
+        """
+        timeout_seconds = timeout_seconds or DEFAULT_WATCH_SECONDS
+        params: dict[str, Any] = {
+            "watch": "true",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": timeout_seconds,
+        }
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        headers = {"Accept": METADATA_ONLY_WATCH_ACCEPT} if metadata_only else {}
+        timeout = (DEFAULT_TIMEOUT[0], timeout_seconds + WATCH_READ_TIMEOUT_MARGIN)
+
+        with self.request("GET", path, params=params, headers=headers, stream=True, timeout=timeout) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "ERROR":
+                    status = event["object"]
+                    raise K8sError(
+                        f"Error watching {path}: {status.get('code')} {status.get('message')}",
+                        status_code=status.get("code"),
+                    )
+                yield event
+
+    def patch(
+        self,
+        path: str,
+        body: Any,
+        patch_type: PatchType = "merge",
+        field_manager: str | None = None,
+        force: bool = False,
+    ) -> dict[str, Any]:
+        """Patches the object at path, to patch a subresource pass the path to it (ex. .../<name>/status)."""
+        params: dict[str, Any] = {}
+        if field_manager:
+            params["fieldManager"] = field_manager
+        if force:
+            params["force"] = "true"
+        return self.request(
+            "PATCH",
+            path,
+            params=params,
+            data=json.dumps(body),
+            headers={"Content-Type": PATCH_CONTENT_TYPES[patch_type]},
+        ).json()
+
+    def apply(
+        self,
+        k8s_object: dict[str, Any],
+        plural: str,
+        field_manager: str = DEFAULT_FIELD_MANAGER,
+        force: bool = True,
+    ) -> dict[str, Any]:
+        """Server-side apply of the given object (managedFields are dropped, the apiserver refuses them)."""
+        k8s_object = {**k8s_object, "metadata": dict(k8s_object["metadata"])}
+        k8s_object["metadata"].pop("managedFields", None)
+        path = resource_path(
+            api_version=k8s_object["apiVersion"],
+            plural=plural,
+            namespace=k8s_object["metadata"].get("namespace"),
+            name=k8s_object["metadata"]["name"],
+        )
+        return self.patch(path=path, body=k8s_object, patch_type="apply", field_manager=field_manager, force=force)
+
+    def delete(self, path: str, propagation_policy: str | None = None) -> dict[str, Any]:
+        body = {"propagationPolicy": propagation_policy} if propagation_policy else None
+        return self.request("DELETE", path, json=body).json()
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(
+    context: str | None = None,
+    impersonate_user: str | None = None,
+    impersonate_group: str | None = None,
+) -> K8sClient:
+    """Shared client, so the kubeconfig is read and the connections are opened only once per script run."""
+    return K8sClient.from_kubeconfig(
+        context=context,
+        impersonate_user=impersonate_user,
+        impersonate_group=impersonate_group,
+    )
+
+
+def get_cluster_id() -> str:
+    """
+    Name of the cluster of the current kubeconfig context (ex. toolsbeta-5c1a2b3d, with a hash of the server url), to
+    keep apart the local state of the scripts (snapshots, journals) for each cluster.
+    """
+    client = get_client()
+    server_hash = hashlib.sha256(client.server.encode()).hexdigest()[:8]
+    return f"{re.sub(r'[^A-Za-z0-9_.-]', '_', client.context or 'default')}-{server_hash}"
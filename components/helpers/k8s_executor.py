@@ -0,0 +1,110 @@
+"""
+Bounded, rate limited executor for the maintenance scripts that have to send many requests to the k8s apiserver.
+
+Usage:
+    executor = RateLimitedExecutor(concurrency=8, max_rps=10)
+    for name in names:
+        executor.submit(name, k8s_patch, new_value=..., name=name)
+    failures = executor.wait()
+
+It will not raise on the first failure, instead it keeps going and prints a summary of all the failures at the end, so
+the script can be re-run only for those.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import click
+
+
+# don't spam the terminal with progress lines
+PROGRESS_INTERVAL_SECONDS = 2.0
+
+
+@dataclass(frozen=True)
+class Failure:
+    name: str
+    error: BaseException
+
+
+class RateLimiter:
+    """Thread safe limiter, makes sure we don't start more than max_rps calls per second (0 means no limit)."""
+
+    def __init__(self, max_rps: float) -> None:
+        self.interval = 1.0 / max_rps if max_rps > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RateLimitedExecutor:
+    def __init__(self, concurrency: int, max_rps: float, label: str = "requests") -> None:
+        self.label = label
+        self.rate_limiter = RateLimiter(max_rps=max_rps)
+        self.failures: list[Failure] = []
+        self.submitted = 0
+        self.done = 0
+        self._pool = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_progress = 0.0
+
+    def submit(self, name: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        with self._lock:
+            self.submitted += 1
+
+        return self._pool.submit(self._run, name, func, *args, **kwargs)
+
+    def _run(self, name: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self.rate_limiter.wait()
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            with self._lock:
+                self.failures.append(Failure(name=name, error=error))
+            click.echo(click.style(f"    {name}: failed: {error}", fg="red"), err=True)
+        finally:
+            with self._lock:
+                self.done += 1
+                self._show_progress()
+
+    def _show_progress(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL_SECONDS:
+            return
+
+        self._last_progress = now
+        elapsed = now - self._start
+        throughput = self.done / elapsed if elapsed else 0.0
+        click.echo(
+            f"  [{self.done}/{self.submitted}] {self.label} done, {len(self.failures)} failed, "
+            f"{throughput:.1f}/s, {elapsed:.0f}s elapsed"
+        )
+
+    def wait(self) -> list[Failure]:
+        """Waits for all the submitted calls to finish, prints a summary and returns the failures."""
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._show_progress(force=True)
+
+        if self.failures:
+            click.echo(click.style(f"{len(self.failures)} {self.label} failed:", fg="red"))
+            for failure in sorted(self.failures, key=lambda failure: failure.name):
+                click.echo(f"    {failure.name}: {failure.error}")
+
+        return self.failures
@@ -0,0 +1,85 @@
+"""
+Append-only journal of the objects a migration script already finished with.
+
+Each line is a json object with the name and the resourceVersion of the object once migrated, so re-running a script
+after an interruption can skip the finished objects without any request to the apiserver, and --verify passes only need
+to re-check the ones that changed since (their resourceVersion is different).
+
+The last entry for a name wins, so re-migrating an object just appends a new line.
+
+The entries also have the cluster they were recorded for (see k8s_client.get_cluster_id), a journal from another
+cluster is refused instead of skipping objects that were never migrated there.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import threading
+import time
+
+
+JOURNALS_DIR = pathlib.Path.home() / ".cache" / "toolforge-deploy" / "journals"
+
+
+class JournalError(Exception):
+    pass
+
+
+class MigrationJournal:
+    def __init__(self, path: pathlib.Path, cluster_id: str = "") -> None:
+        self.path = path
+        self.cluster_id = cluster_id
+        self.done: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def for_script(cls, script: str, cluster_id: str) -> "MigrationJournal":
+        """Default journal for the given script path and cluster, ex. for_script(__file__, get_cluster_id())."""
+        return cls(path=JOURNALS_DIR / cluster_id / f"{pathlib.Path(script).stem}.jsonl", cluster_id=cluster_id)
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+
+        with self.path.open("r+b") as journal_fd:
+            content = journal_fd.read()
+            if content and not content.endswith(b"\n"):
+                # a line half-written when the script got interrupted, drop it so the next record doesn't get appended
+                # to it (and lost with it)
+                content = content[: content.rfind(b"\n") + 1]
+                journal_fd.truncate(len(content))
+
+        for line in content.decode().splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # same, from the runs before the half-written lines were dropped
+                continue
+            if self.cluster_id and entry.get("cluster", self.cluster_id) != self.cluster_id:
+                raise JournalError(
+                    f"The journal {self.path} is for the cluster {entry['cluster']}, not {self.cluster_id}, pass "
+                    "another one"
+                )
+            self.done[entry["name"]] = entry["resourceVersion"]
+
+    def is_done(self, name: str) -> bool:
+        return name in self.done
+
+    def changed(self, resource_versions: dict[str, str]) -> list[str]:
+        """Names of the journaled objects that have a different resourceVersion now (or that are gone)."""
+        return sorted(
+            name
+            for name, resource_version in self.done.items()
+            if resource_versions.get(name) != resource_version
+        )
+
+    def record(self, name: str, resource_version: str) -> None:
+        entry = {"name": name, "resourceVersion": resource_version, "time": time.time()}
+        if self.cluster_id:
+            entry["cluster"] = self.cluster_id
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as journal_fd:
+                journal_fd.write(json.dumps(entry) + "\n")
+            self.done[name] = resource_version
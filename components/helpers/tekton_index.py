@@ -0,0 +1,78 @@
+"""
+Index to find the taskruns belonging to a pipelinerun without scanning all the taskruns every time.
+
+Build it once from a single taskruns list (the full objects, or only their metadata):
+    index = TaskRunIndex.from_taskruns(taskruns=kubectl_list["items"])
+    index.for_pipelinerun("build-xyz")
+
+Taskruns are matched by their `tekton.dev/pipelineRun` label or PipelineRun ownerReference, falling back to the name
+prefix tekton uses (`<pipelinerun>-<pipeline task>`) for the ones that have neither.
+"""
+from __future__ import annotations
+
+import bisect
+from collections import defaultdict
+from typing import Any, Iterable
+
+
+PIPELINERUN_LABEL = "tekton.dev/pipelineRun"
+
+
+def get_owner_pipelinerun(taskrun: dict[str, Any]) -> str | None:
+    metadata = taskrun.get("metadata", {})
+    owner = metadata.get("labels", {}).get(PIPELINERUN_LABEL)
+    if owner:
+        return owner
+
+    for owner_reference in metadata.get("ownerReferences", []):
+        if owner_reference.get("kind") == "PipelineRun":
+            return owner_reference["name"]
+
+    return None
+
+
+class TaskRunIndex:
+    def __init__(self) -> None:
+        self.by_pipelinerun: dict[str, list[str]] = defaultdict(list)
+        # names of the taskruns without owner, sorted to look them up by prefix with bisect
+        self.orphan_names: list[str] = []
+
+    @classmethod
+    def from_taskruns(cls, taskruns: Iterable[dict[str, Any]]) -> "TaskRunIndex":
+        index = cls()
+        for taskrun in taskruns:
+            index.add(name=taskrun["metadata"]["name"], pipelinerun_name=get_owner_pipelinerun(taskrun))
+
+        index.sort()
+        return index
+
+    @classmethod
+    def from_names(cls, taskrun_names: Iterable[str]) -> "TaskRunIndex":
+        """When only the names are known, everything is matched by prefix."""
+        index = cls()
+        index.orphan_names = sorted(taskrun_names)
+        return index
+
+    def add(self, name: str, pipelinerun_name: str | None) -> None:
+        """The orphan names are left unsorted, call sort() once done adding."""
+        if pipelinerun_name:
+            self.by_pipelinerun[pipelinerun_name].append(name)
+        else:
+            self.orphan_names.append(name)
+
+    def sort(self) -> None:
+        self.orphan_names.sort()
+
+    def _by_prefix(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self.orphan_names, prefix)
+        # the highest code point sorts after anything else with the same prefix
+        end = bisect.bisect_left(self.orphan_names, prefix + "\U0010ffff", lo=start)
+        return self.orphan_names[start:end]
+
+    def for_pipelinerun(self, pipelinerun_name: str) -> list[str]:
+        """
+        Taskruns belonging to the given pipelinerun.
+
+        The prefix includes the dash separator so `build-1` does not match the taskruns of `build-10`.
+        """
+        return self.by_pipelinerun.get(pipelinerun_name, []) + self._by_prefix(f"{pipelinerun_name}-")
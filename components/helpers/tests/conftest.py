@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# the helpers import each other as top level modules, as the scripts add components/helpers to their path
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,177 @@
+import time
+
+import pytest
+
+import cluster_snapshot
+from cluster_snapshot import Plan, PlannedPatch, PlanStep, Snapshot
+
+
+@pytest.fixture
+def cluster_id(monkeypatch):
+    current = {"id": "tools-1234"}
+    monkeypatch.setattr(cluster_snapshot, "get_cluster_id", lambda: current["id"])
+    return current
+
+
+@pytest.fixture
+def queries():
+    calls = []
+
+    def list_pipelineruns():
+        calls.append("pipelineruns")
+        return [{"metadata": {"name": f"pr-{len(calls)}"}}]
+
+    return {"pipelineruns": list_pipelineruns}, calls
+
+
+def test_default_path_is_per_cluster(cluster_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(cluster_snapshot, "SNAPSHOTS_DIR", tmp_path)
+
+    path = Snapshot.default_path(script="/some/dir/0.0.72-migrate.py")
+
+    assert path == tmp_path / "tools-1234" / "0.0.72-migrate.json"
+
+
+def test_load_or_capture_reuses_the_snapshot(cluster_id, queries, tmp_path):
+    queries, calls = queries
+    path = tmp_path / "snapshot.json"
+
+    captured = Snapshot.load_or_capture(path=path, queries=queries)
+    loaded = Snapshot.load_or_capture(path=path, queries=queries)
+
+    assert calls == ["pipelineruns"]
+    assert loaded == captured
+    assert loaded.cluster_id == "tools-1234"
+    assert loaded["pipelineruns"] == [{"metadata": {"name": "pr-1"}}]
+
+
+def test_load_or_capture_refresh(cluster_id, queries, tmp_path):
+    queries, calls = queries
+    path = tmp_path / "snapshot.json"
+
+    Snapshot.load_or_capture(path=path, queries=queries)
+    snapshot = Snapshot.load_or_capture(path=path, queries=queries, refresh=True)
+
+    assert calls == ["pipelineruns", "pipelineruns"]
+    assert snapshot["pipelineruns"] == [{"metadata": {"name": "pr-2"}}]
+
+
+def test_load_or_capture_from_another_cluster(cluster_id, queries, tmp_path):
+    queries, calls = queries
+    path = tmp_path / "snapshot.json"
+
+    Snapshot.load_or_capture(path=path, queries=queries)
+    cluster_id["id"] = "toolsbeta-5678"
+    snapshot = Snapshot.load_or_capture(path=path, queries=queries)
+
+    assert calls == ["pipelineruns", "pipelineruns"]
+    assert snapshot.cluster_id == "toolsbeta-5678"
+    assert Snapshot.load(path).cluster_id == "toolsbeta-5678"
+
+
+def test_load_or_capture_too_old(cluster_id, queries, tmp_path):
+    queries, calls = queries
+    path = tmp_path / "snapshot.json"
+    Snapshot(collections={"pipelineruns": []}, captured_at=time.time() - 120, cluster_id="tools-1234").save(path)
+
+    assert Snapshot.load_or_capture(path=path, queries=queries, max_age=300)["pipelineruns"] == []
+    assert calls == []
+
+    assert Snapshot.load_or_capture(path=path, queries=queries, max_age=60)["pipelineruns"] != []
+    assert calls == ["pipelineruns"]
+
+
+def test_load_or_capture_with_other_queries(cluster_id, queries, tmp_path):
+    queries, calls = queries
+    path = tmp_path / "snapshot.json"
+    Snapshot(collections={"taskruns": []}, captured_at=time.time(), cluster_id="tools-1234").save(path)
+
+    assert list(Snapshot.load_or_capture(path=path, queries=queries).collections) == ["pipelineruns"]
+    assert calls == ["pipelineruns"]
+
+
+def test_discard(tmp_path):
+    path = tmp_path / "snapshot.json"
+    path.write_text("{}")
+
+    Snapshot.discard(path=path)
+    # already gone is fine too
+    Snapshot.discard(path=path)
+
+    assert not path.exists()
+
+
+class FakeClient:
+    def __init__(self, conflicts: tuple[str, ...] = ()) -> None:
+        self.conflicts = conflicts
+        self.patches: list[tuple[str, dict]] = []
+        self.resource_version = 10
+
+    def object_path(self, api_version, kind, name, namespace, subresource):
+        path = f"/apis/{api_version}/namespaces/{namespace}/{kind}/{name}"
+        return f"{path}/{subresource}" if subresource else path
+
+    def patch(self, path, body, patch_type):
+        assert patch_type == "merge"
+        if any(path.endswith(f"/{name}") for name in self.conflicts):
+            error = Exception(f"conflict on {path}")
+            error.status_code = 409
+            raise error
+        self.patches.append((path, body))
+        self.resource_version += 1
+        return {"metadata": {"resourceVersion": str(self.resource_version)}}
+
+
+def get_step(name: str, resource_version: str = "5") -> PlanStep:
+    return PlanStep.for_object(
+        k8s_object={
+            "apiVersion": "tekton.dev/v1",
+            "kind": "PipelineRun",
+            "metadata": {"name": name, "namespace": "image-build", "resourceVersion": resource_version},
+        },
+        patches=[
+            PlannedPatch(body={"metadata": {"labels": {"migrated": "yes"}}}),
+            PlannedPatch(body={"status": {"done": True}}, subresource="status"),
+        ],
+    )
+
+
+def test_plan_step_apply_chains_the_resource_versions(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(cluster_snapshot, "get_client", lambda: client)
+
+    assert get_step(name="pr-1").apply() == "12"
+    assert client.patches == [
+        (
+            "/apis/tekton.dev/v1/namespaces/image-build/PipelineRun/pr-1",
+            {"metadata": {"labels": {"migrated": "yes"}, "resourceVersion": "5"}},
+        ),
+        (
+            "/apis/tekton.dev/v1/namespaces/image-build/PipelineRun/pr-1/status",
+            {"status": {"done": True}, "metadata": {"resourceVersion": "11"}},
+        ),
+    ]
+
+
+def test_plan_step_apply_without_resource_version(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(cluster_snapshot, "get_client", lambda: client)
+
+    get_step(name="pr-1", resource_version="").apply()
+
+    assert client.patches[0][1] == {"metadata": {"labels": {"migrated": "yes"}}}
+
+
+def test_plan_apply_returns_the_failures(monkeypatch, capsys):
+    client = FakeClient(conflicts=("pr-2",))
+    monkeypatch.setattr(cluster_snapshot, "get_client", lambda: client)
+    applied = []
+    plan = Plan()
+    for name in ["pr-1", "pr-2", "pr-3"]:
+        plan.add(get_step(name=name))
+
+    failures = plan.apply(concurrency=2, max_rps=0, on_applied=lambda step, _: applied.append(step.name))
+
+    assert [failure.name for failure in failures] == ["PipelineRun/pr-2 (ns:image-build)"]
+    assert sorted(applied) == ["pr-1", "pr-3"]
+    assert "1 objects changed since the snapshot was taken" in capsys.readouterr().out
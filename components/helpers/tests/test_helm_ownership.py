@@ -0,0 +1,81 @@
+import json
+import subprocess
+
+import pytest
+
+import helm_ownership
+
+
+def get_object(kind: str, name: str, annotations: dict[str, str] | None = None):
+    return {
+        "apiVersion": "v1",
+        "kind": kind,
+        "metadata": {"name": name, "namespace": "ns", "resourceVersion": "1", "annotations": annotations or {}},
+    }
+
+
+@pytest.fixture
+def kubectl_output(monkeypatch):
+    calls = []
+
+    def set_output(stdout: str, returncode: int = 0):
+        def fake_run(args, check=False, **kwargs):
+            calls.append(args)
+            if check and returncode:
+                raise subprocess.CalledProcessError(returncode=returncode, cmd=args)
+            return subprocess.CompletedProcess(args=args, returncode=returncode, stdout=stdout, stderr="")
+
+        monkeypatch.setattr(helm_ownership.tracing, "run", fake_run)
+        return calls
+
+    return set_output
+
+
+def test_kubectl_get_list(kubectl_output):
+    objects = [get_object(kind="ConfigMap", name="cm-1"), get_object(kind="Secret", name="secret-1")]
+    calls = kubectl_output(json.dumps({"apiVersion": "v1", "kind": "List", "items": objects}))
+
+    assert helm_ownership._kubectl_get(args=["configmap,secret"], namespace="ns") == objects
+    assert calls == [["kubectl", "get", "--namespace=ns", "--output=json", "configmap,secret"]]
+
+
+def test_kubectl_get_empty_list(kubectl_output):
+    kubectl_output(json.dumps({"apiVersion": "v1", "kind": "List", "items": []}))
+
+    assert helm_ownership._kubectl_get(args=["configmap"], namespace="ns") == []
+
+
+def test_kubectl_get_bare_object(kubectl_output):
+    config_map = get_object(kind="ConfigMap", name="cm-1")
+    kubectl_output(json.dumps(config_map))
+
+    assert helm_ownership._kubectl_get(args=["configmap/cm-1"], namespace="ns") == [config_map]
+
+
+def test_kubectl_get_no_output(kubectl_output):
+    kubectl_output("")
+
+    assert helm_ownership._kubectl_get(args=["--ignore-not-found", "configmap/cm-1"], namespace="ns") == []
+
+
+def test_kubectl_get_failure(kubectl_output):
+    kubectl_output("", returncode=1)
+
+    with pytest.raises(Exception, match="Error running"):
+        helm_ownership._kubectl_get(args=["configmap"], namespace="ns")
+
+
+def test_get_named_objects_single_object(kubectl_output):
+    kubectl_output(
+        json.dumps(
+            get_object(
+                kind="ConfigMap",
+                name="cm-1",
+                annotations={helm_ownership.RELEASE_NAME_ANNOTATION: "release"},
+            )
+        )
+    )
+
+    objects = helm_ownership.get_named_objects(kind_names=["configmap/cm-1"], namespace="ns")
+
+    assert [(str(obj), obj.release_name) for obj in objects] == [("configmap/cm-1 (ns:ns)", "release")]
@@ -0,0 +1,66 @@
+import pytest
+
+import k8s_executor
+from k8s_executor import RateLimitedExecutor, RateLimiter
+
+
+class FakeTime:
+    def __init__(self) -> None:
+        self.now = 100.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(k8s_executor, "time", fake)
+    return fake
+
+
+def test_rate_limiter_spaces_the_calls(fake_time):
+    rate_limiter = RateLimiter(max_rps=4)
+    for _ in range(4):
+        rate_limiter.wait()
+
+    assert fake_time.sleeps == [0.25, 0.25, 0.25]
+
+
+def test_rate_limiter_does_not_save_up_idle_time(fake_time):
+    rate_limiter = RateLimiter(max_rps=2)
+    rate_limiter.wait()
+    fake_time.now += 10
+    rate_limiter.wait()
+    rate_limiter.wait()
+
+    assert fake_time.sleeps == [0.5]
+
+
+def test_rate_limiter_without_limit(fake_time):
+    rate_limiter = RateLimiter(max_rps=0)
+    for _ in range(10):
+        rate_limiter.wait()
+
+    assert fake_time.sleeps == []
+
+
+def test_executor_keeps_going_on_failures(capsys):
+    def call(name: str) -> str:
+        if name.startswith("bad"):
+            raise ValueError(f"{name} is bad")
+        return name
+
+    executor = RateLimitedExecutor(concurrency=3, max_rps=0, label="calls")
+    futures = [executor.submit(name, call, name) for name in ["bad-2", "good-1", "bad-1", "good-2"]]
+    failures = executor.wait()
+
+    assert [future.result() for future in futures] == [None, "good-1", None, "good-2"]
+    assert sorted(str(failure.error) for failure in failures) == ["bad-1 is bad", "bad-2 is bad"]
+    assert executor.done == executor.submitted == 4
+    assert "2 calls failed:" in capsys.readouterr().out
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import migration_journal
+from migration_journal import JournalError, MigrationJournal
+
+
+def test_record_and_reload(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = MigrationJournal(path=path)
+    journal.record(name="tr-1", resource_version="1")
+    journal.record(name="tr-2", resource_version="2")
+    journal.record(name="tr-1", resource_version="3")
+
+    reloaded = MigrationJournal(path=path)
+
+    assert reloaded.done == {"tr-1": "3", "tr-2": "2"}
+    assert reloaded.is_done("tr-2")
+    assert not reloaded.is_done("tr-3")
+
+
+def test_missing_journal_is_empty(tmp_path):
+    journal = MigrationJournal(path=tmp_path / "missing" / "journal.jsonl")
+
+    assert journal.done == {}
+
+
+def test_changed(tmp_path):
+    journal = MigrationJournal(path=tmp_path / "journal.jsonl")
+    journal.record(name="same", resource_version="1")
+    journal.record(name="updated", resource_version="1")
+    journal.record(name="gone", resource_version="1")
+
+    assert journal.changed(resource_versions={"same": "1", "updated": "2", "new": "1"}) == ["gone", "updated"]
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text(json.dumps({"name": "tr-1", "resourceVersion": "1"}) + '\n{"name": "tr-2", "resourceV')
+
+    journal = MigrationJournal(path=path)
+    journal.record(name="tr-3", resource_version="3")
+
+    assert journal.done == {"tr-1": "1", "tr-3": "3"}
+    assert MigrationJournal(path=path).done == {"tr-1": "1", "tr-3": "3"}
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_torn_only_line_is_dropped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"name": "tr-1"')
+
+    journal = MigrationJournal(path=path)
+
+    assert journal.done == {}
+    assert path.read_text() == ""
+
+
+def test_broken_lines_in_the_middle_are_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text(
+        json.dumps({"name": "tr-1", "resourceVersion": "1"})
+        + '\n{"name": "tr-2"{"name": "tr-3", "resourceVersion": "3"}\n'
+        + json.dumps({"name": "tr-4", "resourceVersion": "4"})
+        + "\n"
+    )
+
+    assert MigrationJournal(path=path).done == {"tr-1": "1", "tr-4": "4"}
+
+
+def test_journal_from_another_cluster_is_refused(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    MigrationJournal(path=path, cluster_id="toolsbeta-1234").record(name="tr-1", resource_version="1")
+
+    with pytest.raises(JournalError, match="toolsbeta-1234"):
+        MigrationJournal(path=path, cluster_id="tools-5678")
+
+
+def test_journal_without_cluster_is_accepted(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    MigrationJournal(path=path).record(name="tr-1", resource_version="1")
+
+    journal = MigrationJournal(path=path, cluster_id="tools-5678")
+    journal.record(name="tr-2", resource_version="2")
+
+    assert journal.done == {"tr-1": "1", "tr-2": "2"}
+    assert json.loads(path.read_text().splitlines()[-1])["cluster"] == "tools-5678"
+
+
+def test_for_script_is_per_cluster(tmp_path, monkeypatch):
+    monkeypatch.setattr(migration_journal, "JOURNALS_DIR", tmp_path)
+
+    journal = MigrationJournal.for_script(script="/some/dir/0.124.0-upgrade.py", cluster_id="tools-5678")
+
+    assert journal.path == tmp_path / "tools-5678" / "0.124.0-upgrade.jsonl"
+    assert journal.cluster_id == "tools-5678"
@@ -0,0 +1,69 @@
+from tekton_index import PIPELINERUN_LABEL, TaskRunIndex, get_owner_pipelinerun
+
+
+def get_taskrun(name: str, labels: dict[str, str] | None = None, owners: list[dict[str, str]] | None = None):
+    metadata = {"name": name, "labels": labels or {}}
+    if owners is not None:
+        metadata["ownerReferences"] = owners
+    return {"metadata": metadata}
+
+
+def test_get_owner_pipelinerun_prefers_the_label():
+    taskrun = get_taskrun(
+        name="build-1-build",
+        labels={PIPELINERUN_LABEL: "build-1"},
+        owners=[{"kind": "PipelineRun", "name": "other"}],
+    )
+
+    assert get_owner_pipelinerun(taskrun) == "build-1"
+
+
+def test_get_owner_pipelinerun_falls_back_to_the_owner_reference():
+    taskrun = get_taskrun(
+        name="build-1-build",
+        owners=[{"kind": "Pod", "name": "some-pod"}, {"kind": "PipelineRun", "name": "build-1"}],
+    )
+
+    assert get_owner_pipelinerun(taskrun) == "build-1"
+
+
+def test_get_owner_pipelinerun_without_owner():
+    assert get_owner_pipelinerun(get_taskrun(name="build-1-build")) is None
+    assert get_owner_pipelinerun({"metadata": {"name": "build-1-build"}}) is None
+
+
+def test_for_pipelinerun_matches_by_owner_and_by_prefix():
+    index = TaskRunIndex.from_taskruns(
+        taskruns=[
+            get_taskrun(name="renamed", labels={PIPELINERUN_LABEL: "build-1"}),
+            get_taskrun(name="build-1-build"),
+            get_taskrun(name="build-2-build"),
+        ]
+    )
+
+    assert index.for_pipelinerun("build-1") == ["renamed", "build-1-build"]
+    assert index.for_pipelinerun("build-2") == ["build-2-build"]
+    assert index.for_pipelinerun("build-3") == []
+
+
+def test_for_pipelinerun_prefix_includes_the_dash():
+    index = TaskRunIndex.from_names(taskrun_names=["build-10-build", "build-1-build", "build-1", "build-1x-build"])
+
+    assert index.for_pipelinerun("build-1") == ["build-1-build"]
+    assert index.for_pipelinerun("build-10") == ["build-10-build"]
+
+
+def test_for_pipelinerun_prefix_gets_all_the_tasks_in_order():
+    index = TaskRunIndex.from_names(taskrun_names=["b-1-test", "a-1-build", "b-1-build", "b-1-é", "c-1-build"])
+
+    assert index.for_pipelinerun("b-1") == ["b-1-build", "b-1-test", "b-1-é"]
+
+
+def test_add_then_sort():
+    index = TaskRunIndex()
+    for name in ["build-2-build", "build-1-test", "build-1-build"]:
+        index.add(name=name, pipelinerun_name=None)
+    index.add(name="owned", pipelinerun_name="build-1")
+    index.sort()
+
+    assert index.for_pipelinerun("build-1") == ["owned", "build-1-build", "build-1-test"]
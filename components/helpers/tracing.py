@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Tracing of the deploy and maintenance scripts: how long each of their stages took, and each kubectl, helm, helmfile
+(or any other external command) they ran, with its arguments, exit code and output size.
+
+The spans are appended as json lines to a trace file shared by the python scripts (this module) and the bash ones
+(tracing.sh), one line per finished span:
+    {"trace_id": ..., "span_id": ..., "parent_id": ..., "kind": "script|stage|command", "name": ...,
+     "start": <epoch seconds>, "end": <epoch seconds>, "attributes": {...}}
+
+The first traced script starts a new trace in ~/.cache/toolforge-deploy/traces/<date>-<script>.jsonl and passes it,
+along with its current span, to the commands it runs through the TOOLFORGE_DEPLOY_TRACE_* environment variables, so ex.
+the deploy.sh runs of the tekton upgrade script (and their helmfile runs) show up under its stages. The python scripts
+also get the number and duration of their api calls (see k8s_client) per verb and resource as attributes of their
+script span. Set TOOLFORGE_DEPLOY_TRACE=off to disable it. Only the last TOOLFORGE_DEPLOY_TRACE_KEEP (default 100)
+traces are kept, the older ones are removed when a new one starts (see prune).
+
+Usage:
+    if __name__ == "__main__":
+        with tracing.script_span(__file__):
+            main()
+    ...
+    with tracing.span("upgrade_builds_builder"):
+        tracing.run([f"{BASEDIR}/deploy.sh", "builds-builder"], check=True)
+
+To show a trace as a tree with the time of each span, and the totals per command:
+    components/helpers/tracing.py show ~/.cache/toolforge-deploy/traces/<trace>.jsonl
+
+or as folded stacks for flamegraph.pl or speedscope with --folded. To send it to the Loki of infra-tracing (as OTLP
+logs, one per span, with their trace and span ids):
+    components/helpers/tracing.py export --endpoint https://<user>:<password>@<k8s node>:30004/otlp/v1/logs <trace>
+
+That is also done at the end of every traced run if TOOLFORGE_DEPLOY_TRACE_OTLP_ENDPOINT is set (and
+TOOLFORGE_DEPLOY_TRACE_OTLP_CA to the CA bundle of the endpoint, or 'no' to not verify its certificate).
+"""
+from __future__ import annotations
+
+import argparse
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+TRACES_DIR = pathlib.Path.home() / ".cache" / "toolforge-deploy" / "traces"
+ENABLED_ENV = "TOOLFORGE_DEPLOY_TRACE"
+FILE_ENV = "TOOLFORGE_DEPLOY_TRACE_FILE"
+TRACE_ID_ENV = "TOOLFORGE_DEPLOY_TRACE_ID"
+PARENT_ENV = "TOOLFORGE_DEPLOY_TRACE_PARENT"
+OTLP_ENDPOINT_ENV = "TOOLFORGE_DEPLOY_TRACE_OTLP_ENDPOINT"
+OTLP_CA_ENV = "TOOLFORGE_DEPLOY_TRACE_OTLP_CA"
+KEEP_ENV = "TOOLFORGE_DEPLOY_TRACE_KEEP"
+DEFAULT_KEEP = 100
+# the subcommands to group the commands by, ex. "kubectl get" or "helmfile sync"
+VERBS = {
+    "annotate",
+    "apply",
+    "create",
+    "delete",
+    "diff",
+    "dump",
+    "exec",
+    "get",
+    "install",
+    "label",
+    "list",
+    "load",
+    "patch",
+    "rollout",
+    "status",
+    "sync",
+    "template",
+    "uninstall",
+    "upgrade",
+    "wait",
+}
+
+# the current span of each thread (the ones started by the executors fall back to the script span)
+_current_span: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_span", default=None)
+_api_calls_lock = threading.Lock()
+_api_calls: collections.Counter[str] = collections.Counter()
+_api_seconds: collections.Counter[str] = collections.Counter()
+_write_lock = threading.Lock()
+
+
+@dataclass
+class Span:
+    span_id: str
+    name: str
+    kind: str
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+def new_id(size: int) -> str:
+    """Random hex id, 16 bytes for the traces and 8 for the spans as in OTLP."""
+    return os.urandom(size).hex()
+
+
+def is_active() -> bool:
+    return os.environ.get(ENABLED_ENV, "on") != "off" and bool(os.environ.get(FILE_ENV))
+
+
+def write_span(span: Span, parent_id: str | None, start: float, end: float) -> None:
+    line = json.dumps(
+        {
+            "trace_id": os.environ.get(TRACE_ID_ENV),
+            "span_id": span.span_id,
+            "parent_id": parent_id,
+            "kind": span.kind,
+            "name": span.name,
+            "start": round(start, 6),
+            "end": round(end, 6),
+            "attributes": span.attributes,
+        },
+        default=str,
+    )
+    # a single write per line, so the concurrent scripts appending to the same file don't mix their lines
+    with _write_lock, open(os.environ[FILE_ENV], "a") as trace_file:
+        trace_file.write(line + "\n")
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = "stage", **attributes: Any) -> Iterator[Span]:
+    """Records the time spent in the block, nested in the current span. Add attributes with span.attributes."""
+    current = Span(span_id=new_id(8), name=name, kind=kind, attributes=attributes)
+    if not is_active():
+        yield current
+        return
+
+    parent_id = _current_span.get() or os.environ.get(PARENT_ENV) or None
+    token = _current_span.set(current.span_id)
+    start = time.time()
+    try:
+        yield current
+    except SystemExit as error:
+        current.attributes["exit_code"] = error.code if isinstance(error.code, int) else int(error.code is not None)
+        raise
+    except BaseException as error:
+        current.attributes["error"] = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        _current_span.reset(token)
+        write_span(span=current, parent_id=parent_id, start=start, end=time.time())
+
+
+def prune(traces_dir: pathlib.Path) -> None:
+    """Removes the oldest traces, leaving room for a new one within the last $TOOLFORGE_DEPLOY_TRACE_KEEP."""
+    keep = int(os.environ.get(KEEP_ENV, DEFAULT_KEEP)) - 1
+    # the names start with the date, so sorting them goes from the oldest
+    traces = sorted(traces_dir.glob("*.jsonl"))
+    for trace in traces[: max(len(traces) - keep, 0)]:
+        trace.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def script_span(script: str) -> Iterator[None]:
+    """
+    Span of the whole run of the script, with its arguments and api calls. It starts a new trace (and trace file) if
+    it's not run from an already traced script.
+    """
+    if os.environ.get(ENABLED_ENV, "on") == "off":
+        yield
+        return
+
+    name = pathlib.Path(script).name
+    new_trace = not os.environ.get(FILE_ENV)
+    if new_trace:
+        TRACES_DIR.mkdir(parents=True, exist_ok=True)
+        prune(TRACES_DIR)
+        os.environ[FILE_ENV] = str(TRACES_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.jsonl")
+    os.environ.setdefault(TRACE_ID_ENV, new_id(16))
+
+    parent_id = os.environ.get(PARENT_ENV)
+    try:
+        with span(name, kind="script", args=sys.argv[1:]) as current:
+            # for the other threads, and the commands run without tracing.run
+            os.environ[PARENT_ENV] = current.span_id
+            try:
+                yield
+            finally:
+                current.attributes.update(get_api_calls())
+    finally:
+        if parent_id is None:
+            os.environ.pop(PARENT_ENV, None)
+        else:
+            os.environ[PARENT_ENV] = parent_id
+        if new_trace:
+            print(f"Trace written, see it with: {__file__} show {os.environ[FILE_ENV]}", file=sys.stderr)
+            if os.environ.get(OTLP_ENDPOINT_ENV):
+                export_from_env(pathlib.Path(os.environ[FILE_ENV]))
+
+
+def _size(output: str | bytes | None) -> int:
+    if output is None:
+        return 0
+    return len(output.encode() if isinstance(output, str) else output)
+
+
+def run(args: list[str], check: bool = False, **kwargs: Any) -> subprocess.CompletedProcess:
+    """
+    Like subprocess.run, recording a command span with the arguments, exit code and output size.
+
+    If the output is not captured (or redirected), it's passed through to count it, unless it goes to a terminal.
+    """
+    args = [str(arg) for arg in args]
+    with span(pathlib.Path(args[0]).name, kind="command", args=args) as current:
+        if not is_active():
+            return subprocess.run(args, check=check, **kwargs)
+
+        kwargs["env"] = {**(kwargs.get("env") or os.environ), PARENT_ENV: current.span_id}
+        if kwargs.get("capture_output") or "stdout" in kwargs or "input" in kwargs:
+            result = subprocess.run(args, **kwargs)
+            current.attributes["output_bytes"] = _size(result.stdout) + _size(result.stderr)
+        elif sys.stdout.isatty():
+            # so they still see the terminal, ex. for the colors of helmfile diff
+            result = subprocess.run(args, **kwargs)
+        else:
+            output_bytes = 0
+            # what was printed so far goes before the output of the command
+            sys.stdout.flush()
+            with subprocess.Popen(args, stdout=subprocess.PIPE, **kwargs) as process:
+                assert process.stdout is not None
+                while chunk := os.read(process.stdout.fileno(), 65536):
+                    output_bytes += len(chunk)
+                    sys.stdout.buffer.write(chunk)
+                    sys.stdout.buffer.flush()
+            result = subprocess.CompletedProcess(args=args, returncode=process.returncode)
+            current.attributes["output_bytes"] = output_bytes
+
+        current.attributes["exit_code"] = result.returncode
+    if check:
+        result.check_returncode()
+    return result
+
+
+def get_api_path_key(method: str, path: str) -> str:
+    """'GET /apis/tekton.dev/v1/namespaces/image-build/taskruns/x' -> 'GET taskruns'."""
+    segments = path.split("?")[0].strip("/").split("/")
+    # skip /api/<version> or /apis/<group>/<version>
+    segments = segments[2:] if segments[0] == "api" else segments[3:]
+    if len(segments) > 2 and segments[0] == "namespaces":
+        segments = segments[2:]
+    if not segments:
+        return f"{method} discovery"
+    resource = segments[0]
+    if len(segments) > 2:
+        resource += f"/{segments[2]}"
+    return f"{method} {resource}"
+
+
+def record_api_call(method: str, path: str, seconds: float) -> None:
+    """Accounts an api call of the current process, see get_api_calls."""
+    key = get_api_path_key(method=method, path=path)
+    with _api_calls_lock:
+        _api_calls[key] += 1
+        _api_seconds[key] += seconds
+
+
+def get_api_calls() -> dict[str, Any]:
+    with _api_calls_lock:
+        return {
+            "api_calls": dict(_api_calls),
+            "api_seconds": {key: round(seconds, 3) for key, seconds in _api_seconds.items()},
+        }
+
+
+def load_spans(path: pathlib.Path) -> list[dict[str, Any]]:
+    spans = []
+    for line in path.read_text().splitlines():
+        try:
+            spans.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return sorted(spans, key=lambda span: span["start"])
+
+
+def get_children(spans: list[dict[str, Any]]) -> dict[str | None, list[dict[str, Any]]]:
+    """parent span id -> child spans, the spans with their parent missing (ex. killed) are under None."""
+    span_ids = {span["span_id"] for span in spans}
+    children: dict[str | None, list[dict[str, Any]]] = collections.defaultdict(list)
+    for span in spans:
+        parent_id = span.get("parent_id")
+        children[parent_id if parent_id in span_ids else None].append(span)
+    return children
+
+
+def get_span_name(span: dict[str, Any]) -> str:
+    """The name of the span, with the subcommand for the commands, ex. 'kubectl get'."""
+    args = span.get("attributes", {}).get("args") or []
+    verb = next((arg for arg in args[1:] if arg in VERBS), None) if span["kind"] == "command" else None
+    return f"{span['name']} {verb}" if verb else span["name"]
+
+
+def get_span_label(span: dict[str, Any]) -> str:
+    attributes = span.get("attributes", {})
+    label = get_span_name(span)
+    if span["kind"] == "command" and attributes.get("args"):
+        label = " ".join(attributes["args"])
+    if attributes.get("exit_code"):
+        label += f" (exit code {attributes['exit_code']})"
+    if attributes.get("error"):
+        label += f" ({attributes['error']})"
+    if attributes.get("api_calls"):
+        label += f" ({sum(attributes['api_calls'].values())} api calls)"
+    return label
+
+
+def show_tree(spans: list[dict[str, Any]], width: int, max_depth: int) -> None:
+    """Each span with its duration and, to the left, when it ran within the whole trace."""
+    if not spans:
+        return
+    children = get_children(spans)
+    trace_start = min(span["start"] for span in spans)
+    trace_duration = max(max(span["end"] for span in spans) - trace_start, 0.001)
+
+    def show(span: dict[str, Any], depth: int) -> None:
+        offset = int((span["start"] - trace_start) / trace_duration * width)
+        length = max(1, round((span["end"] - span["start"]) / trace_duration * width))
+        bar = (" " * offset + "#" * length)[:width].ljust(width)
+        label = get_span_label(span)
+        print(f"|{bar}| {span['end'] - span['start']:8.1f}s {'  ' * depth}{label[:200]}")
+        if depth + 1 < max_depth:
+            for child in children.get(span["span_id"], []):
+                show(child, depth + 1)
+
+    for root in children[None]:
+        show(root, 0)
+
+
+def show_totals(spans: list[dict[str, Any]]) -> None:
+    """The time, runs, failures and output of each command (and verb), and the api calls of the python scripts."""
+    totals: dict[str, dict[str, float]] = collections.defaultdict(collections.Counter)
+    api_calls: collections.Counter[str] = collections.Counter()
+    api_seconds: collections.Counter[str] = collections.Counter()
+    for span in spans:
+        attributes = span.get("attributes", {})
+        api_calls.update(attributes.get("api_calls", {}))
+        api_seconds.update(attributes.get("api_seconds", {}))
+        if span["kind"] != "command":
+            continue
+        total = totals[get_span_name(span)]
+        total["runs"] += 1
+        total["seconds"] += span["end"] - span["start"]
+        total["failed"] += 1 if attributes.get("exit_code") else 0
+        total["output_bytes"] += attributes.get("output_bytes", 0)
+
+    if totals:
+        print(f"{'command':30} {'runs':>6} {'failed':>6} {'total(s)':>9} {'avg(s)':>7} {'output(KB)':>10}")
+    for name, total in sorted(totals.items(), key=lambda item: item[1]["seconds"], reverse=True):
+        print(
+            f"{name:30} {total['runs']:>6} {total['failed']:>6} {total['seconds']:>9.1f} "
+            f"{total['seconds'] / total['runs']:>7.2f} {total['output_bytes'] / 1024:>10.1f}"
+        )
+    if api_calls:
+        print(f"{'api call':30} {'calls':>6} {'':>6} {'total(s)':>9} {'avg(s)':>7}")
+        for key, calls in api_calls.most_common():
+            print(f"{key:30} {calls:>6} {'':>6} {api_seconds[key]:>9.1f} {api_seconds[key] / calls:>7.3f}")
+
+
+def show_folded(spans: list[dict[str, Any]]) -> None:
+    """Folded stacks ('root;child;grandchild <self time in ms>'), for flamegraph.pl or speedscope."""
+    children = get_children(spans)
+
+    def fold(span: dict[str, Any], stack: str) -> None:
+        name = get_span_name(span).replace(";", ":")
+        stack = f"{stack};{name}" if stack else name
+        own_children = children.get(span["span_id"], [])
+        # the children might run in parallel, so the self time can't go under 0
+        self_time = (span["end"] - span["start"]) - sum(child["end"] - child["start"] for child in own_children)
+        if self_time > 0:
+            print(f"{stack} {round(self_time * 1000)}")
+        for child in own_children:
+            fold(child, stack)
+
+    for root in children[None]:
+        fold(root, "")
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    return {"stringValue": json.dumps(value)}
+
+
+def to_otlp_logs(spans: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    The spans as OTLP logs (the json encoding), as the infra-tracing collector is Loki. Each span is a log record with
+    its trace and span ids, and its name, kind, parent, duration and attributes as attributes.
+    """
+    records = []
+    for span in spans:
+        attributes = {
+            "span.name": span["name"],
+            "span.kind": span["kind"],
+            "span.parent_id": span.get("parent_id") or "",
+            "span.duration_seconds": round(span["end"] - span["start"], 6),
+            **span.get("attributes", {}),
+        }
+        records.append(
+            {
+                "timeUnixNano": str(int(span["start"] * 1e9)),
+                "observedTimeUnixNano": str(int(span["end"] * 1e9)),
+                "severityText": "ERROR" if span.get("attributes", {}).get("exit_code") else "INFO",
+                "body": {"stringValue": get_span_label(span)},
+                "traceId": span.get("trace_id") or "",
+                "spanId": span["span_id"],
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+            }
+        )
+    return {
+        "resourceLogs": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "toolforge-deploy"}}]},
+                "scopeLogs": [{"scope": {"name": "toolforge-deploy.tracing"}, "logRecords": records}],
+            }
+        ]
+    }
+
+
+def export(spans: list[dict[str, Any]], endpoint: str, ca: str | None = None) -> None:
+    # requests is not needed for anything else here, and the bash scripts only need it for this
+    import requests
+
+    verify: bool | str = True if not ca else False if ca == "no" else ca
+    response = requests.post(endpoint, json=to_otlp_logs(spans), verify=verify, timeout=30)
+    response.raise_for_status()
+
+
+def export_from_env(path: pathlib.Path) -> None:
+    """Exports the trace to $TOOLFORGE_DEPLOY_TRACE_OTLP_ENDPOINT, failing to do so only warns."""
+    try:
+        export(load_spans(path), endpoint=os.environ[OTLP_ENDPOINT_ENV], ca=os.environ.get(OTLP_CA_ENV))
+    except Exception as error:
+        print(f"WARNING: unable to export the trace {path}: {error}", file=sys.stderr)
+        return
+    print(f"Exported the trace {path}", file=sys.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    show_parser = subparsers.add_parser("show", help="Show the spans of the trace as a tree, and the command totals.")
+    show_parser.add_argument("trace", type=pathlib.Path)
+    show_parser.add_argument("--folded", action="store_true", help="Print folded stacks instead (for flame graphs).")
+    show_parser.add_argument("--width", type=int, default=40, help="Width of the time bars (default: 40).")
+    show_parser.add_argument("--max-depth", type=int, default=10, help="Levels of spans to show (default: 10).")
+    export_parser = subparsers.add_parser("export", help="Send the spans of the trace to an OTLP logs endpoint.")
+    export_parser.add_argument("trace", type=pathlib.Path)
+    export_parser.add_argument(
+        "--endpoint",
+        default=os.environ.get(OTLP_ENDPOINT_ENV),
+        help=f"OTLP/HTTP logs endpoint, with the credentials if any (default: ${OTLP_ENDPOINT_ENV}).",
+    )
+    export_parser.add_argument(
+        "--ca",
+        default=os.environ.get(OTLP_CA_ENV),
+        help=f"CA bundle to verify the endpoint certificate, or 'no' to not verify it (default: ${OTLP_CA_ENV}).",
+    )
+    args = parser.parse_args()
+
+    spans = load_spans(args.trace)
+    if args.action == "export":
+        if not args.endpoint:
+            parser.error(f"no --endpoint passed and no ${OTLP_ENDPOINT_ENV} set")
+        export(spans, endpoint=args.endpoint, ca=args.ca)
+        print(f"Exported {len(spans)} spans to {args.endpoint.split('@')[-1]}")
+    elif args.folded:
+        show_folded(spans)
+    else:
+        show_tree(spans, width=args.width, max_depth=args.max_depth)
+        print()
+        show_totals(spans)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
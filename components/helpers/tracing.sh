@@ -0,0 +1,237 @@
+# shellcheck shell=bash
+#
+# Tracing of the bash scripts, the counterpart of tracing.py (see there for the format of the trace files and how to
+# show or export them). Source it, start the span of the script with trace_script, and wrap the stages with
+# trace_stage and the external commands (kubectl, helm, helmfile...) with trace_run:
+#
+#     source "$BASE_DIR/components/helpers/tracing.sh"
+#     trace_script "$@"
+#     ...
+#     trace_stage "deploy $component" deploy_component "$component"
+#     ...
+#     trace_run helmfile --file helmfile.yaml sync
+#
+# The spans left open when the script (or a subshell) exits, ex. by errexit, are ended by an EXIT trap, so don't set
+# another one. Everything runs as usual, without tracing, with TOOLFORGE_DEPLOY_TRACE=off or if there's no jq. Only the
+# last $TOOLFORGE_DEPLOY_TRACE_KEEP (default 100) traces are kept, the older ones are removed when a new one starts.
+
+TRACING_HELPERS_DIR="$(dirname "$(realpath "${BASH_SOURCE[0]}")")"
+# the open spans of this shell and its parents: "<span id>|<parent id>|<start>|<shell pid>|<kind>|<name>|<attributes>"
+_TRACE_OPEN_SPANS=()
+# the pid of the shell that started the trace, if it's this script
+_TRACE_STARTED_BY=""
+
+
+_trace_active() {
+    [[ "${TOOLFORGE_DEPLOY_TRACE:-on}" != "off" && -n "${TOOLFORGE_DEPLOY_TRACE_FILE:-}" ]]
+}
+
+
+# sets the given variable to a new span id, without forking (this runs for every command), the pid keeps them unique
+# for the subshells that got the same $RANDOM seed
+_trace_new_span_id() {
+    printf -v "${1?}" '%08x%04x%04x' "$BASHPID" "$RANDOM" "$RANDOM"
+}
+
+
+# sets the given variable to the epoch seconds with microseconds, EPOCHREALTIME is not in older bash versions
+_trace_now() {
+    if [[ -n "${EPOCHREALTIME:-}" ]]; then
+        # some locales use a comma as decimal separator
+        printf -v "${1?}" '%s' "${EPOCHREALTIME/,/.}"
+    else
+        printf -v "${1?}" '%s' "$(date +%s.%N)"
+    fi
+}
+
+
+# appends a span to the trace file: kind name span_id parent_id start end attributes_json extra_attributes_json
+# [args...], the args are added as the args attribute (split by lines)
+_trace_write() {
+    local line args_lines=""
+
+    if [[ $# -gt 8 ]]; then
+        printf -v args_lines '%s\n' "${@:9}"
+    fi
+    line=$(
+        jq -c -n \
+            --arg trace_id "${TOOLFORGE_DEPLOY_TRACE_ID:-}" \
+            --arg kind "$1" \
+            --arg name "$2" \
+            --arg span_id "$3" \
+            --arg parent_id "$4" \
+            --argjson start_time "$5" \
+            --argjson end_time "$6" \
+            --argjson attributes "$7" \
+            --argjson extra_attributes "$8" \
+            --arg args_lines "$args_lines" \
+            '{
+                trace_id: $trace_id,
+                span_id: $span_id,
+                parent_id: (if $parent_id == "" then null else $parent_id end),
+                kind: $kind,
+                name: $name,
+                start: $start_time,
+                "end": $end_time,
+                attributes: (
+                    $attributes
+                    + (if $args_lines == "" then {} else {args: ($args_lines | rtrimstr("\n") | split("\n"))} end)
+                    + $extra_attributes
+                )
+            }'
+    ) || return 0
+    # a single write per line, so the deployments running in parallel don't mix their lines
+    printf '%s\n' "$line" >>"$TOOLFORGE_DEPLOY_TRACE_FILE"
+}
+
+
+# starts a span nested in the current one: kind name [attributes_json]
+_trace_push() {
+    local kind="${1?}"
+    local name="${2?}"
+    local attributes="${3:-"{}"}"
+    local span_id start
+
+    _trace_new_span_id span_id
+    _trace_now start
+    _TRACE_OPEN_SPANS+=("$span_id|${TOOLFORGE_DEPLOY_TRACE_PARENT:-}|$start|$BASHPID|$kind|$name|$attributes")
+    export TOOLFORGE_DEPLOY_TRACE_PARENT="$span_id"
+    # (re)set for the subshells, they don't get the traps of their parent
+    trap '_trace_on_exit $?' EXIT
+}
+
+
+# ends the current span: exit_code
+_trace_pop() {
+    local exit_code="${1?}"
+    local span_id parent_id start pid kind name attributes end
+
+    IFS='|' read -r span_id parent_id start pid kind name attributes <<<"${_TRACE_OPEN_SPANS[-1]}"
+    unset "_TRACE_OPEN_SPANS[-1]"
+    export TOOLFORGE_DEPLOY_TRACE_PARENT="$parent_id"
+    _trace_now end
+    _trace_write "$kind" "$name" "$span_id" "$parent_id" "$start" "$end" "$attributes" "{\"exit_code\": $exit_code}"
+}
+
+
+# ends the spans this shell left open and, if it started it, the trace
+_trace_on_exit() {
+    local exit_code="${1?}"
+    local pid
+
+    while [[ ${#_TRACE_OPEN_SPANS[@]} -gt 0 ]]; do
+        IFS='|' read -r _ _ _ pid _ <<<"${_TRACE_OPEN_SPANS[-1]}"
+        # a subshell leaves the spans of its parent alone
+        [[ "$pid" == "$BASHPID" ]] || break
+        _trace_pop "$exit_code"
+    done
+
+    if [[ "$_TRACE_STARTED_BY" == "$BASHPID" ]]; then
+        echo "Trace written, see it with: $TRACING_HELPERS_DIR/tracing.py show $TOOLFORGE_DEPLOY_TRACE_FILE" >&2
+        if [[ -n "${TOOLFORGE_DEPLOY_TRACE_OTLP_ENDPOINT:-}" ]]; then
+            python3 "$TRACING_HELPERS_DIR/tracing.py" export "$TOOLFORGE_DEPLOY_TRACE_FILE" >&2 \
+            || echo "WARNING: unable to export the trace $TOOLFORGE_DEPLOY_TRACE_FILE" >&2
+        fi
+    fi
+}
+
+
+# removes the oldest traces of the given dir, leaving room for a new one within the last $TOOLFORGE_DEPLOY_TRACE_KEEP
+# (see tracing.py prune)
+_trace_prune() {
+    local traces_dir="${1?}"
+    local keep=$((${TOOLFORGE_DEPLOY_TRACE_KEEP:-100} - 1))
+    # the names start with the date, so the glob sorts them from the oldest
+    local traces=("$traces_dir"/*.jsonl)
+
+    if [[ -e "${traces[0]}" && ${#traces[@]} -gt $keep ]]; then
+        rm -f "${traces[@]:0:${#traces[@]}-keep}"
+    fi
+}
+
+
+# starts the span of the whole script, ended when it exits, and a new trace if it's not run from a traced script
+trace_script() {
+    local args_lines=""
+
+    if [[ "${TOOLFORGE_DEPLOY_TRACE:-on}" == "off" ]] || ! command -v jq >/dev/null; then
+        return 0
+    fi
+
+    if [[ -z "${TOOLFORGE_DEPLOY_TRACE_FILE:-}" ]]; then
+        TOOLFORGE_DEPLOY_TRACE_FILE="${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/traces"
+        TOOLFORGE_DEPLOY_TRACE_FILE+="/$(date +%Y%m%d-%H%M%S)-$(basename "$0").jsonl"
+        mkdir -p "$(dirname "$TOOLFORGE_DEPLOY_TRACE_FILE")"
+        _trace_prune "$(dirname "$TOOLFORGE_DEPLOY_TRACE_FILE")"
+        _TRACE_STARTED_BY="$BASHPID"
+    fi
+    export TOOLFORGE_DEPLOY_TRACE_FILE
+    if [[ -z "${TOOLFORGE_DEPLOY_TRACE_ID:-}" ]]; then
+        TOOLFORGE_DEPLOY_TRACE_ID=$(od -An -N16 -tx1 /dev/urandom | tr -d ' \n')
+    fi
+    export TOOLFORGE_DEPLOY_TRACE_ID
+    # not with jq --args, older versions take the ones looking like options (ex. --force) as theirs
+    if [[ $# -gt 0 ]]; then
+        printf -v args_lines '%s\n' "$@"
+    fi
+    _trace_push script "$(basename "$0")" \
+        "$(jq -c -n --arg args_lines "$args_lines" '{args: ($args_lines | rtrimstr("\n") | split("\n"))}')"
+}
+
+
+# runs the given function (in this shell) or command as a stage: name command [args...]
+trace_stage() {
+    local name="${1?}"
+    shift
+    local exit_code
+
+    if ! _trace_active; then
+        "$@"
+        return
+    fi
+
+    _trace_push stage "$name"
+    "$@"
+    # only reached on failure if errexit is off or ignored, otherwise the exit trap ends the span
+    exit_code=$?
+    _trace_pop "$exit_code"
+    return "$exit_code"
+}
+
+
+# runs an external command (kubectl, helm, helmfile...) recording its arguments, exit code and, if it's not going to
+# the terminal, the size of its output: command [args...]
+trace_run() {
+    local span_id start end exit_code output_bytes="null" tmp_dir
+
+    if ! _trace_active; then
+        "$@"
+        return
+    fi
+
+    _trace_new_span_id span_id
+    _trace_now start
+    if [[ -t 1 ]]; then
+        # so they still see the terminal, ex. for the colors of helmfile diff
+        if TOOLFORGE_DEPLOY_TRACE_PARENT="$span_id" "$@"; then exit_code=0; else exit_code=$?; fi
+    else
+        tmp_dir=$(mktemp -d)
+        # errexit (with pipefail) would stop us before recording the span, so the exit code goes through a file, and
+        # the output is counted as it goes through (waiting for wc to write the count, the wait needs bash >= 4.4)
+        {
+            if TOOLFORGE_DEPLOY_TRACE_PARENT="$span_id" "$@"; then exit_code=0; else exit_code=$?; fi
+            echo "$exit_code" >"$tmp_dir/exit_code"
+        } | {
+            tee >(wc -c >"$tmp_dir/output_bytes")
+            wait $! 2>/dev/null || :
+        }
+        exit_code=$(<"$tmp_dir/exit_code")
+        read -r output_bytes <"$tmp_dir/output_bytes" || output_bytes="null"
+        rm -rf "$tmp_dir"
+    fi
+
+    _trace_now end
+    _trace_write command "$(basename "$1")" "$span_id" "${TOOLFORGE_DEPLOY_TRACE_PARENT:-}" "$start" "$end" "{}" \
+        "{\"exit_code\": $exit_code, \"output_bytes\": $output_bytes}" "$@"
+    return "$exit_code"
+}
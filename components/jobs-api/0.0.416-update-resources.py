@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Moves the jobs still using the old default cpu resources (500m limit and request) to the new ones.
+
+Instead of going namespace by namespace, this lists the cronjobs and deployments of all the jobs in the whole cluster
+with two (paginated) calls, picks the ones with the old defaults in memory and sends one json patch for each, in
+parallel (see --concurrency and --max-rps).
+
+Each patch tests that the values are still the old defaults, so jobs changed in the meantime are left alone.
+
+Use --dry-run to get the report of what would change without patching anything (--report to save it as json).
+
+With --watch, after the sweep it keeps watching the cronjobs and deployments of the jobs from the resourceVersion of
+the sweep lists, and corrects the ones created or modified with the old defaults within seconds, printing the counters
+of events seen and objects patched every --stats-interval seconds. Errors (apiserver or connection ones) are retried
+with a growing delay, resuming the watch where it stopped.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any
+
+import click
+import requests
+
+
+CURDIR = pathlib.Path(__file__).parent
+BASEDIR = CURDIR.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_client import K8sError, ListResult, get_client, resource_path  # noqa: E402
+from k8s_executor import RateLimitedExecutor  # noqa: E402
+
+
+OLD_DEFAULT_CPU = "500m"
+NEW_CPU_LIMIT = "1000m"
+NEW_CPU_REQUEST = "100m"
+# seconds to wait before retrying a failed watch, doubled on each consecutive error
+WATCH_RETRY_DELAY = 1.0
+WATCH_MAX_RETRY_DELAY = 60.0
+# plural -> api version, component label (the only label all the jobs have), path to the resources of the (first)
+# container
+KINDS = {
+    "cronjobs": (
+        "batch/v1",
+        "app.kubernetes.io/component=cronjobs",
+        "/spec/jobTemplate/spec/template/spec/containers/0/resources",
+    ),
+    "deployments": (
+        "apps/v1",
+        "app.kubernetes.io/component=deployments",
+        "/spec/template/spec/containers/0/resources",
+    ),
+}
+
+
+def get_resources(k8s_object: dict[str, Any], plural: str) -> dict[str, Any]:
+    value: Any = k8s_object
+    for key in KINDS[plural][2].strip("/").split("/"):
+        try:
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        except (KeyError, IndexError):
+            return {}
+    return value or {}
+
+
+def has_cpu_default_limit(resources: dict[str, Any]) -> bool:
+    return (
+        resources.get("limits", {}).get("cpu") == OLD_DEFAULT_CPU
+        and resources.get("requests", {}).get("cpu") == OLD_DEFAULT_CPU
+    )
+
+
+def get_patch(plural: str) -> list[dict[str, Any]]:
+    resources_path = KINDS[plural][2]
+    return [
+        # fail if someone changed them since we listed them
+        {"op": "test", "path": f"{resources_path}/limits/cpu", "value": OLD_DEFAULT_CPU},
+        {"op": "test", "path": f"{resources_path}/requests/cpu", "value": OLD_DEFAULT_CPU},
+        {"op": "replace", "path": f"{resources_path}/limits/cpu", "value": NEW_CPU_LIMIT},
+        {"op": "replace", "path": f"{resources_path}/requests/cpu", "value": NEW_CPU_REQUEST},
+    ]
+
+
+def needs_patch(k8s_object: dict[str, Any], plural: str) -> bool:
+    return k8s_object["metadata"]["namespace"].startswith("tool-") and has_cpu_default_limit(
+        get_resources(k8s_object=k8s_object, plural=plural)
+    )
+
+
+def patch_object(k8s_object: dict[str, Any], plural: str) -> dict[str, Any]:
+    path = resource_path(
+        KINDS[plural][0],
+        plural,
+        namespace=k8s_object["metadata"]["namespace"],
+        name=k8s_object["metadata"]["name"],
+    )
+    return get_client().patch(path=path, body=get_patch(plural=plural), patch_type="json")
+
+
+def list_objects(plural: str) -> ListResult:
+    """All the jobs objects of the given kind in the cluster, with one paginated call."""
+    api_version, selector, _ = KINDS[plural]
+    return get_client().list(resource_path(api_version, plural), label_selector=selector)
+
+
+def describe(k8s_object: dict[str, Any], plural: str) -> str:
+    return f"{plural}/{k8s_object['metadata']['name']} (ns:{k8s_object['metadata']['namespace']})"
+
+
+def sweep(plural: str, dry_run: bool, executor: RateLimitedExecutor, to_patch: list[dict[str, str]]) -> str:
+    """Patches all the objects of the given kind that need it, returns the resourceVersion of the list."""
+    result = list_objects(plural=plural)
+    for k8s_object in result.items:
+        if not needs_patch(k8s_object=k8s_object, plural=plural):
+            continue
+
+        to_patch.append(
+            {"kind": plural, "namespace": k8s_object["metadata"]["namespace"], "name": k8s_object["metadata"]["name"]}
+        )
+        click.echo(
+            f"  {'would patch' if dry_run else 'patching'} {describe(k8s_object=k8s_object, plural=plural)}: "
+            f"cpu limit {OLD_DEFAULT_CPU} -> {NEW_CPU_LIMIT}, cpu request {OLD_DEFAULT_CPU} -> {NEW_CPU_REQUEST}"
+        )
+        if not dry_run:
+            name = describe(k8s_object=k8s_object, plural=plural)
+            executor.submit(name, patch_object, k8s_object=k8s_object, plural=plural)
+
+    return result.resource_version
+
+
+class Watcher:
+    """
+    Keeps correcting the objects of one kind as they get created or modified.
+
+    Starts watching from the resourceVersion of the sweep list, keeps it up to date with the events (and bookmarks) to
+    resume the watch when the apiserver closes it or it fails, and does a new sweep if it's too old (410 Gone).
+    """
+
+    def __init__(self, plural: str, resource_version: str, executor: RateLimitedExecutor) -> None:
+        self.plural = plural
+        self.resource_version = resource_version
+        self.executor = executor
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+        # objects with a patch on the way, so the events in the meantime don't send it again
+        self._pending: set[str] = set()
+        # resourceVersion of the objects after our patch, the events queued before it landed are older and skipped
+        self._patched: dict[str, int] = {}
+
+    def _patch(self, k8s_object: dict[str, Any]) -> None:
+        name = describe(k8s_object=k8s_object, plural=self.plural)
+        try:
+            patched = patch_object(k8s_object=k8s_object, plural=self.plural)
+            with self._lock:
+                self.counters["patched"] += 1
+                self._patched[name] = int(patched["metadata"]["resourceVersion"])
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def handle(self, event: dict[str, Any]) -> None:
+        with self._lock:
+            self.counters[event["type"].lower()] += 1
+        self.resource_version = event["object"]["metadata"]["resourceVersion"]
+        if event["type"] == "DELETED":
+            with self._lock:
+                self._patched.pop(describe(k8s_object=event["object"], plural=self.plural), None)
+        if event["type"] not in ("ADDED", "MODIFIED"):
+            return
+        if not needs_patch(k8s_object=event["object"], plural=self.plural):
+            return
+
+        name = describe(k8s_object=event["object"], plural=self.plural)
+        with self._lock:
+            if name in self._pending:
+                return
+            # resourceVersions are only comparable for the same object, good enough to tell the states before our patch
+            if int(self.resource_version) <= self._patched.get(name, 0):
+                self.counters["stale"] += 1
+                return
+            self._pending.add(name)
+
+        click.echo(f"  patching {name}")
+        self.executor.submit(name, self._patch, k8s_object=event["object"])
+
+    def run(self) -> None:
+        api_version, selector, _ = KINDS[self.plural]
+        retry_delay = WATCH_RETRY_DELAY
+        while True:
+            try:
+                if not self.resource_version:
+                    self.resource_version = sweep(
+                        plural=self.plural, dry_run=False, executor=self.executor, to_patch=[]
+                    )
+                for event in get_client().watch(
+                    resource_path(api_version, self.plural),
+                    resource_version=self.resource_version,
+                    label_selector=selector,
+                ):
+                    self.handle(event=event)
+                    retry_delay = WATCH_RETRY_DELAY
+                continue
+            except K8sError as error:
+                if error.status_code == 410:
+                    click.echo(f"  the {self.plural} watch expired (410 Gone), doing a full sweep again")
+                    with self._lock:
+                        self.counters["resyncs"] += 1
+                    self.resource_version = ""
+                    continue
+                message = str(error)
+            except (requests.RequestException, json.JSONDecodeError) as error:
+                # ex. the connection dropped in the middle of the stream
+                message = f"{error.__class__.__name__}: {error}"
+
+            click.echo(f"  the {self.plural} watch failed ({message}), retrying in {retry_delay:.0f}s", err=True)
+            with self._lock:
+                self.counters["errors"] += 1
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+
+
+def watch(resource_versions: dict[str, str], executor: RateLimitedExecutor, stats_interval: float) -> None:
+    watchers = [
+        Watcher(plural=plural, resource_version=resource_version, executor=executor)
+        for plural, resource_version in resource_versions.items()
+    ]
+    threads = [threading.Thread(target=watcher.run, daemon=True) for watcher in watchers]
+    for thread in threads:
+        thread.start()
+
+    click.echo("### Watching for new or modified jobs with the old defaults (ctrl+c to stop)...")
+    try:
+        while all(thread.is_alive() for thread in threads):
+            time.sleep(stats_interval)
+            for watcher in watchers:
+                click.echo(f"  {watcher.plural}: {dict(watcher.counters)}")
+    except KeyboardInterrupt:
+        pass
+
+    for watcher in watchers:
+        click.echo(f"{watcher.plural}: {dict(watcher.counters)}")
+    if not all(thread.is_alive() for thread in threads):
+        click.echo("A watch stopped unexpectedly, see the errors above.")
+        sys.exit(1)
+
+
+@click.command(help=__doc__)
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be patched.")
+@click.option(
+    "--report",
+    "report_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Also write the list of objects to patch (or patched) and the failures to this json file.",
+)
+@click.option("--concurrency", default=8, show_default=True, help="How many objects to patch in parallel.")
+@click.option("--max-rps", default=10.0, show_default=True, help="Maximum patch requests per second (0 for no limit).")
+@click.option(
+    "--watch",
+    "watch_mode",
+    is_flag=True,
+    default=False,
+    help="After the sweep, keep running and correct the jobs as they are created or modified.",
+)
+@click.option(
+    "--stats-interval",
+    default=60.0,
+    show_default=True,
+    help="How often to print the event counters in --watch mode, in seconds.",
+)
+def main(
+    dry_run: bool,
+    report_path: pathlib.Path | None,
+    concurrency: int,
+    max_rps: float,
+    watch_mode: bool,
+    stats_interval: float,
+) -> None:
+    if dry_run:
+        click.echo("DRY-RUN")
+        if watch_mode:
+            raise click.UsageError("--watch can't be used with --dry-run")
+
+    to_patch: list[dict[str, str]] = []
+    executor = RateLimitedExecutor(concurrency=concurrency, max_rps=max_rps, label="objects")
+    resource_versions = {}
+    for plural in KINDS:
+        click.echo(f"### Checking all the {plural}...")
+        resource_versions[plural] = sweep(plural=plural, dry_run=dry_run, executor=executor, to_patch=to_patch)
+
+    if watch_mode:
+        # the executor keeps running for the patches triggered by the watches
+        watch(resource_versions=resource_versions, executor=executor, stats_interval=stats_interval)
+
+    failures = executor.wait()
+    click.echo(f"{len(to_patch)} objects {'to patch' if dry_run else 'patched'}, {len(failures)} failed")
+    if report_path:
+        report = {
+            "dry_run": dry_run,
+            "objects": to_patch,
+            "failures": [{"name": failure.name, "error": str(failure.error)} for failure in failures],
+        }
+        report_path.write_text(json.dumps(report, indent=2))
+        click.echo(f"Report written to {report_path}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    with tracing.script_span(__file__):
+        main()
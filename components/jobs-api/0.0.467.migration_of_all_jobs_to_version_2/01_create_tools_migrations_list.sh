@@ -5,16 +5,20 @@ set -o pipefail
 set -o nounset
 
 LOG_FILE="$HOME/tools-migration/tools_migration.log"
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+# shellcheck source=SCRIPTDIR/../../helpers/tracing.sh
+source "$SCRIPT_DIR/../../helpers/tracing.sh"
 
 mkdir -p "$(dirname "$LOG_FILE")"
 exec > >(tee -a "$LOG_FILE") 2>&1
 
 OUTPUT_FILE="${1:-$HOME/tools-migration/tools_migration_list.txt}"
+trace_script "$@"
 
 mkdir -p "$(dirname "$OUTPUT_FILE")"
 
-CRONJOBS=$(kubectl get cronjobs -A -l app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1,app.kubernetes.io/component=cronjobs -o jsonpath='{range .items[*]}{.metadata.namespace}{"\n"}{end}')
-DEPLOYMENTS=$(kubectl get deployments -A -l app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1,app.kubernetes.io/component=deployments -o jsonpath='{range .items[*]}{.metadata.namespace}{"\n"}{end}')
+CRONJOBS=$(trace_run kubectl get cronjobs -A -l app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1,app.kubernetes.io/component=cronjobs -o jsonpath='{range .items[*]}{.metadata.namespace}{"\n"}{end}')
+DEPLOYMENTS=$(trace_run kubectl get deployments -A -l app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1,app.kubernetes.io/component=deployments -o jsonpath='{range .items[*]}{.metadata.namespace}{"\n"}{end}')
 
 TOOLS=$(echo -e "${CRONJOBS}\n${DEPLOYMENTS}" | sed 's/^tool-//' | sed '/^$/d' | sort | uniq)
 
@@ -9,6 +9,8 @@ SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 TOOLS_MIGRATION_LIST="${1:-$HOME/tools-migration/tools_migration_list.txt}"
 SOURCE_REMOVE_ONE_OFF_SCRIPT="${SCRIPT_DIR}/util_remove_one_off.py"
 REMOVE_ONE_OFF_SCRIPT="/tmp/util_remove_one_off.py"
+# shellcheck source=SCRIPTDIR/../../helpers/tracing.sh
+source "$SCRIPT_DIR/../../helpers/tracing.sh"
 
 mkdir -p "$(dirname "$LOG_FILE")"
 exec > >(tee -a "$LOG_FILE") 2>&1
@@ -27,6 +29,7 @@ fi
 cp "$SOURCE_REMOVE_ONE_OFF_SCRIPT" "$REMOVE_ONE_OFF_SCRIPT"
 
 
+trace_script "$@"
 PROJECT="$(cat /etc/wmcs-project)"
 
 while IFS= read -r tool_name; do
@@ -46,7 +49,7 @@ while IFS= read -r tool_name; do
     TOOL_DUMPS_DIR="$TOOL_HOME/.tools-migration/dumps"
     TOOL_OUTPUT_FILE="$TOOL_DUMPS_DIR/$tool_name.yaml"
 
-    if sudo -i -u "$TOOL_USER" -- bash -c "
+    if trace_run sudo -i -u "$TOOL_USER" -- bash -c "
         set -o errexit;
         set -o pipefail;
         set -o nounset;
@@ -6,6 +6,9 @@ set -o nounset
 
 LOG_FILE="$HOME/tools-migration/tools_migration.log"
 TOOLS_MIGRATION_LIST="${1:-$HOME/tools-migration/tools_migration_list.txt}"
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+# shellcheck source=SCRIPTDIR/../../helpers/tracing.sh
+source "$SCRIPT_DIR/../../helpers/tracing.sh"
 
 mkdir -p "$(dirname "$LOG_FILE")"
 
@@ -15,6 +18,7 @@ if [[ ! -f "$TOOLS_MIGRATION_LIST" ]]; then
 fi
 
 
+trace_script "$@"
 PROJECT="$(cat /etc/wmcs-project)"
 
 while IFS= read -r tool_name; do
@@ -35,7 +39,7 @@ while IFS= read -r tool_name; do
     TOOL_DUMPS_DIR="$TOOL_HOME/.tools-migration/dumps"
     TOOL_FILE_PATH="$TOOL_DUMPS_DIR/$tool_name.yaml"
 
-    if sudo -i -u "$TOOL_USER" -- bash -c "
+    if trace_run sudo -i -u "$TOOL_USER" -- bash -c "
         set -o errexit;
         set -o pipefail;
         set -o nounset;
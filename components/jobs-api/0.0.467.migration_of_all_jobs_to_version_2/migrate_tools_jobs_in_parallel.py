@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Migrates the jobs of all the tools in the migration list, several tools at a time.
+
+This does the same as 02_create_tools_jobs_dump.sh + 03_migrate_tool_jobs_to_latest_version.sh, but instead of going
+one tool at a time, it runs a bounded pool of workers, each taking a tool through these states:
+* dumped: `toolforge jobs dump` as the tool, saved to <workdir>/dumps/<tool>.yaml
+* filtered: one-off jobs removed in-process (see util_remove_one_off.py), saved to <workdir>/dumps/<tool>.filtered.yaml
+* loaded: filtered dump copied to the tool's ~/.tools-migration/dumps/<tool>.yaml and `toolforge jobs load`-ed
+* verified: there are no version 1 cronjobs/deployments left in the tool namespace
+
+Every state change is appended to <workdir>/state.jsonl, so re-running the script resumes each tool from where it was
+(use --from-scratch to ignore it), failed stages are retried with exponential backoff, and the calls to jobs-api (dump
+and load) are rate limited across all the workers.
+
+Each tool gets its own log in <workdir>/logs/<tool>.log, and a machine readable report with the final state, attempts,
+job counts and errors of every tool is written to <workdir>/report.json.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import pwd
+import random
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable
+
+import click
+
+
+CURDIR = pathlib.Path(__file__).parent
+BASEDIR = CURDIR.parent.parent.parent
+sys.path.insert(0, str(CURDIR))
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_client import get_client, resource_path  # noqa: E402
+from k8s_executor import RateLimitedExecutor, RateLimiter  # noqa: E402
+from util_remove_one_off import dump_jobs, is_oneoff, load_jobs  # noqa: E402
+
+
+DEFAULT_WORKDIR = pathlib.Path.home() / "tools-migration"
+STATES = ["pending", "dumped", "filtered", "loaded", "verified"]
+V1_SELECTOR = "app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1"
+
+
+@dataclass
+class ToolResult:
+    tool: str
+    state: str = "pending"
+    attempts: int = 0
+    dumped_jobs: int | None = None
+    removed_one_off_jobs: int | None = None
+    error: str | None = None
+    duration_seconds: float = 0.0
+
+
+class StateLog:
+    """Append-only log of the state of each tool, the last entry for a tool wins."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.states: dict[str, str] = {}
+        self._lock = threading.Lock()
+        if path.exists():
+            for line in path.read_text().splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # most likely a line half-written when the script got interrupted
+                    continue
+                self.states[entry["tool"]] = entry["state"]
+
+    def record(self, tool: str, state: str) -> None:
+        with self._lock:
+            with self.path.open("a") as state_fd:
+                state_fd.write(json.dumps({"tool": tool, "state": state, "time": time.time()}) + "\n")
+            self.states[tool] = state
+
+
+class ToolMigration:
+    def __init__(
+        self,
+        tool: str,
+        project: str,
+        workdir: pathlib.Path,
+        jobs_api_limiter: RateLimiter,
+        retries: int,
+        backoff: float,
+    ) -> None:
+        self.tool = tool
+        self.tool_user = f"{project}.{tool}"
+        self.dump_path = workdir / "dumps" / f"{tool}.yaml"
+        self.filtered_path = workdir / "dumps" / f"{tool}.filtered.yaml"
+        self.log_path = workdir / "logs" / f"{tool}.log"
+        self.jobs_api_limiter = jobs_api_limiter
+        self.retries = retries
+        self.backoff = backoff
+
+    def log(self, message: str) -> None:
+        with self.log_path.open("a") as log_fd:
+            log_fd.write(f"{time.strftime('%Y-%m-%dT%H:%M:%S')} {message}\n")
+
+    def run_as_tool(self, args: list[str], input: str | None = None) -> str:
+        # no login shell (sudo -i), we only need the tool's user and home
+        cmd = ["sudo", "--set-home", f"--user={self.tool_user}", "--", *args]
+        self.log(f"Running {cmd}")
+        result = tracing.run(cmd, input=input, capture_output=True, text=True)
+        self.log(f"stdout:\n{result.stdout}")
+        self.log(f"stderr:\n{result.stderr}")
+        if result.returncode != 0:
+            raise Exception(f"Error running {cmd} (exit code {result.returncode}), see {self.log_path}")
+
+        return result.stdout
+
+    def with_retries(self, stage: str, func: Callable[[], None], result: ToolResult) -> None:
+        for attempt in range(1, self.retries + 2):
+            result.attempts += 1
+            try:
+                func()
+                return
+            except Exception as error:
+                self.log(f"{stage} attempt {attempt} failed: {error}")
+                if attempt > self.retries:
+                    raise
+                # exponential backoff with some jitter, so the workers don't retry all at the same time
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def dump(self) -> None:
+        self.jobs_api_limiter.wait()
+        self.dump_path.write_text(self.run_as_tool(["toolforge", "jobs", "dump"]))
+
+    def filter(self, result: ToolResult) -> None:
+        jobs = load_jobs(self.dump_path.read_text())
+        if jobs is None:
+            jobs = []
+        if not isinstance(jobs, list):
+            raise Exception(f"The dump is not a list (got {type(jobs)}), see {self.dump_path}")
+
+        kept_jobs = [job for job in jobs if not is_oneoff(job)]
+        result.dumped_jobs = len(jobs)
+        result.removed_one_off_jobs = len(jobs) - len(kept_jobs)
+        self.log(f"Removed {result.removed_one_off_jobs} one-off jobs, keeping {len(kept_jobs)} jobs")
+        self.filtered_path.write_text(dump_jobs(kept_jobs))
+
+    def load(self) -> None:
+        tool_home = pathlib.Path(pwd.getpwnam(self.tool_user).pw_dir)
+        tool_dumps_dir = tool_home / ".tools-migration" / "dumps"
+        tool_file_path = tool_dumps_dir / f"{self.tool}.yaml"
+        self.jobs_api_limiter.wait()
+        # one sudo call to store the file where the sequential scripts did and load it
+        self.run_as_tool(
+            [
+                "bash",
+                "-c",
+                'set -o errexit; mkdir -p "$1"; cat > "$2"; toolforge jobs load "$2"',
+                "--",
+                str(tool_dumps_dir),
+                str(tool_file_path),
+            ],
+            input=self.filtered_path.read_text(),
+        )
+
+    def verify(self) -> None:
+        client = get_client()
+        leftovers = []
+        for plural in ["cronjobs", "deployments"]:
+            api_version = "batch/v1" if plural == "cronjobs" else "apps/v1"
+            path = resource_path(api_version, plural, namespace=f"tool-{self.tool}")
+            result = client.list(path, label_selector=V1_SELECTOR, metadata_only=True)
+            leftovers.extend(f"{plural}/{item['metadata']['name']}" for item in result.items)
+
+        if leftovers:
+            raise Exception(f"There are still version 1 jobs: {', '.join(leftovers)}")
+
+    def run(self, state_log: StateLog, result: ToolResult, until: str) -> None:
+        """Takes the tool from its current state to the `until` one."""
+        start = time.monotonic()
+        stages: dict[str, Callable[[], None]] = {
+            "dumped": self.dump,
+            "filtered": lambda: self.filter(result=result),
+            "loaded": self.load,
+            "verified": self.verify,
+        }
+        try:
+            for state, stage in stages.items():
+                if STATES.index(result.state) >= STATES.index(state):
+                    continue
+                if STATES.index(state) > STATES.index(until):
+                    break
+
+                self.log(f"Starting stage {state}")
+                with tracing.span(state, tool=self.tool):
+                    self.with_retries(stage=state, func=stage, result=result)
+                result.state = state
+                state_log.record(tool=self.tool, state=state)
+        except Exception as error:
+            result.error = str(error)
+            raise
+        finally:
+            result.duration_seconds = round(time.monotonic() - start, 3)
+
+
+def write_report(path: pathlib.Path, results: list[ToolResult], start: float) -> dict[str, Any]:
+    counts = {state: 0 for state in STATES}
+    for result in results:
+        counts[result.state] += 1
+
+    report = {
+        "duration_seconds": round(time.time() - start, 3),
+        "tools": len(results),
+        "failed": sum(1 for result in results if result.error),
+        "states": counts,
+        "results": [asdict(result) for result in sorted(results, key=lambda result: result.tool)],
+    }
+    path.write_text(json.dumps(report, indent=2))
+    return report
+
+
+@click.command(help=__doc__)
+@click.option(
+    "--tools-list",
+    type=click.Path(dir_okay=False, exists=True, path_type=pathlib.Path),
+    default=DEFAULT_WORKDIR / "tools_migration_list.txt",
+    show_default=True,
+    help="File with one tool name per line (see 01_create_tools_migrations_list.sh).",
+)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default=DEFAULT_WORKDIR,
+    show_default=True,
+    help="Where to store the dumps, the logs, the state and the report.",
+)
+@click.option("--concurrency", default=8, show_default=True, help="How many tools to migrate in parallel.")
+@click.option(
+    "--max-rps",
+    default=5.0,
+    show_default=True,
+    help="Maximum jobs-api calls (dump/load) per second across all the workers (0 for no limit).",
+)
+@click.option("--retries", default=3, show_default=True, help="How many times to retry a failed stage of a tool.")
+@click.option("--backoff", default=2.0, show_default=True, help="Seconds to wait before the first retry (doubles).")
+@click.option(
+    "--until",
+    type=click.Choice(STATES[1:]),
+    default="verified",
+    show_default=True,
+    help="Stop each tool at this state, ex. 'filtered' to only create the dumps.",
+)
+@click.option("--from-scratch", is_flag=True, default=False, help="Ignore the state of previous runs.")
+def main(
+    tools_list: pathlib.Path,
+    workdir: pathlib.Path,
+    concurrency: int,
+    max_rps: float,
+    retries: int,
+    backoff: float,
+    until: str,
+    from_scratch: bool,
+) -> None:
+    start = time.time()
+    for subdir in ["dumps", "logs"]:
+        (workdir / subdir).mkdir(parents=True, exist_ok=True)
+
+    project = pathlib.Path("/etc/wmcs-project").read_text().strip()
+    tools = sorted({line.strip() for line in tools_list.read_text().splitlines() if line.strip()})
+    state_log = StateLog(path=workdir / "state.jsonl")
+    if from_scratch:
+        state_log.states = {}
+
+    jobs_api_limiter = RateLimiter(max_rps=max_rps)
+    executor = RateLimitedExecutor(concurrency=concurrency, max_rps=0, label="tools")
+    results = []
+    for tool in tools:
+        result = ToolResult(tool=tool, state=state_log.states.get(tool, "pending"))
+        results.append(result)
+        if STATES.index(result.state) >= STATES.index(until):
+            continue
+
+        migration = ToolMigration(
+            tool=tool,
+            project=project,
+            workdir=workdir,
+            jobs_api_limiter=jobs_api_limiter,
+            retries=retries,
+            backoff=backoff,
+        )
+        executor.submit(tool, migration.run, state_log=state_log, result=result, until=until)
+
+    click.echo(f"Migrating {executor.submitted} tools ({len(tools) - executor.submitted} already at '{until}')")
+    executor.wait()
+    report_path = workdir / "report.json"
+    report = write_report(path=report_path, results=results, start=start)
+    click.echo(f"Tools per state: {report['states']}, report written to {report_path}")
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    with tracing.script_span(__file__):
+        main()
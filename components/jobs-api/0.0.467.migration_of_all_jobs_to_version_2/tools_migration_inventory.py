@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Keeps the list of tools that still have version 1 jobs up to date, cheaply enough to re-check it many times.
+
+Same output as 01_create_tools_migrations_list.sh (one tool name per line), but:
+* the first run lists only the metadata of the version 1 cronjobs and deployments (paginated), instead of the full
+  objects of the whole cluster
+* the objects found and the resourceVersion of each list are saved in an inventory file next to the output
+* the next runs only watch for the changes since that resourceVersion for a few seconds (objects created, migrated or
+  deleted in the meantime), falling back to a full list if it's too old for the apiserver (410 Gone)
+
+Use --full to force a full list.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import sys
+import time
+from collections import Counter
+from typing import Any
+
+import click
+
+
+CURDIR = pathlib.Path(__file__).parent
+BASEDIR = CURDIR.parent.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_client import K8sError, get_client, resource_path  # noqa: E402
+
+
+DEFAULT_OUTPUT_FILE = pathlib.Path.home() / "tools-migration" / "tools_migration_list.txt"
+V1_SELECTOR = "app.kubernetes.io/managed-by=toolforge-jobs-framework,app.kubernetes.io/version=1"
+KINDS = {
+    "cronjobs": ("batch/v1", "app.kubernetes.io/component=cronjobs"),
+    "deployments": ("apps/v1", "app.kubernetes.io/component=deployments"),
+}
+
+
+def get_selector(plural: str) -> str:
+    return f"{V1_SELECTOR},{KINDS[plural][1]}"
+
+
+def object_key(k8s_object: dict[str, Any]) -> str:
+    return f"{k8s_object['metadata']['namespace']}/{k8s_object['metadata']['name']}"
+
+
+def full_list(plural: str) -> dict[str, Any]:
+    result = get_client().list(
+        resource_path(KINDS[plural][0], plural),
+        label_selector=get_selector(plural),
+        metadata_only=True,
+    )
+    return {
+        "resource_version": result.resource_version,
+        "objects": sorted(object_key(item) for item in result.items),
+    }
+
+
+def update(plural: str, inventory: dict[str, Any], watch_seconds: int) -> Counter:
+    """Applies the changes since the inventory resourceVersion, returns the count of events by type."""
+    objects = set(inventory["objects"])
+    events: Counter = Counter()
+    for event in get_client().watch(
+        resource_path(KINDS[plural][0], plural),
+        resource_version=inventory["resource_version"],
+        label_selector=get_selector(plural),
+        timeout_seconds=watch_seconds,
+        metadata_only=True,
+    ):
+        events[event["type"]] += 1
+        if event["type"] in ("ADDED", "MODIFIED"):
+            objects.add(object_key(event["object"]))
+        elif event["type"] == "DELETED":
+            # also sent when an object stops matching the selector (ex. it got migrated to version 2)
+            objects.discard(object_key(event["object"]))
+        inventory["resource_version"] = event["object"]["metadata"]["resourceVersion"]
+
+    inventory["objects"] = sorted(objects)
+    return events
+
+
+@click.command(help=__doc__)
+@click.option(
+    "--output-file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=DEFAULT_OUTPUT_FILE,
+    show_default=True,
+    help="Where to write the tool names, the inventory is stored next to it.",
+)
+@click.option("--full", is_flag=True, default=False, help="Ignore the saved inventory and list everything again.")
+@click.option(
+    "--watch-seconds",
+    default=5,
+    show_default=True,
+    help="How long to watch for changes since the last run (the apiserver replays them right away).",
+)
+def main(output_file: pathlib.Path, full: bool, watch_seconds: int) -> None:
+    inventory_file = output_file.with_name(f"{output_file.stem}.inventory.json")
+    inventory: dict[str, Any] = {}
+    if inventory_file.exists() and not full:
+        inventory = json.loads(inventory_file.read_text())
+
+    start = time.monotonic()
+    for plural in KINDS:
+        if plural in inventory:
+            try:
+                events = update(plural=plural, inventory=inventory[plural], watch_seconds=watch_seconds)
+                click.echo(f"Updated {plural} from the last run: {dict(events) or 'no changes'}")
+                continue
+            except K8sError as error:
+                if error.status_code != 410:
+                    raise
+                click.echo(f"The {plural} inventory is too old for the apiserver, listing all of them again")
+
+        inventory[plural] = full_list(plural=plural)
+        click.echo(f"Listed {len(inventory[plural]['objects'])} version 1 {plural}")
+
+    tools = sorted(
+        {
+            key.split("/", 1)[0].removeprefix("tool-")
+            for plural in KINDS
+            for key in inventory[plural]["objects"]
+        }
+    )
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    inventory_file.write_text(json.dumps(inventory))
+    output_file.write_text("".join(f"{tool}\n" for tool in tools))
+    click.echo(
+        f"{len(tools)} tools require migration, names written to {output_file} ({time.monotonic() - start:.1f}s)"
+    )
+
+
+if __name__ == "__main__":
+    with tracing.script_span(__file__):
+        main()
@@ -1,7 +1,26 @@
 #!/usr/bin/env python3
+import argparse
+import os
+import pathlib
 import sys
+import tempfile
 import yaml
-from typing import Any
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator
+
+
+# the libyaml bindings are way faster, but not always available
+LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+DUMPER = getattr(yaml, "CDumper", yaml.Dumper)
+
+
+@dataclass(frozen=True)
+class FileResult:
+    jobs_file: str
+    loaded: int = 0
+    removed: int = 0
+    error: str = ""
 
 
 def is_oneoff(job: dict[str, Any]) -> bool:
@@ -11,40 +30,126 @@ def is_oneoff(job: dict[str, Any]) -> bool:
     return "schedule" not in job and not job.get("continuous", False)
 
 
-def main():
-    """
-    This script removes all oneoff jobs from the YAML file.
+def load_jobs(data: str) -> Any:
+    return yaml.load(data, Loader=LOADER)
+
+
+def dump_jobs(jobs: list[dict[str, Any]]) -> str:
+    # same options as yaml.dump, so the output is the same with or without libyaml
+    return yaml.dump(jobs, Dumper=DUMPER)
+
+
+def filter_documents(documents: Iterable[Any], counts: dict[str, int]) -> Iterator[list[dict[str, Any]]]:
+    """Yields each document without its oneoff jobs, one at a time, adding up the counts as it goes."""
+    for jobs in documents:
+        if jobs is None:
+            continue
+
+        if not isinstance(jobs, list):
+            raise ValueError(f"not a list (got {type(jobs)})")
+
+        kept_jobs = [job for job in jobs if not is_oneoff(job)]
+        counts["loaded"] += len(jobs)
+        counts["removed"] += len(jobs) - len(kept_jobs)
+        yield kept_jobs
+
+
+def process_file(jobs_file: str) -> FileResult:
     """
-    if len(sys.argv) != 2:
-        print("Usage: ./util_remove_one_off.py <jobs_file>")
-        sys.exit(1)
+    Removes the oneoff jobs from the file, it's only rewritten if there was any.
 
-    jobs_file = sys.argv[1]
+    The documents are streamed from the file to a temporary one next to it (only one of them is in memory at a time),
+    that replaces the file at the end.
+    """
     print(f"Processing jobs file: {jobs_file}")
+    counts = {"loaded": 0, "removed": 0}
+    path = pathlib.Path(jobs_file)
+    with open(path, "r") as jobs_fd, tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as filtered_fd:
+        try:
+            # same options as dump_jobs, a single document is dumped exactly the same
+            yaml.dump_all(
+                filter_documents(documents=yaml.load_all(jobs_fd, Loader=LOADER), counts=counts),
+                filtered_fd,
+                Dumper=DUMPER,
+            )
+        except ValueError as error:
+            os.unlink(filtered_fd.name)
+            print(f"Error: YAML content is {error}. Skipping.")
+            return FileResult(jobs_file=jobs_file, error=str(error))
+        except BaseException:
+            os.unlink(filtered_fd.name)
+            raise
 
-    with open(jobs_file, "r") as f:
-        jobs = yaml.safe_load(f)
-
-    if jobs is None:
+    if not counts["loaded"]:
+        os.unlink(filtered_fd.name)
         print(f"No jobs found in {jobs_file}. Nothing to do.")
-        return
+        return FileResult(jobs_file=jobs_file)
 
-    if not isinstance(jobs, list):
-        print(f"Error: YAML content is not a list (got {type(jobs)}). Skipping.")
-        sys.exit(1)
+    print(f"Loaded {counts['loaded']} jobs from {jobs_file}")
+    print(f"Removed {counts['removed']} one-off jobs, keeping {counts['loaded'] - counts['removed']} jobs")
+
+    if counts["removed"]:
+        os.chmod(filtered_fd.name, path.stat().st_mode)
+        os.replace(filtered_fd.name, path)
+        print(f"Updated {jobs_file} with filtered jobs")
+    else:
+        os.unlink(filtered_fd.name)
+
+    return FileResult(jobs_file=jobs_file, **counts)
+
+
+def get_jobs_files(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Expands the directories to the yaml files in them, sorted so the output is always in the same order.
 
-    print(f"Loaded {len(jobs)} jobs from {jobs_file}")
+    The <tool>.filtered.yaml files that migrate_tools_jobs_in_parallel.py leaves next to the dumps are skipped.
+    """
+    for path in paths:
+        if pathlib.Path(path).is_dir():
+            yield from sorted(
+                str(child)
+                for child in pathlib.Path(path).iterdir()
+                if child.suffix in (".yaml", ".yml") and not child.name.endswith((".filtered.yaml", ".filtered.yml"))
+            )
+        else:
+            yield path
 
-    original_count = len(jobs)
-    jobs = [job for job in jobs if not is_oneoff(job)]
-    removed_count = original_count - len(jobs)
 
-    print(f"Removed {removed_count} one-off jobs, keeping {len(jobs)} jobs")
+def main():
+    """
+    This script removes all oneoff jobs from the YAML files (or all the YAML files in the given directories).
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("jobs_files", nargs="+", metavar="jobs_file_or_dir")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="How many files to process in parallel (default: 1, in this same process).",
+    )
+    args = parser.parse_args()
+
+    jobs_files = list(get_jobs_files(args.jobs_files))
+    if args.processes > 1 and len(jobs_files) > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            # map keeps the order of the files
+            results = list(pool.map(process_file, jobs_files, chunksize=16))
+    else:
+        results = [process_file(jobs_file) for jobs_file in jobs_files]
 
-    with open(jobs_file, "w") as f:
-        yaml.dump(jobs, f)
+    failed = [result for result in results if result.error]
+    if len(results) > 1:
+        print(
+            f"Processed {len(results)} files: loaded {sum(result.loaded for result in results)} jobs, "
+            f"removed {sum(result.removed for result in results)} one-off jobs, {len(failed)} files failed"
+        )
+        for result in failed:
+            print(f"    {result.jobs_file}: {result.error}")
 
-    print(f"Updated {jobs_file} with filtered jobs")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
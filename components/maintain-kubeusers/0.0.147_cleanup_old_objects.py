@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Cleans up the objects left behind by the maintain-kubeusers refactor:
+* the configmap used by maintain-kubeusers changed name, the old `maintain-kubeusers` ones in the tool namespaces are
+  not needed anymore (the new name is maintain-kubeusers-<toolname>)
+* some resourcequotas were created while developing maintain-kubeusers, and k8s restricts to the strictest quota. The
+  ones to delete are named `<toolname>`, the ones to keep `tool-<toolname>` (same as the namespace)
+
+It runs as your user with the system:masters group (like `kubectl --as=$USER --as-group=system:masters`).
+
+To clean up after future refactors, add a rule to RULES (see components/helpers/k8s_cleanup.py).
+"""
+from __future__ import annotations
+
+import getpass
+import pathlib
+import sys
+
+import click
+
+
+BASEDIR = pathlib.Path(__file__).parent.parent.parent
+sys.path.insert(0, str(BASEDIR / "components" / "helpers"))
+import tracing  # noqa: E402
+from k8s_cleanup import CleanupRule, run_cleanup  # noqa: E402
+from k8s_client import get_client  # noqa: E402
+
+
+RULES = [
+    CleanupRule(
+        description="old maintain-kubeusers configmaps",
+        api_version="v1",
+        plural="configmaps",
+        field_selector="metadata.name=maintain-kubeusers,metadata.namespace!=maintain-kubeusers",
+    ),
+    CleanupRule(
+        description="old resourcequotas",
+        api_version="v1",
+        plural="resourcequotas",
+        predicate=lambda metadata: metadata["name"] != metadata["namespace"],
+    ),
+]
+
+
+@click.command(help=__doc__)
+@click.option("--dry-run", is_flag=True, default=False, help="Only show what would be deleted.")
+@click.option("--concurrency", default=8, show_default=True, help="How many objects to delete in parallel.")
+@click.option("--max-rps", default=10.0, show_default=True, help="Maximum delete requests per second (0 for no limit).")
+@click.option(
+    "--propagation-policy",
+    type=click.Choice(["Background", "Foreground", "Orphan"]),
+    default="Background",
+    show_default=True,
+    help="What to do with the objects owned by the deleted ones.",
+)
+def main(dry_run: bool, concurrency: int, max_rps: float, propagation_policy: str) -> None:
+    client = get_client(impersonate_user=getpass.getuser(), impersonate_group="system:masters")
+    if not run_cleanup(
+        client=client,
+        rules=RULES,
+        concurrency=concurrency,
+        max_rps=max_rps,
+        propagation_policy=propagation_policy,
+        dry_run=dry_run,
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    with tracing.script_span(__file__):
+        main()
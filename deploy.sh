@@ -6,6 +6,8 @@ set -o nounset
 shopt -s extglob
 
 BASE_DIR=$(dirname "$(realpath -s "$0")")
+# shellcheck source=SCRIPTDIR/components/helpers/tracing.sh
+source "$BASE_DIR/components/helpers/tracing.sh"
 
 
 cd "$BASE_DIR/components"
@@ -13,6 +15,37 @@ COMPONENTS=(!(helpers|common))
 cd -
 
 
+# components -> components that have to be deployed before them, only used when deploying more than one component at
+# a time (see deploy_many), the ones not listed only depend on cert-manager
+declare -A DEPENDENCIES=(
+    # the base: certificates, CNI and CRDs
+    ["cert-manager"]=""
+    ["calico"]=""
+    ["gateway-api"]=""
+    ["istio-system"]="gateway-api"
+    ["istio-gateway"]="istio-system cert-manager"
+    # the admission webhooks, before the APIs that create the objects they handle
+    ["envvars-admission"]="cert-manager"
+    ["ingress-admission"]="cert-manager"
+    ["registry-admission"]="cert-manager"
+    ["volume-admission"]="cert-manager"
+    # the APIs and the rest
+    ["builds-builder"]="cert-manager registry-admission"
+    ["builds-api"]="builds-builder envvars-admission"
+    ["envvars-api"]="envvars-admission"
+    ["jobs-api"]="envvars-admission registry-admission volume-admission"
+    ["jobs-emailer"]="jobs-api"
+    ["logs-api"]="logging"
+    ["maintain-kubeusers"]="cert-manager kyverno"
+)
+DEFAULT_DEPENDENCIES="cert-manager"
+MAX_PARALLEL_DEPLOYS="${MAX_PARALLEL_DEPLOYS:-4}"
+CONTENT_HASH_ANNOTATION="toolforge.org/deploy-content-hash"
+HASHES_CONFIGMAP="toolforge-deploy-content-hashes"
+FORCE_DEPLOY="no"
+DEPLOY_LOGS_DIR="${DEPLOY_LOGS_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/deploy-logs/$(date +%Y%m%d-%H%M%S)}"
+
+
 help() {
     local components_string=""
     local component
@@ -21,14 +54,24 @@ help() {
                 * $component"
     done
     cat <<EOH
-    Usage: $0 <COMPONENT> [ENVIRONMENT] [HELMFILE_OPTIONS]
+    Usage: $0 <COMPONENT|COMPONENT1,COMPONENT2,...|--all> [ENVIRONMENT] [--force] [HELMFILE_OPTIONS]
 
     Deploy the given component your current default k8s cluster (set by the current context in \$KUBECONFIG).
 
+    Components that did not change since their last deployment are skipped: a hash of all the files of the
+    component, the common values and secrets they use and the options is recorded on the deployed helm releases
+    (or in the $HASHES_CONFIGMAP configmap for the components with an override-deploy.sh), and compared before
+    running the diff. Pass --force to deploy them anyway.
+
     Arguments:
         COMPONENT
             The toolforge component to deploy, one of: $components_string
 
+            Pass a comma separated list of components, or --all for all of them, to deploy several at once. They
+            are deployed in the order of their dependencies (see DEPENDENCIES in $0), in parallel when
+            possible (up to \$MAX_PARALLEL_DEPLOYS, default 4), non-interactively, each with its own log in
+            \$DEPLOY_LOGS_DIR (default ~/.cache/toolforge-deploy/deploy-logs/<date>).
+
         ENVIRONMENT
             The environment to deploy on, might depend on the component, but usually should be one of:
                 * local
@@ -42,49 +85,120 @@ help() {
 EOH
 }
 
-main() {
-    local deploy_environment \
-        component \
-        project \
-        interactive_param
 
-    if [[  "$1" =~ ^-h$|^--help$ ]]; then
-        help
+is_deployable() {
+    local component="${1?}"
+    [[ -e "$BASE_DIR/components/$component/helmfile.yaml" || -e "$BASE_DIR/components/$component/override-deploy.sh" ]]
+}
+
+
+# prints a hash of everything that goes into deploying the component (run from its directory): all the files in the
+# component directory (the helmfiles load values files from many places in it), the common values if used, the
+# secrets they use, the environment and the helmfile options
+get_content_hash() {
+    local deploy_environment="${1?}"
+    shift
+    local -a files
+    local common_values="" secrets_file
+
+    if [[ -e "helmfile.yaml" ]] && grep -q "\.\./common/values" helmfile.yaml; then
+        common_values="../common/values"
+    fi
+    mapfile -d '' files < <(find . $common_values -type f -print0 | sort -z)
+    secrets_file="${SECRETS_FILE:-/etc/toolforge-deploy/secrets.yaml}"
+    if grep -qs "get_secret.sh" "${files[@]}" && [[ -e "$secrets_file" ]]; then
+        files+=("$secrets_file")
+    fi
+
+    {
+        echo "$deploy_environment" "${@/--wait/}"
+        sha256sum "${files[@]}"
+    } | sha256sum | cut -d' ' -f1
+}
+
+
+# prints the "<namespace> <release>" of all the installed releases of the component (run from its directory)
+get_releases() {
+    local deploy_environment="${1?}"
+    trace_run helmfile -e "$deploy_environment" --file "helmfile.yaml" list --output json 2>/dev/null \
+    | jq -r '.[] | select(.enabled and .installed) | "\(.namespace) \(.name)"'
+}
+
+
+# prints the content hash recorded on the live deployment of the component (run from its directory), if it's the same
+# for all its releases
+get_deployed_hash() {
+    local component="${1?}"
+    local deploy_environment="${2?}"
+    local namespace release
+
+    if [[ -e "override-deploy.sh" ]]; then
+        trace_run kubectl get configmap --namespace kube-system "$HASHES_CONFIGMAP" --output json 2>/dev/null \
+        | jq -r --arg key "$component.$deploy_environment" '.data[$key] // ""'
         return 0
     fi
 
-    component="${1:?No component passed, choose one of: ${COMPONENTS[@]}}"
-    shift
-    if ! [[ -d $BASE_DIR/components/$component ]]; then
-        echo "The component '$component' was not found, choose one of: ${COMPONENTS[*]}"
-        help
-        return 1
+    while read -r namespace release; do
+        trace_run kubectl get secret \
+            --namespace "$namespace" \
+            --selector "owner=helm,name=$release,status=deployed" \
+            --output json \
+        | jq -r --arg key "$CONTENT_HASH_ANNOTATION" '.items[] | .metadata.annotations[$key] // ""'
+    done < <(get_releases "$deploy_environment") | sort -u | awk 'NR == 1 {hash=$0} END {if (NR == 1) print hash}'
+}
+
+
+# records the content hash on the live deployment of the component (run from its directory), for helm releases it
+# goes on the release itself (the helm secret of the deployed revision), so any other deployment or rollback
+# invalidates it
+record_deployed_hash() {
+    local component="${1?}"
+    local deploy_environment="${2?}"
+    local content_hash="${3?}"
+    local namespace release
+
+    if [[ -e "override-deploy.sh" ]]; then
+        kubectl create configmap --namespace kube-system "$HASHES_CONFIGMAP" --dry-run=client --output yaml \
+        | trace_run kubectl apply --server-side --field-manager=toolforge-deploy --filename - >/dev/null
+        trace_run kubectl patch configmap --namespace kube-system "$HASHES_CONFIGMAP" --type merge \
+            --patch "{\"data\": {\"$component.$deploy_environment\": \"$content_hash\"}}" >/dev/null
+        return 0
     fi
 
+    while read -r namespace release; do
+        trace_run kubectl annotate secret \
+            --namespace "$namespace" \
+            --selector "owner=helm,name=$release,status=deployed" \
+            --overwrite \
+            "$CONTENT_HASH_ANNOTATION=$content_hash" >/dev/null
+    done < <(get_releases "$deploy_environment")
+}
+
+
+deploy_component() {
+    local component="${1?}"
+    local deploy_environment="${2?}"
+    shift 2
+    local answer content_hash
+
     # explicitly find and specify path to helmfile to allow invoking
     # this script without having to cd to the deployment directory
     cd "$BASE_DIR/components/$component"
 
+    content_hash=$(get_content_hash "$deploy_environment" "$@")
+    if [[ "$FORCE_DEPLOY" == "no" && "$(get_deployed_hash "$component" "$deploy_environment")" == "$content_hash" ]]; then
+        echo "Nothing changed for $component on $deploy_environment since the last deployment, skipping" \
+            "(use --force to deploy anyway)"
+        return 0
+    fi
+
     # give components the ability to override the deployment process from
     # the standard helmfile. this is needed at least for Gateway API CRDs
     # which are not distributed as a Helm chart
     if [[ -e "override-deploy.sh" ]]; then
-        exec ./override-deploy.sh
-        exit 0
-    fi
-
-    project=$(cat /etc/wmcs-project 2>/dev/null || echo "local")
-    # If we got any flags, no env was passed, ex. --wait
-    if [[ "${1:-}" != --* ]]; then
-        deploy_environment=${1:-}
-    else
-        deploy_environment=""
-    fi
-
-    if [[ "$deploy_environment" == "" ]]; then
-        deploy_environment="$project"
-    else
-        shift
+        trace_run ./override-deploy.sh
+        record_deployed_hash "$component" "$deploy_environment" "$content_hash"
+        return 0
     fi
 
     valuesfile="values/$deploy_environment.yaml"
@@ -98,27 +212,229 @@ main() {
         fi
     fi
 
-    # use -i (interactive) to ask for confirmation for changing
-    # live cluster state if stdin is a tty
-    if [[ -t 0 ]]; then
-        interactive_param="-i"
-    else
-        interactive_param=""
-    fi
-
     # We use "helmfile diff" + "helmfile sync", instead of "helmfile apply",
     # because apply will not update the installed version if the diff is empty.
-    helmfile \
+    trace_run helmfile \
         -e "$deploy_environment" \
         --file "helmfile.yaml" \
         diff \
         "${@/--wait/}" # ugly hack because --wait is not valid for "helmfile diff"
-    helmfile \
+
+    # ask for confirmation for changing live cluster state if stdin is a tty, here instead of with helmfile -i so we
+    # know if the sync happened and can record the hash
+    if [[ -t 0 ]]; then
+        read -r -p "Do you really want to sync $component on $deploy_environment? [y/N] " answer
+        if [[ "$answer" != "y" && "$answer" != "Y" ]]; then
+            echo "Not syncing $component"
+            return 0
+        fi
+    fi
+    trace_run helmfile \
         -e "$deploy_environment" \
         --file "helmfile.yaml" \
-        $interactive_param \
         sync \
         "$@"
+
+    record_deployed_hash "$component" "$deploy_environment" "$content_hash"
+}
+
+
+# fails naming the components in a cycle of DEPENDENCIES, deploy_many would wait forever for them
+check_dependencies() {
+    local -A remaining=()
+    local component dependency blocked progress="yes"
+
+    for component in "${!DEPENDENCIES[@]}"; do
+        remaining["$component"]="yes"
+    done
+    # drop the ones without remaining dependencies until there's none left, or only the ones in a cycle
+    while [[ "$progress" == "yes" ]]; do
+        progress="no"
+        for component in "${!remaining[@]}"; do
+            blocked="no"
+            for dependency in ${DEPENDENCIES[$component]}; do
+                if [[ -v "remaining[$dependency]" ]]; then
+                    blocked="yes"
+                    break
+                fi
+            done
+            if [[ "$blocked" == "no" ]]; then
+                unset "remaining[$component]"
+                progress="yes"
+            fi
+        done
+    done
+
+    if [[ ${#remaining[@]} -gt 0 ]]; then
+        echo "The DEPENDENCIES of ${!remaining[*]} have a cycle (or depend on one), fix them in $0" >&2
+        return 1
+    fi
+}
+
+
+# deploys the given components following DEPENDENCIES, running the independent ones in parallel
+deploy_many() {
+    local deploy_environment="${1?}"
+    local components_str="${2?}"
+    shift 2
+    local -a components pending_components
+    local -A state=() pids=() start_times=() durations=()
+    local component dependency ready pid exit_code changed running=0 failed=0
+
+    check_dependencies
+    IFS=, read -r -a components <<<"$components_str"
+    for component in "${components[@]}"; do
+        state["$component"]="pending"
+    done
+
+    mkdir -p "$DEPLOY_LOGS_DIR"
+    echo "Deploying ${components[*]} to $deploy_environment (logs in $DEPLOY_LOGS_DIR)"
+    while true; do
+        pending_components=()
+        for component in "${components[@]}"; do
+            [[ "${state[$component]}" == "pending" ]] && pending_components+=("$component")
+        done
+        if [[ ${#pending_components[@]} -eq 0 && $running -eq 0 ]]; then
+            break
+        fi
+
+        changed="no"
+        for component in "${pending_components[@]}"; do
+            [[ $running -ge $MAX_PARALLEL_DEPLOYS ]] && break
+            ready="yes"
+            for dependency in ${DEPENDENCIES[$component]-$DEFAULT_DEPENDENCIES}; do
+                # dependencies not being deployed this time are considered already there
+                case "${state[$dependency]:-done}" in
+                    done) ;;
+                    failed|skipped)
+                        ready="skip"
+                        break
+                        ;;
+                    *) ready="no" ;;
+                esac
+            done
+
+            if [[ "$ready" == "skip" ]]; then
+                echo "!! Skipping $component, its dependency $dependency was not deployed"
+                state["$component"]="skipped"
+                changed="yes"
+            elif [[ "$ready" == "yes" ]]; then
+                echo ">> Deploying $component"
+                ( trace_stage "deploy $component" deploy_component "$component" "$deploy_environment" "$@" ) \
+                    </dev/null &>"$DEPLOY_LOGS_DIR/$component.log" &
+                pids["$component"]=$!
+                start_times["$component"]=$SECONDS
+                state["$component"]="running"
+                running=$((running + 1))
+                changed="yes"
+            fi
+        done
+
+        if [[ $running -eq 0 && "$changed" == "no" ]]; then
+            # nothing to wait for, the pending ones are waiting for each other
+            echo "!! Unable to deploy ${pending_components[*]}, their dependencies wait for each other" \
+                "(see DEPENDENCIES in $0)"
+            for component in "${pending_components[@]}"; do
+                state["$component"]="failed"
+                failed=$((failed + 1))
+            done
+            continue
+        fi
+
+        # no wait -n -p in older bash versions, so we poll
+        sleep 1
+        for component in "${!pids[@]}"; do
+            pid="${pids[$component]}"
+            kill -0 "$pid" 2>/dev/null && continue
+
+            exit_code=0
+            wait "$pid" || exit_code=$?
+            unset "pids[$component]"
+            running=$((running - 1))
+            durations["$component"]=$((SECONDS - start_times[$component]))
+            if [[ $exit_code -eq 0 ]]; then
+                state["$component"]="done"
+                echo "<< Deployed $component (${durations[$component]}s)"
+            else
+                state["$component"]="failed"
+                failed=$((failed + 1))
+                echo "!! Failed to deploy $component (exit code $exit_code), see $DEPLOY_LOGS_DIR/$component.log"
+            fi
+        done
+    done
+
+    echo "Summary (total ${SECONDS}s):"
+    for component in "${components[@]}"; do
+        if [[ -v "durations[$component]" ]]; then
+            printf "    %-20s %-8s %5ss  %s\n" \
+                "$component" "${state[$component]}" "${durations[$component]}" "$DEPLOY_LOGS_DIR/$component.log"
+        else
+            printf "    %-20s %-8s\n" "$component" "${state[$component]}"
+        fi
+    done
+    [[ $failed -eq 0 ]]
+}
+
+
+main() {
+    local deploy_environment \
+        component \
+        components_str \
+        project \
+        arg
+
+    if [[  "$1" =~ ^-h$|^--help$ ]]; then
+        help
+        return 0
+    fi
+
+    trace_script "$@"
+
+    components_str="${1:?No component passed, choose one of: ${COMPONENTS[@]}}"
+    shift
+    for arg in "$@"; do
+        shift
+        if [[ "$arg" == "--force" ]]; then
+            FORCE_DEPLOY="yes"
+        else
+            set -- "$@" "$arg"
+        fi
+    done
+    if [[ "$components_str" == "--all" ]]; then
+        components_str=""
+        for component in "${COMPONENTS[@]}"; do
+            is_deployable "$component" && components_str+="${components_str:+,}$component"
+        done
+    fi
+
+    IFS=, read -r -a components <<<"$components_str"
+    for component in "${components[@]}"; do
+        if ! [[ -d $BASE_DIR/components/$component ]]; then
+            echo "The component '$component' was not found, choose one of: ${COMPONENTS[*]}"
+            help
+            return 1
+        fi
+    done
+
+    project=$(cat /etc/wmcs-project 2>/dev/null || echo "local")
+    # If we got any flags, no env was passed, ex. --wait
+    if [[ "${1:-}" != --* ]]; then
+        deploy_environment=${1:-}
+    else
+        deploy_environment=""
+    fi
+
+    if [[ "$deploy_environment" == "" ]]; then
+        deploy_environment="$project"
+    else
+        shift
+    fi
+
+    if [[ ${#components[@]} -eq 1 ]]; then
+        trace_stage "deploy ${components[0]}" deploy_component "${components[0]}" "$deploy_environment" "$@"
+    else
+        deploy_many "$deploy_environment" "$components_str" "$@"
+    fi
 }
 
 
@@ -50,7 +50,7 @@ setup(){
 
     assert_success
 
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
 
     retention_id=$($CURL -X GET "$HARBOR_URL/projects/$HARBOR_PROJECT_NAME" | jq '.metadata.retention_id')
 
@@ -73,7 +73,7 @@ setup(){
 
     assert_success
 
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
 
     updated_retention=$($CURL -X GET "$HARBOR_URL/retentions/$retention_id")
 
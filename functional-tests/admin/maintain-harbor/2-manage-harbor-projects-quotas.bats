@@ -26,7 +26,7 @@ setup(){
     job_name="test-$RANDOM"
     run --separate-stderr bash -c "$SUKUBECTL create job \"$job_name\" --from=cronjob/mh--manage-harbor-projects-quotas-cron"
     assert_success
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
 }
 
 @test "update if quota different from default" {
@@ -45,7 +45,7 @@ setup(){
     job_name="test-$RANDOM"
     run --separate-stderr bash -c "$SUKUBECTL create job \"$job_name\" --from=cronjob/mh--manage-harbor-projects-quotas-cron"
     assert_success
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
     quota=$($CURL -X GET "$HARBOR_URL/quotas/$quota_id")
     assert_not_equal "$(echo "$quota" | jq -r '.hard.storage')" "100"
 }
@@ -65,7 +65,7 @@ setup(){
     job_name="test-$RANDOM"
     run --separate-stderr bash -c "$SUKUBECTL create job \"$job_name\" --from=cronjob/mh--manage-harbor-projects-quotas-cron"
     assert_success
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
     quota=$($CURL -X GET "$HARBOR_URL/quotas/$quota_id")
     assert_equal "$(echo "$quota" | jq -r '.hard.storage')" "1000"
 }
@@ -42,7 +42,7 @@ setup(){
 
     assert_success
 
-    retry "$SUKUBECTL get pods | grep \"$job_name\" | grep 'Completed'"
+    wait_for_job_complete "$job_name" 240 "$SUKUBECTL"
 
     run --separate-stderr bash -c "$CURL -X GET \"$HARBOR_URL/projects\" | jq -r '.'"
 
@@ -15,11 +15,10 @@ setup(){
     run --separate-stderr $SUKUBECTL create job "$job_name" --from=cronjob/mh--delete-stale-toolforge-artifacts-cron
     assert_success
 
-    retry "$SUKUBECTL get pods -o name | grep -q \"$job_name\"" 60
+    pod=$(wait_for_pod_created "job-name=$job_name" 60 "$SUKUBECTL")
+    wait_for_log_line "$pod" "Enabled immutable rule" 240 "$SUKUBECTL"
     # shellcheck disable=SC2086
-    pod=$($SUKUBECTL get pods -o name | grep "$job_name")
-    # shellcheck disable=SC2086
-    run --separate-stderr retry "$SUKUBECTL logs --follow '$pod'"
+    run --separate-stderr $SUKUBECTL logs "$pod"
     assert_success
 
     assert_line --regexp "Cleaning up stale artifacts of toolforge project repositories"
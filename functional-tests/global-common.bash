@@ -30,6 +30,80 @@ _global_teardown() {
     fi
 }
 
+# the longest sleep between two tries of wait_until, like the one second of retry
+WAIT_MAX_DELAY_MS=1000
+
+
+# records how long a wait took, they are summarized at the end of the run (see teardown_suite)
+_record_wait() {
+    local description="${1?}"
+    local start="${2?}"
+    local result="${3?}"
+    local elapsed_ms
+    elapsed_ms=$(( (${EPOCHREALTIME/[.,]/} - ${start/[.,]/}) / 1000 ))
+    echo "Waited ${elapsed_ms}ms for $description ($result)"
+    printf '%s\t%s\t%s\t%s\n' "${BATS_TEST_NAME:-}" "$description" "$elapsed_ms" "$result" \
+        >> "${BATS_WAITS_FILE:-/dev/null}"
+}
+
+
+# seconds left until the deadline (as in $SECONDS), at least 1 as `timeout 0` never times out
+_remaining() {
+    local deadline="${1?}"
+    echo $((deadline - SECONDS > 0 ? deadline - SECONDS : 1))
+}
+
+
+# runs the given (watch) command until it prints a line matching the regex, and prints that line
+# returns 1 if the command ends (ex. errors out) or times out before that
+_watch_until() {
+    local timeout="${1?}"
+    local regex="${2?}"
+    shift 2
+    local line fd pid found="no"
+
+    # fd 3 is closed, otherwise bats waits for the watch to finish
+    exec {fd}< <(timeout "$timeout" "$@" 2>/dev/null 3>&-)
+    pid=$!
+    while IFS= read -r -u "$fd" line; do
+        if [[ "$line" =~ $regex ]]; then
+            found="yes"
+            echo "$line"
+            break
+        fi
+    done
+    kill "$pid" 2>/dev/null || :
+    exec {fd}<&-
+    [[ "$found" == "yes" ]]
+}
+
+
+# runs the command until it succeeds, backing off exponentially between tries, up to timeout seconds
+# use it when there's nothing to watch, ex. the output of a cli
+wait_until() {
+    local command="${1?}"
+    local timeout="${2:-120}"
+    local description="${3:-$command}"
+    local start="$EPOCHREALTIME"
+    local deadline=$((SECONDS + timeout))
+    local delay_ms=250
+
+    echo "Waiting up to ${timeout}s for: $command"
+    while true; do
+        if bash -c "$command"; then
+            _record_wait "$description" "$start" "ok"
+            return 0
+        fi
+        if [[ $SECONDS -ge $deadline ]]; then
+            _record_wait "$description" "$start" "timeout"
+            return 1
+        fi
+        sleep "$((delay_ms / 1000)).$(printf '%03d' $((delay_ms % 1000)))"
+        delay_ms=$((delay_ms * 2 > WAIT_MAX_DELAY_MS ? WAIT_MAX_DELAY_MS : delay_ms * 2))
+    done
+}
+
+
 retry() {
     local command="${1?}"
     # default to 120 because:
@@ -44,3 +118,92 @@ retry() {
     done
     return 1
 }
+
+
+# waits until the jsonpath of the object matches the regex, ex.:
+#   wait_for_jsonpath pod/my-pod '{.status.phase}' '^Running$' 60 "$SUKUBECTL"
+# uses a watch, so it returns as soon as it changes, polling if the object does not exist yet
+wait_for_jsonpath() {
+    local object="${1?}"
+    local jsonpath="${2?}"
+    local regex="${3?}"
+    local timeout="${4:-120}"
+    local kubectl="${5:-kubectl}"
+    local start="$EPOCHREALTIME"
+    local deadline=$((SECONDS + timeout))
+    local description="$object $jsonpath =~ $regex"
+    local command
+
+    echo "Watching up to ${timeout}s for: $description"
+    # shellcheck disable=SC2086
+    if _watch_until "$timeout" "$regex" $kubectl get "$object" --watch --output "jsonpath=$jsonpath{\"\\n\"}" \
+        >/dev/null; then
+        _record_wait "$description" "$start" "ok"
+        return 0
+    fi
+    if [[ $SECONDS -ge $deadline ]]; then
+        _record_wait "$description" "$start" "timeout"
+        return 1
+    fi
+
+    # the watch failed, most likely the object is not there yet
+    printf -v command '%s get %q --output %q | grep -qE %q' "$kubectl" "$object" "jsonpath=$jsonpath" "$regex"
+    wait_until "$command" "$(_remaining "$deadline")" "$description (polling)"
+}
+
+
+wait_for_job_complete() {
+    local job="${1?}"
+    local timeout="${2:-120}"
+    local kubectl="${3:-kubectl}"
+    wait_for_jsonpath "job/$job" '{.status.conditions[?(@.type=="Complete")].status}' '^True$' "$timeout" "$kubectl"
+}
+
+
+wait_for_pod_phase() {
+    local pod="${1?}"
+    local phase_regex="${2?}"
+    local timeout="${3:-120}"
+    local kubectl="${4:-kubectl}"
+    wait_for_jsonpath "pod/${pod#pod/}" '{.status.phase}' "^($phase_regex)\$" "$timeout" "$kubectl"
+}
+
+
+# prints the name of the first pod matching the label selector, waiting for it to be created
+wait_for_pod_created() {
+    local selector="${1?}"
+    local timeout="${2:-120}"
+    local kubectl="${3:-kubectl}"
+    local start="$EPOCHREALTIME"
+    local pod
+
+    # shellcheck disable=SC2086
+    if pod=$(_watch_until "$timeout" '.' $kubectl get pods --selector "$selector" --watch --output name); then
+        _record_wait "a pod with $selector" "$start" "ok" >&2
+        echo "$pod"
+        return 0
+    fi
+    _record_wait "a pod with $selector" "$start" "timeout" >&2
+    return 1
+}
+
+
+# waits until the pod logs a line matching the regex, following them
+wait_for_log_line() {
+    local pod="${1?}"
+    local regex="${2?}"
+    local timeout="${3:-120}"
+    local kubectl="${4:-kubectl}"
+    local start="$EPOCHREALTIME"
+    local deadline=$((SECONDS + timeout))
+
+    # the logs can't be followed before the container starts
+    wait_for_pod_phase "$pod" "Running|Succeeded|Failed" "$timeout" "$kubectl" || return 1
+    # shellcheck disable=SC2086
+    if _watch_until "$(_remaining "$deadline")" "$regex" $kubectl logs --follow "pod/${pod#pod/}"; then
+        _record_wait "$pod to log $regex" "$start" "ok"
+        return 0
+    fi
+    _record_wait "$pod to log $regex" "$start" "timeout"
+    return 1
+}
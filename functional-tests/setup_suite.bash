@@ -6,6 +6,8 @@ setup_suite() {
     export BATS_SKIP_FILE="$BATS_TMPDIR/$USER.bats.skip"
     # cleanup the skip file on the first run
     rm -f "$BATS_SKIP_FILE"
+    # how long each wait took, see wait_until and friends in global-common.bash
+    export BATS_WAITS_FILE="$BATS_RUN_TMPDIR/waits.tsv"
     export TOOLFORGE_API_URL=$(grep api_gateway -A 2 /etc/toolforge/common.yaml | grep url: | grep -o 'http.*$')
     bats_require_minimum_version 1.5.0
 }
@@ -13,4 +15,13 @@ setup_suite() {
 
 teardown_suite() {
     rm -f "$BATS_SKIP_FILE"
+    if [[ -s "$BATS_WAITS_FILE" ]]; then
+        {
+            awk -F '\t' '{total += $3} END {printf "# %d waits, %.1fs in total, the slowest:\n", NR, total / 1000}' \
+                "$BATS_WAITS_FILE"
+            sort -t $'\t' -k 3 -rn "$BATS_WAITS_FILE" \
+            | head -n 5 \
+            | awk -F '\t' '{printf "#   %6.1fs %s (%s, %s)\n", $3 / 1000, $2, $1, $4}'
+        } >&3
+    fi
 }
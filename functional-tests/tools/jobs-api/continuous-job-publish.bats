@@ -80,7 +80,11 @@ _get_external_url() {
 
     toolforge jobs restart "$rand_string"
 
-    retry "kubectl get deployment '$rand_string' -o jsonpath='{.spec.template.metadata.annotations.app\.kubernetes\.io/restartedAt}' | grep ." 30
+    wait_for_jsonpath \
+        "deployment/$rand_string" \
+        '{.spec.template.metadata.annotations.app\.kubernetes\.io/restartedAt}' \
+        '.' \
+        60
 
     retry "toolforge jobs show '$rand_string' | grep 'Status' | grep 'Running'" 100
 
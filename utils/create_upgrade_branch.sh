@@ -5,6 +5,8 @@ set -o nounset
 shopt -s extglob
 GITLAB_REPO_BASE="https://gitlab.wikimedia.org/repos/cloud/toolforge"
 GITLAB_RELEASE_SUFFIX="-/releases"
+# bare mirrors of the component repos, reused between runs to get the bugs fixed between releases
+MIRRORS_DIR="${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/mirrors"
 
 cd components
 COMPONENTS=(!(helpers))
@@ -45,15 +47,21 @@ get_bugs_for_upgrade() {
     local repo="${1?no component repo passed}"
     local from_release="${2?no from_release passed}"
     local to_release="${3?no to_release passed}"
-    local tmpdir
-
-    tmpdir=$(mktemp -d)
-    git init "$tmpdir" >/dev/null
-    git --git-dir="${tmpdir}/.git" remote add origin "$repo" >/dev/null
-    # TODO: try to fetch only commits between the releases if possible
-    git --git-dir="${tmpdir}/.git" fetch origin>/dev/null
-    git --git-dir="${tmpdir}/.git" log "$from_release...$to_release" | grep -o "Bug: T[[:digit:]]*"
-    rm -rf "$tmpdir"
+    local mirror="$MIRRORS_DIR/${repo##*/}"
+    mirror="${mirror%.git}.git"
+
+    if [[ ! -d "$mirror" ]]; then
+        mkdir -p "$MIRRORS_DIR"
+        git init --bare --quiet "$mirror"
+        git --git-dir="$mirror" remote add origin "$repo"
+    fi
+    # only the two release tags, and of those only the commits we don't have yet, without trees nor blobs as we only
+    # need the commit messages
+    git --git-dir="$mirror" fetch --quiet --no-tags --filter=tree:0 origin \
+        "+refs/tags/$from_release:refs/tags/$from_release" \
+        "+refs/tags/$to_release:refs/tags/$to_release" \
+        >/dev/null
+    git --git-dir="$mirror" log --format=%B "$from_release...$to_release" | grep -o "Bug: T[[:digit:]]*" || :
 }
 
 main() {
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Keeps a history of how long each functional test took, to spot the tests (and so the components) that got slower.
+
+It takes the junit reports of a run of the functional tests (see run_functional_tests.sh) and appends a line to the
+history file with the environment, the versions of the components deployed (from toolforge_get_versions.sh --json) and
+the duration and status of each test. Then it prints the slowest tests of the run and the biggest regressions, the tests
+that took much longer than their median over the last runs in the same environment, along with the component versions
+that changed since those runs.
+
+Without reports it just prints the summary of the last run in the history.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import pathlib
+import statistics
+import sys
+import xml.etree.ElementTree as ET
+from typing import Any
+
+HISTORY_FILE = pathlib.Path.home() / ".cache" / "toolforge-deploy" / "functional-tests" / "history.jsonl"
+
+
+def load_reports(reports: list[pathlib.Path]) -> dict[str, dict[str, Any]]:
+    """Returns the tests in the junit reports, as '<bats file>: <test name>' -> {duration, status}."""
+    tests = {}
+    for report in reports:
+        try:
+            testcases = ET.parse(report).getroot().iter("testcase")
+        except ET.ParseError as error:
+            print(f"WARNING: skipping unparseable report {report}: {error}", file=sys.stderr)
+            continue
+
+        for testcase in testcases:
+            # the classname is relative to the directory passed to bats, that changes when running sharded
+            bats_file = pathlib.PurePath(testcase.get("classname", "")).name
+            if testcase.find("failure") is not None:
+                status = "failed"
+            elif testcase.find("skipped") is not None:
+                status = "skipped"
+            else:
+                status = "passed"
+            tests[f"{bats_file}: {testcase.get('name')}"] = {
+                "duration": float(testcase.get("time") or 0),
+                "status": status,
+            }
+    return tests
+
+
+def load_versions(versions_file: pathlib.Path | None) -> dict[str, str]:
+    if versions_file is None or not versions_file.exists():
+        return {}
+    return {row["component"]: row["version"] for row in json.loads(versions_file.read_text() or "[]")}
+
+
+def load_history(history_file: pathlib.Path) -> list[dict[str, Any]]:
+    if not history_file.exists():
+        return []
+    runs = []
+    for line in history_file.read_text().splitlines():
+        try:
+            runs.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return runs
+
+
+def get_version_changes(previous: dict[str, str], current: dict[str, str]) -> list[str]:
+    return [
+        f"{component} {previous.get(component, 'missing')} -> {current.get(component, 'missing')}"
+        for component in sorted(set(previous) | set(current))
+        if previous.get(component) != current.get(component)
+    ]
+
+
+def show_summary(run: dict[str, Any], previous_runs: list[dict[str, Any]], slowest: int, threshold: float) -> None:
+    tests = {name: test for name, test in run["tests"].items() if test["status"] != "skipped"}
+    print(f"@@@@@@@@ Slowest tests ({run['environment']}, {len(tests)} tests, {len(previous_runs)} previous runs):")
+    for name, test in sorted(tests.items(), key=lambda item: item[1]["duration"], reverse=True)[:slowest]:
+        print(f"    {test['duration']:7.1f}s  {test['status']:6}  {name}")
+
+    if not previous_runs:
+        return
+
+    regressions = []
+    for name, test in tests.items():
+        durations = [
+            previous["tests"][name]["duration"]
+            for previous in previous_runs
+            if previous["tests"].get(name, {}).get("status") == "passed"
+        ]
+        if not durations:
+            continue
+        median = statistics.median(durations)
+        # ignore the noise of the tests that take a few seconds
+        if test["duration"] - median >= 5 and test["duration"] >= median * threshold:
+            regressions.append((test["duration"] - median, median, test["duration"], name))
+
+    print(f"@@@@@@@@ Regressions (over {threshold}x the median of the last {len(previous_runs)} runs):")
+    if not regressions:
+        print("    None")
+    for diff, median, duration, name in sorted(regressions, reverse=True)[:slowest]:
+        print(f"    {diff:+7.1f}s  {median:7.1f}s -> {duration:7.1f}s  {name}")
+
+    changes = get_version_changes(previous=previous_runs[0]["versions"], current=run["versions"])
+    print(f"@@@@@@@@ Component versions changed since {previous_runs[0]['timestamp']}:")
+    for change in changes or ["None"]:
+        print(f"    {change}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("reports", type=pathlib.Path, nargs="*", help="The junit reports (report.xml) of the run.")
+    parser.add_argument("--environment", required=True, help="The environment the tests ran in (ex. toolsbeta).")
+    parser.add_argument(
+        "--versions",
+        type=pathlib.Path,
+        help="The json output of toolforge_get_versions.sh --json, with the versions of the deployed components.",
+    )
+    parser.add_argument(
+        "--history", type=pathlib.Path, default=HISTORY_FILE, help=f"The history file (default: {HISTORY_FILE})."
+    )
+    parser.add_argument("--last-runs", type=int, default=5, help="How many previous runs to compare with (default: 5).")
+    parser.add_argument("--slowest", type=int, default=10, help="How many tests to show (default: 10).")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="How many times the median duration a test has to take to be shown as a regression (default: 1.5).",
+    )
+    args = parser.parse_args()
+
+    runs = [run for run in load_history(args.history) if run["environment"] == args.environment]
+    if args.reports:
+        run = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "environment": args.environment,
+            "versions": load_versions(args.versions),
+            "tests": load_reports(args.reports),
+        }
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with args.history.open("a") as history:
+            history.write(json.dumps(run, sort_keys=True) + "\n")
+        print(f"Recorded the durations of {len(run['tests'])} tests in {args.history}")
+    elif runs:
+        run = runs.pop()
+    else:
+        print(f"No runs for environment {args.environment} in {args.history}")
+        return 1
+
+    # most recent first
+    previous_runs = list(reversed(runs[-args.last_runs :])) if args.last_runs > 0 else []
+    show_summary(run=run, previous_runs=previous_runs, slowest=args.slowest, threshold=args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,29 @@ DEFAULT_TEST_TOOLS_PER_ENV["local"]="tf-test"
 DEFAULT_TEST_TOOLS_PER_ENV["toolsbeta"]="test"
 DEFAULT_TEST_TOOLS_PER_ENV["tools"]="automated-toolforge-tests"
 SOURCE_FILE_NAME="functional-tests-source-file-$RANDOM"
+# all the test tools used (more than one to run the tests sharded), locked while the tests run
+declare -a TEST_TOOLS_POOL=()
+# where the logs, junit reports and versions of each run are kept
+TEST_RUNS_DIR="${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/functional-tests"
+# where run_tests leaves the junit report of the last run of each tests dir, relative to the cache dir of the user
+TEST_REPORTS_SUBDIR="toolforge-deploy/functional-tests/reports"
+# the durations of the tests of every run, see functional_tests_history.py
+TESTS_HISTORY_FILE="$TEST_RUNS_DIR/history.jsonl"
+# how many previous runs to compare the durations of the tests with
+TESTS_HISTORY_RUNS="${TESTS_HISTORY_RUNS:-5}"
+# the python packages needed to run the tests, the test venv is only rebuilt when they change, so they are pinned (an
+# unpinned package would never be upgraded in an existing venv), bump them to get a new version
+TEST_REQUIREMENTS=(
+    "bats-core-pkg==0.1.11.post1"
+)
+# where the test venvs are built, one per hash of the requirements, see setup_venv
+TEST_VENVS_DIR="${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/test-venvs"
+# the test venvs not used for this long are removed, other runs might still be using the ones for other requirements
+TEST_VENVS_MAX_AGE_DAYS="${TEST_VENVS_MAX_AGE_DAYS:-7}"
+# the webservice type used to create the test venv in tools/toolsbeta, the bastions don't have the venv module
+TEST_VENV_WEBSERVICE_TYPE="python3.13"
+# the directory of this script, set by main (run_tests changes the current directory)
+UTILS_DIR=""
 
 
 help() {
@@ -34,6 +57,9 @@ help() {
 
             -t|--test-tool
                 Name of the tool to use for the testing without prefix (ex. tf-test or wm-lol)
+                Pass it more than once to use a pool of test tools: the tools tests are then split in
+                shards (one per suite, ex. tools/jobs-api) that run in parallel, each tool running one
+                shard at a time, with a log per shard and a summary at the end.
 
             -c|--component
                 This is used to determine the test tags to use (ex. -c builds-api -c jobs-api)
@@ -51,6 +77,14 @@ help() {
                     For more control over the tests that run, use --filter-tags to filter by tag:
                     * --filter-tags jobs-api
 
+        Results:
+            The logs, the junit reports and the versions of the components of each run are kept in
+            $TEST_RUNS_DIR/<date>, and the duration of each test in
+            $TESTS_HISTORY_FILE.
+            At the end of the run the slowest tests are shown, along with the ones that took much
+            longer than in the last $TESTS_HISTORY_RUNS runs (set TESTS_HISTORY_RUNS to change it) and the
+            components that changed since.
+
 
         Example:
             To run in toolforge deployment using the wm-lol tool as test tool and fetching the latest test:
@@ -104,6 +138,14 @@ ensure_lock() {
     return 1
 }
 
+cleanup_test_tools() {
+    local test_tool_uid
+    for test_tool_uid in "${TEST_TOOLS_POOL[@]}"; do
+        remove_file "$test_tool_uid" "functional_tests.lock"
+        remove_file "$test_tool_uid" "$SOURCE_FILE_NAME"
+    done
+}
+
 inside_toolforge_deployment() {
     if [[ -e /etc/wmcs-project ]]; then
         grep -q 'tools' /etc/wmcs-project
@@ -137,35 +179,75 @@ is_tool_user() {
     fi
 }
 
-setup_venv() {
-    if ! [[ -e "$HOME/venv/bin/activate" ]]; then
+# prints the hash of what goes in the test venv, a venv with the same hash can be reused as is
+get_test_venv_hash() {
+    {
+        printf '%s\n' "${TEST_REQUIREMENTS[@]}"
         if inside_toolforge_deployment; then
-            # shellcheck disable=SC2016
-            # double -- as the `toolforge` cli swallows it (T370184)
-            # This is done as webservice because we don't have venv installed in the bastion
-            toolforge webservice python3.13 shell -- -- bash -c 'python3 -m venv "$TOOL_DATA_DIR/venv"'
-            local retries=10
-            while ! [[ -e "$HOME/venv/bin/activate" ]]; do
-                echo "Waiting for nfs to sync up..."
-                # Force NFS to re-check the home dir
-                ls "$HOME" &>/dev/null || :
-                sleep 1
-                retries=$((retries - 1))
-                if [[ "$retries" -le 0 ]]; then
-                    echo "ERROR: Unable to find the venv created with webservice" >&2
-                    return 1
-                fi
-            done
+            echo "webservice $TEST_VENV_WEBSERVICE_TYPE"
         else
-            # TODO: use webservice for lima-kilo once it's supported there
-            python3 -m venv "$HOME/venv"
+            python3 --version
         fi
+    } | sha256sum | cut -c1-16
+}
+
+build_test_venv() {
+    local venv_dir="${1?}"
+
+    rm -rf "$venv_dir"
+    mkdir -p "${venv_dir%/*}"
+    if inside_toolforge_deployment; then
+        # double -- as the `toolforge` cli swallows it (T370184)
+        # This is done as webservice because we don't have venv installed in the bastion
+        toolforge webservice "$TEST_VENV_WEBSERVICE_TYPE" shell -- -- python3 -m venv "$venv_dir"
+        local retries=10
+        while ! [[ -e "$venv_dir/bin/activate" ]]; do
+            echo "Waiting for nfs to sync up..."
+            # Force NFS to re-check the venvs dir
+            ls "${venv_dir%/*}" &>/dev/null || :
+            sleep 1
+            retries=$((retries - 1))
+            if [[ "$retries" -le 0 ]]; then
+                echo "ERROR: Unable to find the venv created with webservice" >&2
+                return 1
+            fi
+        done
+    else
+        # TODO: use webservice for lima-kilo once it's supported there
+        python3 -m venv "$venv_dir"
     fi
+
+    "$venv_dir/bin/pip" install --quiet "${TEST_REQUIREMENTS[@]}"
+    # only complete venvs are reused
+    printf '%s\n' "${TEST_REQUIREMENTS[@]}" > "$venv_dir/.complete"
+}
+
+# sets up $HOME/venv pointing to the venv for the current test requirements, building it only if they changed
+setup_venv() {
+    local start=$SECONDS
+    local venv_dir
+
+    venv_dir="$TEST_VENVS_DIR/$(get_test_venv_hash)"
+    if [[ -e "$venv_dir/.complete" ]]; then
+        echo "Reusing the test venv $venv_dir"
+    else
+        echo "Building the test venv $venv_dir for: ${TEST_REQUIREMENTS[*]}"
+        build_test_venv "$venv_dir"
+    fi
+
+    if [[ -d "$HOME/venv" && ! -L "$HOME/venv" ]]; then
+        # the venv used to be created there directly
+        rm -rf "$HOME/venv"
+    fi
+    ln -sfn "$venv_dir" "$HOME/venv"
+    # the mtime of the venv dir is when it was last used
+    touch "$venv_dir"
+    find "$TEST_VENVS_DIR" -mindepth 1 -maxdepth 1 -type d ! -path "$venv_dir" -mtime +"$TEST_VENVS_MAX_AGE_DAYS" \
+        -exec rm -rf {} +
+
     # shellcheck disable=SC1091
     source "$HOME/venv/bin/activate"
-
-    command -v bats_core_pkg >/dev/null \
-    || pip install --upgrade bats-core-pkg
+    echo "Test venv ready in $((SECONDS - start))s"
 }
 
 setup_toolforge_deploy() {
@@ -251,6 +333,11 @@ run_tests() {
         done
     fi
 
+    # the junit report with the duration of each test, see get_test_report
+    local report_dir="${XDG_CACHE_HOME:-$HOME/.cache}/$TEST_REPORTS_SUBDIR/${dir//\//-}"
+    rm -rf "$report_dir"
+    mkdir -p "$report_dir"
+
     # we need to be in the home of the tool, where the jobs will create the logs
     cd "$test_tool_home"
     local extra_env=""
@@ -264,6 +351,8 @@ source "$test_tool_home/venv/bin/activate" \\
     --verbose-run \\
     --pretty \\
     --timing \\
+    --report-formatter junit \\
+    --output "$report_dir" \\
     --recursive \\
     --setup-suite-file "${test_tool_home}/toolforge-deploy/functional-tests/setup_suite.bash" \\
     "${test_tool_home}/toolforge-deploy/functional-tests/${dir}" \\
@@ -274,12 +363,179 @@ EOM
         --verbose-run \
         --pretty \
         --timing \
+        --report-formatter junit \
+        --output "$report_dir" \
         --recursive \
         --setup-suite-file "${test_tool_home}/toolforge-deploy/functional-tests/setup_suite.bash" \
         "${test_tool_home}/toolforge-deploy/functional-tests/${dir}" \
         "${extra_args[@]}"
 }
 
+# prints the junit report of the last run of the given tests dir (ex. admin or tools/jobs-api) by the given user
+get_test_report() {
+    local user="${1?}"
+    local dir="${2?}"
+    local report="$TEST_REPORTS_SUBDIR/${dir//\//-}/report.xml"
+
+    if [[ "$user" == "$USER" ]]; then
+        cat "${XDG_CACHE_HOME:-$HOME/.cache}/$report"
+    else
+        sudo -i -u "$user" bash -c "cat \"\${XDG_CACHE_HOME:-\$HOME/.cache}/$report\""
+    fi
+}
+
+# appends the durations of the tests of the run to the history and shows the slowest tests and the regressions
+record_test_timings() {
+    local run_dir="${1?}"
+    local environment="${2?}"
+    local -a reports=("$run_dir"/reports/*.xml)
+
+    if ! [[ -e "${reports[0]}" ]]; then
+        echo "No test reports found in $run_dir/reports, not recording the test timings"
+        return 0
+    fi
+    python3 "$UTILS_DIR"/functional_tests_history.py \
+        --environment "$environment" \
+        --versions "$run_dir/versions.json" \
+        --history "$TESTS_HISTORY_FILE" \
+        --last-runs "$TESTS_HISTORY_RUNS" \
+        "${reports[@]}" \
+    || echo "Unable to record the test timings, continuing"
+}
+
+# prints the tools test suites (shards) that have tests for the given components, the ones with file_tags matching
+# their tests.txt tags, or all of them
+get_test_shards() {
+    local components_str="${1?}"
+    local test_tool_home="${2?}"
+    local tests_dir="${test_tool_home}/toolforge-deploy/functional-tests"
+    local -A wanted_tags=()
+    local -a components
+    local component suite_dir tag
+
+    if [[ "$components_str" != "all" ]]; then
+        IFS=, read -ra components <<< "$components_str"
+        for component in "${components[@]}"; do
+            while read -r tag; do
+                wanted_tags["$tag"]="yes"
+            done < <(grep -s '^[^#]' "$test_tool_home/toolforge-deploy/components/$component/tests.txt")
+        done
+    fi
+
+    for suite_dir in "$tests_dir"/tools/*/; do
+        suite_dir="${suite_dir%/}"
+        if [[ "$components_str" == "all" ]]; then
+            echo "tools/${suite_dir##*/}"
+            continue
+        fi
+        while read -r tag; do
+            if [[ "${wanted_tags[$tag]:-}" == "yes" ]]; then
+                echo "tools/${suite_dir##*/}"
+                break
+            fi
+        done < <(grep -h '^# bats file_tags=' "$suite_dir"/*.bats | cut -d= -f2 | tr ',' '\n')
+    done
+}
+
+# runs as the login user, copies this script to the tool home and sets up its venv and toolforge-deploy checkout
+setup_test_tool() {
+    local test_tool_uid="${1?}"
+    local refetch="${2?}"
+    local git_branch="${3?}"
+    local repo_url="${4?}"
+    local test_tool_home
+
+    test_tool_home="$(sudo -i -u "$test_tool_uid" bash -c "echo \"\$HOME\"")"
+    sudo cp "$(realpath "$0")" "$test_tool_home/$SOURCE_FILE_NAME"
+    sudo -i -u "$test_tool_uid" bash -c "source $test_tool_home/$SOURCE_FILE_NAME && setup_venv"
+    sudo -i -u "$test_tool_uid" bash -c "source $test_tool_home/$SOURCE_FILE_NAME && setup_toolforge_deploy \"\$@\"" -- "$refetch" "$git_branch" "$repo_url"
+}
+
+# runs as the login user, takes the shards not yet claimed by other tools one by one and runs them as the given tool
+run_shards_worker() {
+    local test_tool_uid="${1?}"
+    local run_dir="${2?}"
+    local components_str="${3?}"
+    local run_admin="${4?}"
+    shift 4
+    local test_tool_home shard shard_name start exit_code
+
+    test_tool_home="$(sudo -i -u "$test_tool_uid" bash -c "echo \"\$HOME\"")"
+    while read -r shard; do
+        shard_name="${shard//\//-}"
+        [[ "$shard" == "admin" && "$run_admin" == "no" ]] && continue
+        # mkdir is atomic, only one worker gets each shard
+        mkdir "$run_dir/claims/$shard_name" 2>/dev/null || continue
+
+        start=$SECONDS
+        exit_code=0
+        if [[ "$shard" == "admin" ]]; then
+            run_tests "$components_str" "$test_tool_home" "admin" "$@" &>"$run_dir/logs/$shard_name.log" \
+            || exit_code=$?
+        else
+            # the logs are written by the login user
+            # shellcheck disable=SC2024
+            sudo -i -u "$test_tool_uid" \
+            bash -c \
+            "source $test_tool_home/$SOURCE_FILE_NAME && \
+            run_tests \"\$@\"" -- "$components_str" "$test_tool_home" "$shard" "$@" \
+            &>"$run_dir/logs/$shard_name.log" \
+            || exit_code=$?
+        fi
+        if [[ "$shard" == "admin" ]]; then
+            get_test_report "$USER" "$shard" > "$run_dir/reports/$shard_name.xml" 2>/dev/null || :
+        else
+            get_test_report "$test_tool_uid" "$shard" > "$run_dir/reports/$shard_name.xml" 2>/dev/null || :
+        fi
+        echo "$shard_name $test_tool_uid $exit_code $((SECONDS - start))" >> "$run_dir/results"
+        echo "@@@@@@@@ Finished $shard as $test_tool_uid (exit code $exit_code, $((SECONDS - start))s)"
+    done < "$run_dir/shards"
+}
+
+# runs the admin tests as the login user and the tools tests sharded over the pool of test tools, all in parallel
+run_sharded_tests() {
+    local components_str="${1?}"
+    local run_dir="${2?}"
+    local test_tools_str="${3?}"
+    shift 3
+    local -a test_tools
+    local test_tool_uid shard_name status duration run_admin failed=0
+
+    IFS=, read -ra test_tools <<< "$test_tools_str"
+    mkdir -p "$run_dir/claims" "$run_dir/logs" "$run_dir/reports"
+    {
+        echo "admin"
+        get_test_shards "$components_str" "$HOME"
+    } > "$run_dir/shards"
+    echo "@@@@@@@@ Running $(wc -l < "$run_dir/shards") shards with ${#test_tools[@]} test tools, logs in $run_dir/logs"
+
+    for test_tool_uid in "${test_tools[@]}"; do
+        # the admin shard runs as the login user (with TEST_TOOL_UID set to the first tool), so only the first
+        # worker picks it up
+        if [[ "$test_tool_uid" == "${test_tools[0]}" ]]; then
+            run_admin="yes"
+        else
+            run_admin="no"
+        fi
+        TEST_TOOL_UID="$test_tool_uid" run_shards_worker "$test_tool_uid" "$run_dir" "$components_str" "$run_admin" "$@" &
+    done
+    wait
+
+    echo "@@@@@@@@ Results:"
+    while read -r shard_name test_tool_uid status duration; do
+        if [[ "$status" == "0" ]]; then
+            printf "    %-30s %-35s %-6s %5ss\n" "$shard_name" "$test_tool_uid" "ok" "$duration"
+        else
+            printf "    %-30s %-35s %-6s %5ss  %s\n" \
+                "$shard_name" "$test_tool_uid" "FAILED" "$duration" "$run_dir/logs/$shard_name.log"
+            failed=$((failed + 1))
+        fi
+        cat "$run_dir/logs/$shard_name.log" >> "$run_dir/all.log"
+    done < <(sort "$run_dir/results")
+    echo "@@@@@@@@ Merged log: $run_dir/all.log"
+    return $failed
+}
+
 
 main() {
     local refetch="no"
@@ -290,8 +546,14 @@ main() {
     local opts \
         test_tool_uid \
         current_project \
-        test_tool_name=""
+        test_tool_name="" \
+        extra_test_tool_name \
+        run_dir \
+        pid \
+        exit_code=0
+    local -a extra_test_tool_names=() setup_pids=()
 
+    UTILS_DIR="$(dirname "$(realpath "$0")")"
 
     opts=$(getopt -o 'hrvt:b:c:u:' --long 'help,verbose,refetch-tests,test-tool:,branch:,component:,url:' -n "$0" -- "$@")
     # shellcheck disable=SC2181
@@ -322,7 +584,11 @@ main() {
                 continue
             ;;
             '-t'|'--test-tool')
-                test_tool_name="$2"
+                if [[ "$test_tool_name" == "" ]]; then
+                    test_tool_name="$2"
+                else
+                    extra_test_tool_names+=("$2")
+                fi
                 shift 2
                 continue
             ;;
@@ -392,19 +658,75 @@ main() {
 
     # since tests are no longer always run as tool user, we can't depend on $USER
     export TEST_TOOL_UID="$test_tool_uid"
+    TEST_TOOLS_POOL=("$test_tool_uid")
+    for extra_test_tool_name in "${extra_test_tool_names[@]}"; do
+        if ! is_login_user; then
+            echo "You can only run the tests with a pool of test tools as a login user"
+            exit 1
+        fi
+        if ! id -u "$current_project.$extra_test_tool_name" &>/dev/null; then
+            echo "Unable to find user for tool $extra_test_tool_name (uid:$current_project.$extra_test_tool_name)"
+            exit 1
+        fi
+        TEST_TOOLS_POOL+=("$current_project.$extra_test_tool_name")
+    done
 
-    ensure_lock "$TEST_TOOL_UID"
-    trap 'remove_file "$TEST_TOOL_UID" "functional_tests.lock"; remove_file "$TEST_TOOL_UID" "$SOURCE_FILE_NAME"' EXIT
+    for test_tool_uid in "${TEST_TOOLS_POOL[@]}"; do
+        ensure_lock "$test_tool_uid"
+    done
+    trap 'cleanup_test_tools' EXIT
+    test_tool_uid="$TEST_TOOL_UID"
 
     if is_login_user; then
         echo "Installed toolforge components and CLIs versions:"
         # 47 chars. Note that this is being used here https://gerrit.wikimedia.org/r/plugins/gitiles/cloud/wmcs-cookbooks/+/refs/heads/main/cookbooks/wmcs/toolforge/component/deploy.py#222
         echo "-----------------------------------------------"
-        "${0%/*}"/toolforge_get_versions.sh
+        run_dir="$TEST_RUNS_DIR/$(date +%Y%m%d-%H%M%S)"
+        mkdir -p "$run_dir/logs" "$run_dir/reports"
+        "${0%/*}"/toolforge_get_versions.sh --save-json "$run_dir/versions.json"
          # 47 chars. Note that this is being used here https://gerrit.wikimedia.org/r/plugins/gitiles/cloud/wmcs-cookbooks/+/refs/heads/main/cookbooks/wmcs/toolforge/component/deploy.py#222
         echo "-----------------------------------------------"
         echo -e "\n"
 
+        if [[ ${#TEST_TOOLS_POOL[@]} -gt 1 ]]; then
+            echo "@@@@@@@@ Setting up the test tools ${TEST_TOOLS_POOL[*]} (logs in $run_dir/logs)"
+            for test_tool_uid in "${TEST_TOOLS_POOL[@]}"; do
+                setup_test_tool "$test_tool_uid" "$refetch" "$git_branch" "$repo_url" \
+                    &>"$run_dir/logs/setup-$test_tool_uid.log" &
+                setup_pids+=("$!")
+            done
+            setup_toolforge_deploy "$refetch" "$git_branch" "$repo_url"
+            for pid in "${setup_pids[@]}"; do
+                if ! wait "$pid"; then
+                    echo "Failed to set up some of the test tools, see $run_dir/logs/setup-*.log"
+                    exit 1
+                fi
+            done
+
+            local components_str="all"
+            if [[ ${#components[@]} -gt 0 ]]; then
+                for component in "${components[@]}"; do
+                    if [[ ! -d "$HOME/toolforge-deploy/components/$component" ]]; then
+                        echo "The component ${component} doesn't exist. Exiting..."
+                        exit 1
+                    fi
+                done
+                components_str=$(IFS=,; echo "${components[*]}")
+            fi
+
+            echo "@@@@@@@@ Running admin and tools tests sharded (for components $components_str) ..."
+            echo "--------------------------------------------------"
+            run_sharded_tests \
+                "$components_str" \
+                "$run_dir" \
+                "$(IFS=,; echo "${TEST_TOOLS_POOL[*]}")" \
+                "${verbose_options[@]}" \
+                "$@" \
+            || exit_code=$?
+            record_test_timings "$run_dir" "$current_project"
+            return $exit_code
+        fi
+
         local test_tool_home
         test_tool_home="$(sudo -i -u "$TEST_TOOL_UID" bash -c "echo \"\$HOME\"")"
         sudo cp "$(realpath "$0")" "$test_tool_home/$SOURCE_FILE_NAME"
@@ -428,19 +750,28 @@ main() {
 
         echo "@@@@@@@@ Running admin tests as $USER (for components $components_str) ..."
         echo "-----------------------------------------"
-        run_tests "$components_str" "$test_tool_home" "admin" "${verbose_options[@]}" "$@"
-
-        echo "@@@@@@@@ Running tools tests as $test_tool_uid (for components $components_str) ..."
-        echo "--------------------------------------------------"
-        sudo -i -u "$TEST_TOOL_UID" \
-        bash -c \
-        "source $test_tool_home/$SOURCE_FILE_NAME && \
-        run_tests \"\$@\"" -- "$components_str" "$test_tool_home" "tools" "${verbose_options[@]}" "$@"
+        run_tests "$components_str" "$test_tool_home" "admin" "${verbose_options[@]}" "$@" || exit_code=$?
+        get_test_report "$USER" "admin" > "$run_dir/reports/admin.xml" 2>/dev/null || :
+
+        if [[ "$exit_code" -eq 0 ]]; then
+            echo "@@@@@@@@ Running tools tests as $test_tool_uid (for components $components_str) ..."
+            echo "--------------------------------------------------"
+            sudo -i -u "$TEST_TOOL_UID" \
+            bash -c \
+            "source $test_tool_home/$SOURCE_FILE_NAME && \
+            run_tests \"\$@\"" -- "$components_str" "$test_tool_home" "tools" "${verbose_options[@]}" "$@" \
+            || exit_code=$?
+            get_test_report "$TEST_TOOL_UID" "tools" > "$run_dir/reports/tools.xml" 2>/dev/null || :
+        fi
+        record_test_timings "$run_dir" "$current_project"
+        return $exit_code
     fi
 
     if is_tool_user "$TEST_TOOL_UID"; then
         echo "Installed toolforge CLIs versions:"
-        "${0%/*}"/toolforge_get_versions.sh
+        run_dir="$TEST_RUNS_DIR/$(date +%Y%m%d-%H%M%S)"
+        mkdir -p "$run_dir/reports"
+        "${0%/*}"/toolforge_get_versions.sh --save-json "$run_dir/versions.json"
         echo -e "\n"
 
         setup_venv
@@ -461,7 +792,10 @@ main() {
 
         echo "@@@@@@@@ Running tools tests as $test_tool_uid (for components $components_str) ..."
         echo "--------------------------------------------------"
-        run_tests "$components_str" "$HOME" "tools" "${verbose_options[@]}" "$@"
+        run_tests "$components_str" "$HOME" "tools" "${verbose_options[@]}" "$@" || exit_code=$?
+        get_test_report "$USER" "tools" > "$run_dir/reports/tools.xml" 2>/dev/null || :
+        record_test_timings "$run_dir" "$current_project"
+        return $exit_code
     fi
 }
 
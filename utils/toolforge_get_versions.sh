@@ -12,7 +12,74 @@ TOOLFORGE_DEPLOY_REPO=~/toolforge-deploy
 TOOLFORGE_PACKAGE_REGISTRY_DIR=~/.lima-kilo/installed_packages
 
 
-declare -A NAME_TO_APT_PACKAGE=(
+# the components, their packages and charts come from the components index of the toolforge-deploy checkout, or the
+# one this script is in if there's none (see components/helpers/components_index.py)
+if [[ -e "$TOOLFORGE_DEPLOY_REPO/components/helpers/components_index.py" ]]; then
+    INDEX_REPO="$TOOLFORGE_DEPLOY_REPO"
+else
+    INDEX_REPO="$(dirname "$(realpath "$0")")/.."
+fi
+
+# see components/helpers/tracing.sh, this script might be copied around without the rest of the repo
+TRACING_SH="$(dirname "$(realpath "$0")")/../components/helpers/tracing.sh"
+if [[ -e "$TRACING_SH" ]]; then
+    # shellcheck source=SCRIPTDIR/../components/helpers/tracing.sh
+    source "$TRACING_SH"
+else
+    trace_script() { :; }
+    trace_run() { "$@"; }
+fi
+
+# component -> apt package, filled once by load_components_index
+declare -A APT_PACKAGES=()
+# component -> main helm release, filled once by load_components_index
+declare -A HELM_RELEASES=()
+# release name -> deployed chart (<chart>-<version>), filled once by load_deployed_charts
+declare -A DEPLOYED_CHARTS=()
+# package -> installed version, filled once by load_installed_packages
+declare -A INSTALLED_PACKAGES=()
+# component -> chart version in toolforge-deploy (<chart>-<version>), filled once by load_components_index
+declare -A TOOLFORGE_DEPLOY_VERSIONS=()
+OUTPUT_JSON="no"
+# if set, the versions are also saved as json to this file, see --save-json
+SAVE_JSON_FILE=""
+
+
+im_inside_cloudvps() {
+    [[ -e "/etc/wmcs-project" ]] \
+    && grep -q -e '^\(tools\|toolsbeta\)$' "/etc/wmcs-project"
+}
+
+
+# helm list -A takes quite a while in tools/toolsbeta, so we call it only once for all the charts
+load_deployed_charts() {
+    declare -a extra_opts=()
+    local name chart
+    if im_inside_cloudvps; then
+        extra_opts=(
+            "--kube-as-user=$USER"
+            "--kube-as-group=system:masters"
+        )
+    fi
+    while read -r name chart; do
+        DEPLOYED_CHARTS["$name"]="$chart"
+    done < <(trace_run helm "${extra_opts[@]}" list -A --output json | jq -r '.[] | "\(.name) \(.chart)"')
+}
+
+
+# a single dpkg-query call for all the packages instead of one apt policy per package
+load_installed_packages() {
+    local package status version
+    while IFS=$'\t' read -r package status version; do
+        if [[ "$status" == "install ok installed" ]]; then
+            INSTALLED_PACKAGES["$package"]="$version"
+        fi
+    done < <(dpkg-query --show --showformat='${Package}\t${Status}\t${Version}\n' "${APT_PACKAGES[@]}" 2>/dev/null || :)
+}
+
+
+# the components known before the components index, see load_components_index_without_python
+declare -A FALLBACK_APT_PACKAGES=(
     ["builds-cli"]="toolforge-builds-cli"
     ["components-cli"]="toolforge-components-cli"
     ["envvars-cli"]="toolforge-envvars-cli"
@@ -22,162 +89,283 @@ declare -A NAME_TO_APT_PACKAGE=(
     ["webservice-cli"]="toolforge-webservice"
     ["toolforge-weld"]="python3-toolforge-weld"
 )
-
-
-declare -A NAME_TO_HELM_CHART=(
-    ["api-gateway"]="api-gateway"
-    ["builds-api"]="builds-api"
-    ["builds-builder"]="builds-builder"
-    ["calico"]="calico"
-    ["cert-manager"]="cert-manager"
-    ["components-api"]="components-api"
-    ["envvars-admission"]="envvars-admission"
-    ["envvars-api"]="envvars-api"
-    ["image-config"]="image-config"
-    ["ingress-admission"]="ingress-admission"
-    ["istio-system"]="istio-base"
-    ["jobs-api"]="jobs-api"
-    ["jobs-emailer"]="jobs-emailer"
-    ["kyverno"]="kyverno"
-    ["logs-api"]="logs-api"
-    ["maintain-kubeusers"]="maintain-kubeusers"
-    ["registry-admission"]="registry-admission"
-    ["volume-admission"]="volume-admission"
-    ["wmcs-k8s-metrics"]="wmcs-metrics"
-    ["maintain-harbor"]="maintain-harbor"
+# component -> "<main release> <chart>"
+declare -A FALLBACK_HELM_RELEASES=(
+    ["api-gateway"]="api-gateway api-gateway"
+    ["builds-api"]="builds-api builds-api"
+    ["builds-builder"]="builds-builder builds-builder"
+    ["calico"]="calico calico"
+    ["cert-manager"]="cert-manager cert-manager"
+    ["components-api"]="components-api components-api"
+    ["envvars-admission"]="envvars-admission envvars-admission"
+    ["envvars-api"]="envvars-api envvars-api"
+    ["image-config"]="image-config image-config"
+    ["ingress-admission"]="ingress-admission ingress-admission"
+    ["istio-system"]="istio-base base"
+    ["jobs-api"]="jobs-api jobs-api"
+    ["jobs-emailer"]="jobs-emailer jobs-emailer"
+    ["kyverno"]="kyverno kyverno"
+    ["logs-api"]="logs-api logs-api"
+    ["maintain-kubeusers"]="maintain-kubeusers maintain-kubeusers"
+    ["registry-admission"]="registry-admission registry-admission"
+    ["volume-admission"]="volume-admission volume-admission"
+    ["wmcs-k8s-metrics"]="wmcs-metrics wmcs-k8s-metrics"
+    ["maintain-harbor"]="maintain-harbor maintain-harbor"
 )
 
-ALL_CHARTS_CACHE=""
-
 
-# helm list -A takes quite a while in tools/toolsbeta, so we cache it
-get_all_charts() {
-    declare -a extra_opts
+get_project() {
     if im_inside_cloudvps; then
-        extra_opts=(
-            "--kube-as-user=$USER"
-            "--kube-as-group=system:masters"
-        )
+        cat /etc/wmcs-project
+    else
+        echo "local"
     fi
-    if [[ "$ALL_CHARTS_CACHE" == "" ]]; then
-        ALL_CHARTS_CACHE=$(helm "${extra_opts[@]}" list -A)
+}
+
+
+# the components index needs python3 with PyYAML (and jq to read it), they might not be there when running as a tool
+can_use_components_index() {
+    [[ -e "$INDEX_REPO/components/helpers/components_index.py" ]] \
+    && command -v jq >/dev/null \
+    && python3 -c 'import yaml' 2>/dev/null
+}
+
+
+# the old in-bash parsing of the helmfiles and values files, for when the components index can't be used
+load_components_index_without_python() {
+    local project component release chart version
+    project="$(get_project)"
+
+    for component in "${!FALLBACK_APT_PACKAGES[@]}"; do
+        APT_PACKAGES["$component"]="${FALLBACK_APT_PACKAGES[$component]}"
+    done
+    for component in "${!FALLBACK_HELM_RELEASES[@]}"; do
+        read -r release chart <<<"${FALLBACK_HELM_RELEASES[$component]}"
+        if [[ "$component" =~ (cert-manager|kyverno) ]]; then
+            # it stores the version in the helmfile
+            version="$(grep version "$INDEX_REPO/components/$component/helmfile.yaml" | awk '{print $2}' | tail -n 1)" || :
+        else
+            version="$(
+                grep chartVersion "$INDEX_REPO/components/$component/values/$project".yaml* 2>/dev/null \
+                | awk '{print $2}' \
+                | tail -n 1
+            )" || :
+        fi
+        HELM_RELEASES["$component"]="$release"
+        TOOLFORGE_DEPLOY_VERSIONS["$component"]="$chart-$version"
+    done
+}
+
+
+# a single pass over the components index instead of grepping the values and helmfiles
+load_components_index() {
+    local project kind component name version
+    if ! can_use_components_index; then
+        load_components_index_without_python
+        return 0
     fi
-    echo "$ALL_CHARTS_CACHE"
+    project="$(get_project)"
+
+    while IFS=$'\t' read -r kind component name version; do
+        if [[ "$kind" == "package" ]]; then
+            APT_PACKAGES["$component"]="$name"
+        else
+            HELM_RELEASES["$component"]="$name"
+            TOOLFORGE_DEPLOY_VERSIONS["$component"]="$version"
+        fi
+    done < <(
+        trace_run python3 "$INDEX_REPO/components/helpers/components_index.py" --base-dir "$INDEX_REPO" \
+        | jq -r --arg project "$project" '
+            .components
+            | to_entries[]
+            | .key as $component
+            | .value
+            | if .apt_package then
+                ["package", $component, .apt_package, ""]
+            elif .main_release and .releases[.main_release].chart != "raw" then
+                [
+                    "chart",
+                    $component,
+                    .main_release,
+                    "\(.releases[.main_release].chart)-\(.environments[$project].chart_version // "")"
+                ]
+            else
+                empty
+            end
+            | @tsv
+        '
+    )
 }
 
 
-im_inside_cloudvps() {
-    [[ -e "/etc/wmcs-project" ]] \
-    && grep -q -e '^\(tools\|toolsbeta\)$' "/etc/wmcs-project"
+# converts the tab separated rows from show_row into a json list, with a single jq call for all of them
+rows_to_json() {
+    jq --raw-input --slurp '
+        split("\n")
+        | map(
+            select(. != "")
+            | split("\t")
+            | {component: .[0], type: .[1], name: .[2], version: .[3], comment: .[4]}
+        )
+    '
 }
 
 
-get_toolforge_deploy_version() {
+# prints a row of the report: component type name version comment, tab separated for --json (see rows_to_json)
+show_row() {
     local component="${1?}"
-    local project
-    if im_inside_cloudvps; then
-        project="$(cat /etc/wmcs-project)"
-    else
-        project="local"
+    local type="${2?}"
+    local name="${3?}"
+    local version="${4?}"
+    local comment="${5?}"
+    local version_color="${6:-}"
+    local comment_color="${7:-}"
+    local tsv_row
+
+    tsv_row="$component"$'\t'"$type"$'\t'"$name"$'\t'"$version"$'\t'"$comment"
+    if [[ "$SAVE_JSON_FILE" != "" ]]; then
+        echo "$tsv_row" >> "$SAVE_JSON_FILE.rows"
     fi
-    if [[ "$component" =~ (cert-manager|kyverno) ]]; then
-        # it stores the version in the helmfile
-        echo "$component-$(grep version "$TOOLFORGE_DEPLOY_REPO"/components/"$component"/helmfile.yaml | awk '{print $2}' | tail -n 1)"
+    if [[ "$OUTPUT_JSON" == "yes" ]]; then
+        echo "$tsv_row"
         return 0
     fi
 
-    echo "$component-$(grep chartVersion "$TOOLFORGE_DEPLOY_REPO"/components/"$component"/values/"$project".yaml* | awk '{print $2}' | tail -n 1)"
-    return 0
+    if [[ "$version_color" != "" ]]; then
+        version="$version_color$version$ENDCOLOR"
+    fi
+    if [[ "$comment_color" != "" && "$comment" != "" ]]; then
+        comment="$comment_color$comment$ENDCOLOR"
+    fi
+    echo -e "| $component | $type | $name | $version | $comment |"
 }
 
 
 show_package_version() {
     local component="${1?}"
-    local package="${NAME_TO_APT_PACKAGE[$component]}"
+    local package="${APT_PACKAGES[$component]}"
     local cur_version \
-        apt_policy \
         installed_mr \
-        registry_file \
-        comment=""
-
-    # Check if package exists first
-    # The output of apt policy will have the installed version starting
-    # with three ***, or *** will not be there if it's not installed
-    apt_policy=$(apt policy "$package" 2>/dev/null | grep '\*\*\*' --after 1)
-    if ! [[ "$apt_policy" =~ ^\ \*\*\* ]]; then
-        echo -e "| $component | package | $package | ${RED}missing${ENDCOLOR} | |"
+        registry_file
+
+    if [[ "${INSTALLED_PACKAGES[$package]:-}" == "" ]]; then
+        show_row "$component" package "$package" missing "" "$RED"
         return 0
     fi
 
-    cur_version=$(echo "$apt_policy"| head -n1 | awk '{print $2}')
+    cur_version="${INSTALLED_PACKAGES[$package]}"
     registry_file="$TOOLFORGE_PACKAGE_REGISTRY_DIR/$package"
     if [[ -e "$registry_file" ]]; then
         installed_mr=$( \
             jq '.mr_number' 2>/dev/null < "$registry_file" \
             || echo "$registry_file" \
         )
-        cur_version="$YELLOW$cur_version$ENDCOLOR"
-        comment="${YELLOW}mr:$component!$installed_mr$ENDCOLOR"
+        show_row "$component" package "$package" "$cur_version" "mr:$component!$installed_mr" "$YELLOW" "$YELLOW"
+        return 0
     fi
-    echo -e "| $component | package | $package | $cur_version | $comment |"
+    show_row "$component" package "$package" "$cur_version" ""
 }
 
 
 show_chart_version() {
     local component="${1?}"
-    local chart="${NAME_TO_HELM_CHART[$component]}"
+    local release="${HELM_RELEASES[$component]}"
     local cur_version
     local td_version
-    local name
-    local comment=""
-    # warm up the cache
-    get_all_charts >/dev/null
 
-    if [[ "$chart" == "wmcs-metrics" ]]; then
-        name="wmcs-k8s-metrics"
-    else
-        name="$chart"
-    fi
-
-    if ! get_all_charts | grep -q "^$chart "; then
-        echo -e "| $component | chart | $chart | ${RED}missing${ENDCOLOR} | $comment |"
+    if [[ "${DEPLOYED_CHARTS[$release]:-}" == "" ]]; then
+        show_row "$component" chart "$release" missing "" "$RED"
         return
     fi
 
-    cur_version="$(get_all_charts | grep "^$chart " | awk '{print $9}')"
-    if [[ "$component" == "istio-system" ]]; then
-        # istio-base chart version does not include the component name
-        cur_version="${cur_version/#base-/istio-system-}"
-    fi
-
-    td_version=$(get_toolforge_deploy_version "$component")
+    cur_version="${DEPLOYED_CHARTS[$release]}"
+    td_version="${TOOLFORGE_DEPLOY_VERSIONS[$component]}"
     if [[ "$cur_version" =~ ^.*-dev-mr-(.*)$ ]]; then
-        cur_version="$YELLOW$cur_version$ENDCOLOR"
-        comment="${YELLOW}mr:$component!${BASH_REMATCH[1]}$ENDCOLOR"
+        show_row "$component" chart "$release" "$cur_version" "mr:$component!${BASH_REMATCH[1]}" "$YELLOW" "$YELLOW"
     elif [[ "$cur_version" != "$td_version" ]]; then
-        cur_version="$RED$cur_version$ENDCOLOR"
-        comment="${YELLOW}toolforge-deploy has $td_version$ENDCOLOR"
+        show_row "$component" chart "$release" "$cur_version" "toolforge-deploy has $td_version" "$RED" "$YELLOW"
+    else
+        show_row "$component" chart "$release" "$cur_version" ""
     fi
-    echo -e "| $name | chart | $chart | $cur_version | $comment |"
 }
 
-main() {
+
+help() {
+    cat <<EOH
+Usage: $0 [--json] [--save-json FILE]
+
+Shows the installed versions of the toolforge packages and the deployed charts (compared with the ones in
+$TOOLFORGE_DEPLOY_REPO).
+
+The components, their packages and charts come from components/helpers/components_index.py, that needs python3 with
+PyYAML and jq, and caches the index in ~/.cache/toolforge-deploy/components-index/. Without them it falls back to a
+built-in list of the components (new ones won't show up). jq is also needed for --json and the deployed charts.
+
+Options:
+    --json              Output a json list instead of the markdown table.
+    --save-json FILE    Also save the json list to FILE (ex. to keep along the results of the functional tests).
+EOH
+}
+
+
+show_versions() {
     local component
 
+    load_components_index
+    load_installed_packages
     # shellcheck disable=SC1078
-    for component in "${!NAME_TO_APT_PACKAGE[@]}"; do
+    for component in "${!APT_PACKAGES[@]}"; do
         show_package_version "$component"
     done
 
     if [[ "$USER" != "root" ]] && sudo -n true 2>/dev/null;then # trying to show deployed charts as tool user errors out
+        load_deployed_charts
         # shellcheck disable=SC1078
-        for component in "${!NAME_TO_HELM_CHART[@]}"; do
+        for component in "${!HELM_RELEASES[@]}"; do
             show_chart_version "$component"
         done
     fi
 }
 
 
-echo '| component | type | package name | version | comment |'
-echo '| :-------: | :--: | :----------: | :-----: | :-----: |'
-main "$@" | sort
+main() {
+    trace_script "$@"
+    while [[ $# -gt 0 ]]; do
+        case "$1" in
+            -h|--help)
+                help
+                return 0
+            ;;
+            --json)
+                OUTPUT_JSON="yes"
+                shift
+            ;;
+            --save-json)
+                SAVE_JSON_FILE="${2:?--save-json needs a file}"
+                rm -f "$SAVE_JSON_FILE.rows"
+                shift 2
+            ;;
+            *)
+                echo "Unknown option $1" >&2
+                help
+                return 1
+            ;;
+        esac
+    done
+
+    if [[ "$OUTPUT_JSON" == "yes" ]]; then
+        show_versions | sort | rows_to_json
+    else
+        echo '| component | type | package name | version | comment |'
+        echo '| :-------: | :--: | :----------: | :-----: | :-----: |'
+        show_versions | sort
+    fi
+
+    if [[ "$SAVE_JSON_FILE" != "" ]]; then
+        sort "$SAVE_JSON_FILE.rows" 2>/dev/null | rows_to_json > "$SAVE_JSON_FILE"
+        rm -f "$SAVE_JSON_FILE.rows"
+    fi
+}
+
+
+main "$@"
@@ -1,26 +1,17 @@
 #!/bin/bash
-# shellcheck disable=SC2209
-GITLAB_BASE_URL="https://gitlab.wikimedia.org/repos/cloud/toolforge"
+# can be overridden, ex. GITLAB_BASE_URL=file:///tmp/repos to use local bare repos
+GITLAB_BASE_URL="${GITLAB_BASE_URL:-https://gitlab.wikimedia.org/repos/cloud/toolforge}"
+# the latest tag of each repo is cached for this long when updating all the components (0 to disable the cache)
+TAGS_CACHE_TTL_MINUTES="${TAGS_CACHE_TTL_MINUTES:-10}"
+TAGS_CACHE_DIR="${XDG_CACHE_HOME:-$HOME/.cache}/toolforge-deploy/latest-tags"
+# how many repos to query at the same time when updating all the components
+MAX_PARALLEL_QUERIES="${MAX_PARALLEL_QUERIES:-8}"
 
 set -o errexit
 set -o pipefail
 set -o nounset
 shopt -s extglob
 
-GREP=grep
-if ! grep --version | grep -q 'GNU'; then
-    if command -v ggrep; then
-        GREP=ggrep
-    else
-        cat <<EOT
-You don't seem to be running GNU grep, some parts if this script might not work.
-The easiest workaround is probably for Mac users to just 'brew install grep'
-EOT
-        exit 1
-    fi
-fi
-
-
 cd components
 COMPONENTS=(!(helpers))
 cd -
@@ -40,18 +31,80 @@ help() {
     Arguments:
         COMPONENT
             The toolforge component to deploy, pass 'all' or one of: $components_string
+
+    Environment variables:
+        GITLAB_BASE_URL
+            Where to look for the component repos (default: https://gitlab.wikimedia.org/repos/cloud/toolforge),
+            ex. file:///tmp/repos to use local bare repos.
+        TAGS_CACHE_TTL_MINUTES
+            How long to reuse the latest tags found for each repo with 'all', 0 to disable the cache (default: 10).
+            They are cached in $TAGS_CACHE_DIR. A single component always gets the latest tag from its repo.
+        MAX_PARALLEL_QUERIES
+            How many repos to query at the same time with 'all' (default: 8).
+
+    The current chart versions come from components/helpers/components_index.py if python3 (with PyYAML) and jq
+    are available, otherwise they are read from the top level chartVersion of the values files with sed.
 EOH
 }
 
+get_cache_file() {
+    local repo="${1?no component repo passed}"
+    # git is always there, unlike sha256sum/shasum
+    echo "$TAGS_CACHE_DIR/$(echo -n "$repo" | git hash-object --stdin)"
+}
+
+
+# prints the latest tag of the repo, from the cache (see TAGS_CACHE_TTL_MINUTES) if use_cache is "yes": repo [use_cache]
 get_latest_tag() {
     local repo="${1?no component repo passed}"
-    local tmpdir
+    local use_cache="${2:-no}"
+    local cache_file \
+        latest_tag
 
-    tmpdir=$(mktemp -d)
-    git init "$tmpdir" >/dev/null
-    git --git-dir="${tmpdir}/.git" remote add origin "$repo" >/dev/null
-    git --git-dir="${tmpdir}/.git" ls-remote --tags origin | awk '{print $2}' | sort -V | tail -n 1 | sed -e 's/refs\/tags\///'
-    rm -rf "$tmpdir"
+    cache_file="$(get_cache_file "$repo")"
+    if [[ "$use_cache" == "yes" && "$TAGS_CACHE_TTL_MINUTES" != "0" ]] \
+        && [[ -n "$(find "$cache_file" -mmin "-$TAGS_CACHE_TTL_MINUTES" 2>/dev/null)" ]]; then
+        cat "$cache_file"
+        return 0
+    fi
+
+    # no need for a local repo to list the remote tags, --refs skips the peeled tags (<tag>^{})
+    latest_tag="$(git ls-remote --tags --refs "$repo" | awk '{print $2}' | sort -V | tail -n 1 | sed -e 's/refs\/tags\///')"
+    if [[ "$latest_tag" != "" ]]; then
+        mkdir -p "$TAGS_CACHE_DIR"
+        # write and move, so concurrent runs never read a half written file
+        echo "$latest_tag" > "$cache_file.$$"
+        mv "$cache_file.$$" "$cache_file"
+    fi
+    echo "$latest_tag"
+}
+
+
+# component -> latest tag found by prefetch_latest_tags, an empty file when the repo has no tags
+PREFETCHED_TAGS_DIR=""
+
+
+# queries the latest tags of all the given components in parallel, filling the cache and PREFETCHED_TAGS_DIR
+prefetch_latest_tags() {
+    local component
+    local running=0
+
+    PREFETCHED_TAGS_DIR="$(mktemp -d)"
+    trap 'rm -rf "$PREFETCHED_TAGS_DIR"' EXIT
+    for component in "$@"; do
+        if [[ "$running" -ge "$MAX_PARALLEL_QUERIES" ]]; then
+            wait -n || :
+            running=$((running - 1))
+        fi
+        # write and move, so a failed query leaves no result and gets retried by update_component
+        {
+            get_latest_tag "${GITLAB_BASE_URL}/${component}.git" yes \
+                >"$PREFETCHED_TAGS_DIR/$component.tmp" 2>/dev/null \
+            && mv "$PREFETCHED_TAGS_DIR/$component.tmp" "$PREFETCHED_TAGS_DIR/$component"
+        } &
+        running=$((running + 1))
+    done
+    wait || :
 }
 
 
@@ -65,7 +118,11 @@ update_component() {
         deployment
 
     component_repo="${GITLAB_BASE_URL}/${component}.git"
-    latest_tag=$(get_latest_tag "$component_repo")
+    if [[ -n "$PREFETCHED_TAGS_DIR" && -e "$PREFETCHED_TAGS_DIR/$component" ]]; then
+        latest_tag=$(<"$PREFETCHED_TAGS_DIR/$component")
+    else
+        latest_tag=$(get_latest_tag "$component_repo")
+    fi
 
     if [[ "$latest_tag" == "" ]]; then
         echo "Unable to find a latest release for component $component, maybe it does not have CI setup?"
@@ -75,7 +132,7 @@ update_component() {
     some_tag_found="no"
     deployment_files=(components/"$component"/values/*.yaml*)
     for deployment_file in "${deployment_files[@]}"; do
-        current_tag=$($GREP -Po '(?<=chartVersion: ).*' "$deployment_file" | sed -e 's/ //g' || echo "tagnotfound")
+        current_tag="${CHART_VERSIONS[$deployment_file]:-tagnotfound}"
         if [ "$current_tag" == "tagnotfound" ] ; then
             # this can happen if we have multiple values files, for overrides, but not all of them
             # have the chartVersion entry. See for example wmcs-k8s-metrics
@@ -88,7 +145,7 @@ update_component() {
         deployment="${deployment##*/}"
         if [[ "$current_tag" != "$latest_tag" ]]; then
             echo "**Updating** $component/$deployment: $current_tag -> $latest_tag"
-            sed -i -e "s/chartVersion:.*/chartVersion: $latest_tag/" "$deployment_file"
+            FILES_TO_UPDATE["$deployment_file"]="$latest_tag"
         else
             echo "Already at latest $component/$deployment: $current_tag == $latest_tag"
         fi
@@ -96,10 +153,56 @@ update_component() {
 
     if [ "$some_tag_found" == "no" ] ; then
         echo "Could not find any chartVersion tag in any deployment value files. Checked: ${deployment_files[*]}"
+        # keep the updates of the previous components
+        write_chart_versions
         exit 1
     fi
 }
 
+# values file -> current chartVersion, see load_chart_versions
+declare -A CHART_VERSIONS=()
+# values file -> new chartVersion, see write_chart_versions
+declare -A FILES_TO_UPDATE=()
+
+
+# the components index needs python3 with PyYAML, and jq to read it
+can_use_components_index() {
+    command -v jq >/dev/null && python3 -c 'import yaml' 2>/dev/null
+}
+
+
+# gets the chartVersion of all the values files from the components index (see components/helpers/components_index.py),
+# or straight from the values files if it can't be used
+load_chart_versions() {
+    local deployment_file current_tag
+    if ! can_use_components_index; then
+        for deployment_file in components/*/values/*.yaml*; do
+            # only the top level one, like the components index
+            current_tag="$(sed -n -e 's/^chartVersion:[[:space:]]*//p' "$deployment_file" | head -n 1 | tr -d ' ')"
+            if [[ "$current_tag" != "" ]]; then
+                CHART_VERSIONS["$deployment_file"]="$current_tag"
+            fi
+        done
+        return 0
+    fi
+
+    while IFS=$'\t' read -r deployment_file current_tag; do
+        CHART_VERSIONS["$deployment_file"]="$current_tag"
+    done < <(
+        python3 components/helpers/components_index.py \
+        | jq -r '.components[].values_files | to_entries[] | select(.value != null) | [.key, .value] | @tsv'
+    )
+}
+
+
+write_chart_versions() {
+    local deployment_file
+    for deployment_file in "${!FILES_TO_UPDATE[@]}"; do
+        sed -i -e "s/chartVersion:.*/chartVersion: ${FILES_TO_UPDATE[$deployment_file]}/" "$deployment_file"
+    done
+}
+
+
 main() {
     local component \
         component_repo \
@@ -112,7 +215,9 @@ main() {
 
     component="${1:?No component passed, pass 'all' or choose one of: ${COMPONENTS[@]}}"
     shift
+    load_chart_versions
     if [[ "$component" == "all" ]]; then
+        prefetch_latest_tags "${COMPONENTS[@]}"
         for component in "${COMPONENTS[@]}"; do
             update_component "$component"
         done
@@ -124,6 +229,7 @@ main() {
         fi
         update_component "$component"
     fi
+    write_chart_versions
 
     echo -e "\n**NOTE**: you might have to modify helm configuration, this only updates the chart versions."
 }